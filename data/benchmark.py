@@ -0,0 +1,436 @@
+'''
+Benchmarks of the fetcher's local storage and the data transforms, over a
+synthetic dataset (see `yelp/synthetic.py`) of a given number of businesses.
+
+Each benchmark records the best time of `--repeat` runs, throughput in items
+per second, and peak memory allocated by Python (from a separate run under
+tracemalloc, so tracing doesn't skew the timings).
+
+    python benchmark.py --size 100000 --save benchmarks/100k.json
+    python benchmark.py --size 100000 --compare benchmarks/100k.json
+
+With `--compare`, results that are slower, or peak memory that is higher,
+than the baseline by more than `--threshold` are flagged as regressions, and
+the script exits non-zero.
+'''
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import datavis_transform
+from yelp import persist, synthetic, yelp_categories
+from yelp.archive import ResponseArchive
+from yelp.columnar import export_columns, load_columns
+from yelp.progress import ProgressMeter
+from yelp.snapshots import SnapshotStore
+from yelp.store import BusinessStore, fingerprint, trim_business
+
+# Businesses per archive frame, as in a page of search results.
+ARCHIVE_FRAME_SIZE = 50
+
+# Number of writes timed by the write benchmarks. Each JSON progress write
+# rewrites the whole file, so there are fewer of those.
+JSON_WRITES = 10
+LOG_WRITES = 10000
+
+STORE_BATCH_SIZE = 1000
+
+DEFAULT_THRESHOLD = 0.2
+
+
+class Context():
+    '''Datasets shared by benchmarks, generated on first use.'''
+
+    def __init__(self, size, dir, seed=0):
+        self.size = size
+        self.dir = dir
+        self.seed = seed
+        self._categories = None
+        self._store_path = None
+        self._columns_path = None
+        self._n_files = 0
+
+    def path(self, name):
+        '''A fresh path in the scratch directory.'''
+        self._n_files += 1
+        return os.path.join(self.dir, '%d-%s' % (self._n_files, name))
+
+    @property
+    def categories(self):
+        if self._categories is None:
+            self._categories = synthetic.make_categories(seed=self.seed)
+        return self._categories
+
+    def businesses(self):
+        return synthetic.iter_businesses(
+            self.size, seed=self.seed, categories=self.categories)
+
+    def batches(self, size):
+        '''`businesses()` in lists of up to `size`, so they aren't all held.'''
+        batch = []
+        for biz in self.businesses():
+            batch.append(biz)
+            if len(batch) == size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    @property
+    def store_path(self):
+        '''A business store of trimmed businesses, as the fetcher writes.'''
+        if self._store_path is None:
+            path = os.path.join(self.dir, 'businesses.sqlite3')
+            store = BusinessStore(path)
+            for batch in self.batches(STORE_BATCH_SIZE):
+                store.upsert([trim_business(biz) for biz in batch],
+                             fingerprints=[fingerprint(biz) for biz in batch])
+            store.close()
+            self._store_path = path
+        return self._store_path
+
+    @property
+    def columns_path(self):
+        if self._columns_path is None:
+            path = os.path.join(self.dir, 'columns')
+            store = BusinessStore(self.store_path)
+            export_columns(store.items(), path, yelp_categories.CategoryIndex(
+                self.categories))
+            store.close()
+            self._columns_path = path
+        return self._columns_path
+
+    def progress_keys(self):
+        return ['key%08d' % i for i in range(self.size)]
+
+
+# Benchmarks: each takes a `Context` and returns `(run, items)`, where `run`
+# is the function to time and `items` is the number of items it processes.
+# Setup outside of `run` isn't timed.
+
+def bench_update_json_file(ctx):
+    path = ctx.path('progress.json')
+    persist.write_json_file(path, {k: 1 for k in ctx.progress_keys()})
+
+    def run():
+        for i in range(JSON_WRITES):
+            persist.update_json_file(path, {'key%08d' % i: 2})
+    return run, JSON_WRITES
+
+
+def bench_progress_add_keys(ctx):
+    keys = ctx.progress_keys()
+
+    def run():
+        progress = ProgressMeter(ctx.path('progress.json'), use_log=True)
+        progress.add_keys(keys)
+        progress.close()
+    return run, len(keys)
+
+
+def _bench_progress_writes(ctx, use_log, n):
+    keys = ctx.progress_keys()
+    progress = ProgressMeter(ctx.path('progress.json'), use_log=use_log)
+    progress.add_keys(keys)
+
+    def run():
+        for i in range(n):
+            progress.mark_complete(keys[i % len(keys)])
+    return run, n
+
+
+def bench_progress_json_writes(ctx):
+    return _bench_progress_writes(ctx, False, JSON_WRITES)
+
+
+def bench_progress_log_writes(ctx):
+    return _bench_progress_writes(ctx, True, LOG_WRITES)
+
+
+def bench_progress_load(ctx):
+    keys = ctx.progress_keys()
+    path = ctx.path('progress.json')
+    progress = ProgressMeter(path, use_log=True)
+    progress.add_keys(keys)
+    progress.close()
+
+    def run():
+        ProgressMeter(path, use_log=True).close()
+    return run, len(keys)
+
+
+def bench_archive_append(ctx):
+    '''Archive the dataset a page at a time, including generating it.'''
+    def run():
+        archive = ResponseArchive(ctx.path('archive'))
+        for frame in ctx.batches(ARCHIVE_FRAME_SIZE):
+            archive.append(frame)
+        archive.close()
+    return run, ctx.size
+
+
+def bench_archive_scan(ctx):
+    path = ctx.path('archive')
+    archive = ResponseArchive(path)
+    for frame in ctx.batches(ARCHIVE_FRAME_SIZE):
+        archive.append(frame)
+    archive.close()
+
+    def run():
+        archive = ResponseArchive(path)
+        for biz in archive:
+            pass
+        archive.close()
+    return run, ctx.size
+
+
+def bench_get_business_data(ctx):
+    path = ctx.store_path
+
+    def run():
+        datavis_transform.business_data_cache = None
+        datavis_transform.get_business_data(path)
+        datavis_transform.business_data_cache = None
+    return run, ctx.size
+
+
+def bench_to_points(ctx):
+    path = ctx.store_path
+
+    def run():
+        datavis_transform.to_points(
+            'price', datavis_transform.price_level,
+            restrict_to_city='San Francisco', path=path)
+    return run, ctx.size
+
+
+def bench_to_points_vectorized(ctx):
+    columns = load_columns(ctx.columns_path)
+
+    def run():
+        datavis_transform.to_points_vectorized(
+            'price', restrict_to_city='San Francisco', columns=columns)
+    return run, ctx.size
+
+
+def _bench_snapshot_diff(ctx, same_base):
+    '''Diff two snapshots a crawl apart: 1% of businesses changed.'''
+    store = BusinessStore(ctx.path('businesses.sqlite3'))
+    snapshots = SnapshotStore(ctx.path('snapshots.sqlite3'))
+    changed = []
+    for batch in ctx.batches(STORE_BATCH_SIZE):
+        store.upsert(batch)
+        changed.extend(dict(biz, rating=1.0) for biz in batch[::100])
+    old = snapshots.take(store)
+    store.upsert(changed)
+    if not same_base:
+        # Force the new snapshot to be a base of its own.
+        snapshots.conn.execute(
+            'UPDATE snapshots SET size = 0 WHERE id = ?', (old,))
+    new = snapshots.take(store)
+    store.close()
+
+    def run():
+        for change in snapshots.diff(old, new):
+            pass
+    return run, ctx.size
+
+
+def bench_snapshot_diff_delta(ctx):
+    return _bench_snapshot_diff(ctx, True)
+
+
+def bench_snapshot_diff_full(ctx):
+    return _bench_snapshot_diff(ctx, False)
+
+
+def bench_density_points(ctx):
+    columns = load_columns(ctx.columns_path)
+
+    def run():
+        datavis_transform.density_points(
+            'rating', restrict_to_city='San Francisco', columns=columns)
+    return run, ctx.size
+
+
+def _bench_category_points(ctx, indexed):
+    '''Points of one top level category and everything below it.'''
+    columns = load_columns(ctx.columns_path)
+    index = yelp_categories.CategoryIndex(ctx.categories)
+    category = index.top_level[0]
+    layer = datavis_transform.Layer(None, 'rating')
+    # Scan with the synthetic hierarchy, rather than that of categories.json.
+    layer.category_sets = [
+        frozenset((category,) + index.descendants[category])]
+    path = ctx.store_path
+
+    def run():
+        if indexed:
+            datavis_transform.to_points(
+                'rating', categories=category, path=path, columns=columns)
+        else:
+            list(datavis_transform.iter_layer_points(
+                [layer], datavis_transform.iter_business_data(path)))
+    return run, ctx.size
+
+
+def bench_category_points_indexed(ctx):
+    return _bench_category_points(ctx, True)
+
+
+def bench_category_points_scan(ctx):
+    return _bench_category_points(ctx, False)
+
+
+def bench_category_index_build(ctx):
+    path = ctx.path('categories.json')
+    with open(path, 'w') as f:
+        f.write(json.dumps(ctx.categories))
+
+    def run():
+        yelp_categories.build_category_index(path)
+    return run, len(ctx.categories)
+
+
+def bench_category_lookups(ctx):
+    index = yelp_categories.CategoryIndex(ctx.categories)
+    aliases = list(index.aliases)
+
+    def run():
+        saved = yelp_categories.category_index
+        yelp_categories.category_index = index
+        try:
+            for alias in aliases:
+                yelp_categories.get_child_categories(alias)
+                yelp_categories.get_descendant_categories(alias)
+                yelp_categories.get_ancestor_categories(alias)
+                yelp_categories.is_leaf_category(alias)
+        finally:
+            yelp_categories.category_index = saved
+    return run, 4 * len(aliases)
+
+
+BENCHMARKS = {
+    'update_json_file': bench_update_json_file,
+    'progress_add_keys': bench_progress_add_keys,
+    'progress_json_writes': bench_progress_json_writes,
+    'progress_log_writes': bench_progress_log_writes,
+    'progress_load': bench_progress_load,
+    'archive_append': bench_archive_append,
+    'archive_scan': bench_archive_scan,
+    'get_business_data': bench_get_business_data,
+    'to_points': bench_to_points,
+    'to_points_vectorized': bench_to_points_vectorized,
+    'density_points': bench_density_points,
+    'snapshot_diff_delta': bench_snapshot_diff_delta,
+    'snapshot_diff_full': bench_snapshot_diff_full,
+    'category_points_indexed': bench_category_points_indexed,
+    'category_points_scan': bench_category_points_scan,
+    'category_index_build': bench_category_index_build,
+    'category_lookups': bench_category_lookups,
+}
+
+
+def measure(ctx, bench, repeat=3):
+    '''Time a benchmark and measure its peak memory.'''
+    run, items = bench(ctx)
+    seconds = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+
+    tracemalloc.start()
+    try:
+        run()
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {
+        'seconds': seconds,
+        'items': items,
+        'throughput': items / seconds if seconds else None,
+        'peak_bytes': peak_bytes,
+    }
+
+
+def run_benchmarks(size, names=None, repeat=3, seed=0):
+    '''Run benchmarks over a synthetic dataset of `size` businesses.'''
+    results = {}
+    with tempfile.TemporaryDirectory() as dir:
+        ctx = Context(size, dir, seed=seed)
+        for name in names or BENCHMARKS:
+            results[name] = measure(ctx, BENCHMARKS[name], repeat)
+            print('%-24s %10.4fs %14.0f items/s %10.1f MiB peak' % (
+                name, results[name]['seconds'],
+                results[name]['throughput'] or 0,
+                results[name]['peak_bytes'] / 1024 ** 2))
+    return {
+        'size': size,
+        'seed': seed,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD):
+    '''Return descriptions of results that regressed from the baseline.'''
+    if baseline['size'] != current['size']:
+        raise ValueError('Baseline is for size %d, not %d' % (
+            baseline['size'], current['size']))
+    regressions = []
+    for name, result in current['results'].items():
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        for metric in ('seconds', 'peak_bytes'):
+            if not base[metric]:
+                continue
+            change = result[metric] / base[metric] - 1
+            if change > threshold:
+                regressions.append('%s: %s %.0f%% worse (%s -> %s)' % (
+                    name, metric, 100 * change, base[metric], result[metric]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size', type=int, default=10000,
+                        help='number of businesses (default 10000)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS),
+                        help='benchmarks to run (default all)')
+    parser.add_argument('--save', help='write results to this JSON file')
+    parser.add_argument('--compare', help='baseline JSON file to compare to')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='relative slowdown that counts as a regression')
+    args = parser.parse_args(argv)
+
+    current = run_benchmarks(args.size, args.only, args.repeat, args.seed)
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)),
+                    exist_ok=True)
+        persist.write_json_file(args.save, current)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.loads(f.read())
+        regressions = compare(baseline, current, args.threshold)
+        for regression in regressions:
+            print('REGRESSION %s' % regression)
+        if regressions:
+            return 1
+        print('No regressions against %s' % args.compare)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,89 +6,640 @@ downloaded.
 + heatmap points: `[lat, lng, intensity]`
 '''
 
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 import json
 import os
+import shutil
+import sys
 import time
 
+import numpy as np
+
+from yelp.columnar import load_columns
+from yelp import density
+from yelp import persist
+from yelp.jsonstream import (
+    JSONArrayWriter, iter_json_file_items, write_json_array)
+from yelp import pointfile
+from yelp import tiles
 from yelp.settings import *
+from yelp.snapshots import SnapshotStore, iter_change_businesses
+from yelp.store import BusinessStore
+from yelp.yelp_categories import get_descendant_categories
+
+# Tile pyramid output, relative to this directory.
+TILES_DIR = 'tiles'
+TILES_MIN_ZOOM = 10
+TILES_MAX_ZOOM = 16
+
+# Density normalized layers: grid resolution and kernel bandwidth.
+DENSITY_CELL_METERS = density.DEFAULT_CELL_METERS
+DENSITY_BANDWIDTH_METERS = density.DEFAULT_BANDWIDTH_METERS
+
+
+def normalize_city(city):
+    return city.lower().replace(' ', '')
 
 
 def to_points(
     value_selector, value_transform_fn=None, ignore_nulls=False,
-    restrict_to_city=None
+    restrict_to_city=None, path=None, bbox=None, columns=None,
+    businesses=None, categories=None, match_all_categories=False
 ):
     '''
     Transforms business data into a list of points to be used on a map; that
     is, coordinates with an associated value.
 
     `value_selector` is a dictionary key into a Yelp business API object.
+    `bbox`, if given, is `(south, west, north, east)`; only businesses in it
+    are read, via the spatial index of the columnar dataset `columns`.
+    `businesses`, if given, are the `(id, business)` pairs to use instead of
+    local storage, e.g. from `iter_change_businesses`.
+    `categories`, if given, is a category alias or collection of aliases;
+    only businesses in any of them (with `match_all_categories`, in all of
+    them), or in a category below one in the hierarchy, are read, via the
+    inverted category index of `columns`.
     Point format:
         `[lat, lng, value]`
     '''
-    if value_transform_fn is None:
-        def value_transform_fn(x): return x  # Identity function
-
-    def should_keep_biz(biz):
-        # Check if value is null
-        if biz.get(value_selector) is None and not ignore_nulls:
-            return False
-        # Check if city doesn't match
-        if restrict_to_city:
-            if (biz['location']['city'].lower().replace(' ', '') !=
-                    restrict_to_city.lower().replace(' ', '')):
-                return False
-        return True
-
-    return [
-        [
-            b['coordinates']['latitude'],
-            b['coordinates']['longitude'],
-            value_transform_fn(b.get(value_selector)),
-        ]
-        for id, b in list(get_business_data().items())
-        if should_keep_biz(b)
+    return list(iter_points(
+        value_selector, value_transform_fn, ignore_nulls, restrict_to_city,
+        path, bbox, columns, businesses, categories, match_all_categories))
+
+
+def iter_points(
+    value_selector, value_transform_fn=None, ignore_nulls=False,
+    restrict_to_city=None, path=None, bbox=None, columns=None,
+    businesses=None, categories=None, match_all_categories=False
+):
+    '''
+    Generator version of `to_points`, which streams businesses from local
+    storage so that memory use doesn't grow with the dataset.
+    '''
+    indexed = businesses is None and not _is_json_path(path)
+    if businesses is None and categories is not None and indexed:
+        businesses = iter_business_data_in_categories(
+            categories, match_all_categories, bbox, path, columns)
+        # The index already picked out the categories.
+        categories = None
+    elif businesses is None and bbox is None:
+        businesses = iter_business_data(path)
+    elif businesses is None:
+        businesses = iter_business_data_in_bbox(bbox, path, columns)
+    layer = Layer(
+        None, value_selector, value_transform_fn, ignore_nulls,
+        restrict_to_city, categories, match_all_categories)
+    for i, point in iter_layer_points([layer], businesses):
+        yield point
+
+
+def price_level(price):
+    return len(price)
+
+
+class Layer():
+    '''
+    A heatmap layer: which points to take from each business (arguments are
+    as for `to_points`), and where to write them, relative to this directory.
+    Transform functions must be picklable, i.e. not lambdas, for layers to be
+    built in a process pool.
+    '''
+
+    def __init__(
+        self, output_path, value_selector, value_transform_fn=None,
+        ignore_nulls=False, restrict_to_city=None, categories=None,
+        match_all_categories=False
+    ):
+        self.output_path = output_path
+        self.value_selector = value_selector
+        self.value_transform_fn = value_transform_fn
+        self.ignore_nulls = ignore_nulls
+        self.restrict_to_city = restrict_to_city
+        self.city = normalize_city(restrict_to_city) if restrict_to_city \
+            else None
+        if isinstance(categories, str):
+            categories = [categories]
+        self.categories = categories
+        self.match_all_categories = match_all_categories
+        # Aliases that count as being in each category, for businesses that
+        # aren't looked up in the inverted category index.
+        self.category_sets = [
+            frozenset([c] + get_descendant_categories(c))
+            for c in categories
+        ] if categories is not None else None
+
+    def in_categories(self, b):
+        '''Whether business `b` passes the layer's category filter.'''
+        if self.category_sets is None:
+            return True
+        aliases = set(c['alias'] for c in b.get('categories') or [])
+        match = all if self.match_all_categories else any
+        return match(not aliases.isdisjoint(s) for s in self.category_sets)
+
+    @property
+    def name(self):
+        return os.path.splitext(os.path.basename(self.output_path))[0]
+
+
+def iter_layer_points(layers, businesses):
+    '''
+    Yield `(layer index, point)` for all layers, in one pass over
+    `(id, business)` pairs. Each layer's points come out in the same order
+    as from `to_points`.
+    '''
+    for id, b in businesses:
+        city = None
+        for i, layer in enumerate(layers):
+            value = b.get(layer.value_selector)
+            # Check if value is null
+            if value is None and not layer.ignore_nulls:
+                continue
+            # Check if city doesn't match
+            if layer.city:
+                if city is None:
+                    city = normalize_city(b['location']['city'])
+                if city != layer.city:
+                    continue
+            if not layer.in_categories(b):
+                continue
+            if layer.value_transform_fn is not None:
+                value = layer.value_transform_fn(value)
+            yield i, [
+                b['coordinates']['latitude'],
+                b['coordinates']['longitude'],
+                value,
+            ]
+
+
+def _chunk_layer_points(layers, chunk):
+    '''Process pool worker: points per layer for a chunk of businesses.'''
+    points = [[] for layer in layers]
+    for i, point in iter_layer_points(layers, chunk):
+        points[i].append(point)
+    return points
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def write_layers(
+    layers, path=None, processes=1, chunk_size=10000, binary=False
+):
+    '''
+    Write every layer's points to its `output_path` from a single scan of
+    the business data. With `processes` > 1, chunks of `chunk_size`
+    businesses are turned into points in a process pool; output is the same
+    either way.
+    With `binary`, also write each layer as a binary point file,
+    `<name>.bin` alongside its JSON output (see `yelp/pointfile.py`).
+    Files are written alongside and swapped in once every layer is done, so
+    a failed run leaves the old ones.
+    '''
+    output_paths = [
+        os.path.join(os.path.dirname(__file__), layer.output_path)
+        for layer in layers
     ]
+    tmp_paths = [output_path + '.tmp' for output_path in output_paths]
+    files = [open(tmp_path, 'w') for tmp_path in tmp_paths]
+    writers = [JSONArrayWriter(f) for f in files]
+    if binary:
+        writers = [
+            TeeWriter(writer, pointfile.PointFileWriter(
+                os.path.splitext(output_path)[0] + '.bin'))
+            for writer, output_path in zip(writers, output_paths)
+        ]
+    businesses = iter_business_data(path)
+    try:
+        if processes <= 1:
+            for i, point in iter_layer_points(layers, businesses):
+                writers[i].write(point)
+        else:
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                # Bound the number of chunks in flight, so memory use stays
+                # flat however big the dataset is.
+                pending = deque()
+                for chunk in _chunks(businesses, chunk_size):
+                    pending.append(
+                        executor.submit(_chunk_layer_points, layers, chunk))
+                    if len(pending) >= 2 * processes:
+                        _write_chunk(writers, pending.popleft().result())
+                while pending:
+                    _write_chunk(writers, pending.popleft().result())
+        for writer in writers:
+            writer.close()
+    finally:
+        for f in files:
+            f.close()
+    for tmp_path, output_path in zip(tmp_paths, output_paths):
+        os.replace(tmp_path, output_path)
+
+
+def write_tile_pyramid(
+    layers, root=TILES_DIR, min_zoom=TILES_MIN_ZOOM, max_zoom=TILES_MAX_ZOOM,
+    path=None
+):
+    '''
+    Write a tile pyramid for each layer (see `yelp/tiles.py`) from a single
+    scan of the business data, to `<root>/<layer name>/<z>/<x>/<y>.json`,
+    plus `<root>/index.json` describing the layers.
+    `root` is relative to this directory. Each layer's tiles are written to
+    a directory alongside and swapped in, so a failed run leaves the old
+    ones.
+    '''
+    root = os.path.join(os.path.dirname(__file__), root)
+    pyramids = [tiles.TilePyramid(min_zoom, max_zoom) for layer in layers]
+    for i, point in iter_layer_points(layers, iter_business_data(path)):
+        pyramids[i].add(point)
+
+    for layer, pyramid in zip(layers, pyramids):
+        tmp_name = layer.name + '.tmp'
+        shutil.rmtree(os.path.join(root, tmp_name), ignore_errors=True)
+        os.makedirs(os.path.join(root, tmp_name))
+        for (z, x, y), contents in pyramid.tiles():
+            tile_path = tiles.tile_path(root, tmp_name, z, x, y)
+            os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+            with open(tile_path, 'w') as f:
+                f.write(json.dumps(contents))
+        persist.replace_dir(
+            os.path.join(root, tmp_name), os.path.join(root, layer.name))
+    persist.write_json_file(os.path.join(root, 'index.json'), {
+        'min_zoom': min_zoom,
+        'max_zoom': max_zoom,
+        'tile_size': tiles.TILE_SIZE,
+        'layers': [layer.name for layer in layers],
+    }, pretty_print=False)
+
+
+class TeeWriter():
+    '''Write points to several writers.'''
+
+    def __init__(self, *writers):
+        self.writers = writers
+
+    def write(self, point):
+        for writer in self.writers:
+            writer.write(point)
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+
+def _write_chunk(writers, chunk_points):
+    for writer, points in zip(writers, chunk_points):
+        for point in points:
+            writer.write(point)
+
+
+# Columns of the columnar dataset that back each `value_selector`, and the
+# value that column uses for null.
+COLUMN_SELECTORS = {
+    'price': ('price_level', 0),
+    'rating': ('rating', np.nan),
+    'review_count': ('review_count', -1),
+}
+
+
+def null_mask(values, null_value):
+    if isinstance(null_value, float) and np.isnan(null_value):
+        return np.isnan(values)
+    return values == null_value
+
+
+def city_bounds(city):
+    '''A city's bounds in `SEARCH_LOCATIONS`, or None.'''
+    city = normalize_city(city)
+    for location, bounds in SEARCH_LOCATIONS.items():
+        if normalize_city(location) == city:
+            return bounds
+    return None
+
+
+def select_point_arrays(
+    value_selector, value_transform_fn=None, ignore_nulls=False,
+    restrict_to_city=None, bbox=None, columns=None, categories=None,
+    match_all_categories=False
+):
+    '''
+    Vectorized engine behind `to_points_vectorized`. Returns `PointArrays`
+    sliced straight out of the columnar dataset (see `yelp/columnar.py`),
+    which must be up to date.
+
+    `value_selector` is a key of `COLUMN_SELECTORS`. Note that 'price' is
+    already a price level, i.e. `len()` of the price string.
+    `value_transform_fn`, if given, maps an array of values to an array.
+    `bbox` is `(south, west, north, east)`.
+    `categories` and `match_all_categories` are as for `to_points`.
+    '''
+    if columns is None:
+        columns = load_columns()
+    column, null_value = COLUMN_SELECTORS[value_selector]
+
+    # Candidate rows: the bbox's rows from the spatial index, intersected
+    # with the categories' rows from the category index, else all.
+    rows = None
+    if bbox is not None:
+        rows = columns.spatial.bbox(*bbox)
+    if categories is not None:
+        category_rows = columns.category_rows(
+            categories, match_all_categories)
+        rows = category_rows if rows is None else np.intersect1d(
+            rows, category_rows, assume_unique=True)
+    if rows is None:
+        rows = np.arange(len(columns))
+    values = np.asarray(getattr(columns, column))[rows]
+
+    keep = np.ones(len(rows), dtype=bool)
+    nulls = null_mask(values, null_value)
+    if not ignore_nulls:
+        keep &= ~nulls
+    if restrict_to_city:
+        restrict_to_city = normalize_city(restrict_to_city)
+        city_codes = [
+            i for i, city in enumerate(columns.cities)
+            if city is not None and normalize_city(city) == restrict_to_city
+        ]
+        keep &= np.isin(columns.city[rows], city_codes)
+
+    rows = rows[keep]
+    values = values[keep]
+    nulls = nulls[keep]
+    lat = np.asarray(columns.latitude)
+    lng = np.asarray(columns.longitude)
+    if value_transform_fn is not None:
+        values = value_transform_fn(values)
+    return PointArrays(lat[rows], lng[rows], values, nulls)
+
+
+class PointArrays(namedtuple('PointArrays', ['lat', 'lng', 'value', 'null'])):
+    '''Points as parallel arrays; `null` masks null values.'''
+
+    def __len__(self):
+        return len(self.lat)
+
+    def tolist(self):
+        '''`[lat, lng, value]` lists, with None for nulls and NaNs.'''
+        lat = _to_list(self.lat, np.isnan(self.lat))
+        lng = _to_list(self.lng, np.isnan(self.lng))
+        value = _to_list(self.value, self.null)
+        return [[a, b, c] for a, b, c in zip(lat, lng, value)]
+
+
+def _to_list(values, nulls):
+    '''`values.tolist()`, with None wherever `nulls` is set.'''
+    values = values.tolist()
+    if nulls.any():
+        for i in np.flatnonzero(nulls):
+            values[i] = None
+    return values
+
+
+def to_points_vectorized(*args, **kwargs):
+    '''
+    Same as `to_points`, but computed with array operations over the
+    columnar dataset. Takes the arguments of `select_point_arrays`.
+    '''
+    return select_point_arrays(*args, **kwargs).tolist()
+
+
+def density_points(
+    value_selector, value_transform_fn=None, restrict_to_city=None,
+    columns=None, cell_meters=DENSITY_CELL_METERS,
+    bandwidth_meters=DENSITY_BANDWIDTH_METERS,
+    min_weight=density.DEFAULT_MIN_WEIGHT, categories=None,
+    match_all_categories=False, bounds=None
+):
+    '''
+    Density normalized version of `to_points_vectorized`: `PointArrays` of
+    the kernel-weighted mean value around each cell of a grid, rather than
+    a point per business, so that areas with many businesses don't swamp
+    the values. See `yelp/density.py`.
+    The grid covers `bounds`, by default `restrict_to_city`'s search bounds
+    in `SEARCH_LOCATIONS` if it has any, else the businesses' bounding box.
+    '''
+    if bounds is None and restrict_to_city:
+        bounds = city_bounds(restrict_to_city)
+    points = select_point_arrays(
+        value_selector, value_transform_fn, restrict_to_city=restrict_to_city,
+        columns=columns, categories=categories,
+        match_all_categories=match_all_categories)
+    lat, lng, value = density.normalize(
+        points.lat, points.lng, points.value, cell_meters, bandwidth_meters,
+        min_weight, bounds).points()
+    return PointArrays(lat, lng, value, np.zeros(len(value), dtype=bool))
+
+
+def write_density_layers(
+    layers=None, columns=None, cell_meters=DENSITY_CELL_METERS,
+    bandwidth_meters=DENSITY_BANDWIDTH_METERS, binary=False
+):
+    '''
+    Write each layer's `density_points` to its `output_path`, and with
+    `binary`, to `<name>.bin` alongside.
+    Layer values are selected as in `select_point_arrays`.
+    '''
+    if layers is None:
+        layers = DENSITY_LAYERS
+    if columns is None:
+        columns = load_columns()
+    for layer in layers:
+        points = density_points(
+            layer.value_selector, layer.value_transform_fn,
+            layer.restrict_to_city, columns, cell_meters, bandwidth_meters,
+            categories=layer.categories,
+            match_all_categories=layer.match_all_categories)
+        write_heatmap_points(layer.output_path, points)
+        if binary:
+            write_heatmap_points(
+                os.path.splitext(layer.output_path)[0] + '.bin', points)
 
 
 def write_heatmap_points(rel_path, points):
+    '''
+    Write points to a JSON file. `points` may be a generator, e.g. from
+    `iter_points`, in which case it is streamed to the file.
+    If `rel_path` ends in '.bin', write a binary point file instead (see
+    `yelp/pointfile.py`).
+    '''
     path = os.path.join(os.path.dirname(__file__), rel_path)
+    if path.endswith('.bin'):
+        if isinstance(points, PointArrays):
+            data = pointfile.encode_points(
+                points.lat, points.lng, points.value, points.null)
+        else:
+            data = pointfile.encode_point_list(list(points))
+        pointfile.write_point_file(path, data)
+        return
+
+    if isinstance(points, PointArrays):
+        points = points.tolist()
     with open(path, 'w') as f:
-        f.write(json.dumps(points))
+        write_json_array(f, points)
 
 
 business_data_cache = None
 business_data_cached_path = None
 
 
+def iter_business_data(path=None):
+    '''
+    Yield `(id, business)` pairs from local storage.
+    `path` may be a business store, or a legacy `businesses_search.json`.
+    '''
+    if path is None:
+        path = BUSINESS_STORE_PATH
+
+    if _is_json_path(path):
+        yield from iter_json_file_items(path)
+        return
+
+    store = BusinessStore(path)
+    try:
+        yield from store.items()
+    finally:
+        store.close()
+
+
+def iter_business_data_in_bbox(bbox, path=None, columns=None):
+    '''
+    Yield `(id, business)` pairs inside `bbox`, in ID order, looking them up
+    in the spatial index of the columnar dataset `columns` rather than
+    scanning the whole store. Legacy JSON files have no index, so are scanned.
+    '''
+    if _is_json_path(path):
+        south, west, north, east = bbox
+        for id, b in iter_business_data(path):
+            lat = b['coordinates']['latitude']
+            lng = b['coordinates']['longitude']
+            if lat is not None and lng is not None and \
+                    south <= lat <= north and west <= lng <= east:
+                yield id, b
+        return
+
+    if columns is None:
+        columns = load_columns()
+    yield from _iter_business_data_in_rows(
+        columns.spatial.bbox(*bbox), path, columns)
+
+
+def iter_business_data_in_categories(
+    categories, match_all_categories=False, bbox=None, path=None,
+    columns=None
+):
+    '''
+    Yield `(id, business)` pairs in any of `categories` (with
+    `match_all_categories`, in all of them), or below one in the hierarchy,
+    and inside `bbox` if given, in ID order. Businesses are looked up in the
+    inverted category index of the columnar dataset `columns`, rather than
+    found by scanning the whole store.
+    '''
+    if columns is None:
+        columns = load_columns()
+    rows = columns.category_rows(categories, match_all_categories)
+    if bbox is not None:
+        rows = np.intersect1d(
+            rows, columns.spatial.bbox(*bbox), assume_unique=True)
+    yield from _iter_business_data_in_rows(rows, path, columns)
+
+
+def _iter_business_data_in_rows(rows, path, columns):
+    ids = columns.id[rows].tolist()
+    store = BusinessStore(path or BUSINESS_STORE_PATH)
+    try:
+        yield from store.get_many(ids)
+    finally:
+        store.close()
+
+
+def _is_json_path(path):
+    '''Whether `path` is a legacy JSON file, rather than a business store.'''
+    return path is not None and path.endswith('.json')
+
+
 def get_business_data(path=None):
     '''
-    Fetch all business data from local storage.
+    Fetch all business data from local storage into a cached dict, for
+    callers that need random access. Prefer `iter_business_data` otherwise.
     '''
     if path is None:
-        path = SEARCH_API_DATA_PATH
+        path = BUSINESS_STORE_PATH
 
     global business_data_cache, business_data_cached_path
     if business_data_cache is None or path != business_data_cached_path:
-        with open(path, 'r') as f:
-            business_data_cache = json.loads(f.read())
-            business_data_cached_path = path
+        business_data_cache = dict(iter_business_data(path))
+        business_data_cached_path = path
 
     return business_data_cache
 
 
+CITY = 'San Francisco'
+LAYERS = [
+    Layer('yelp_price_points.json', 'price', price_level,
+          restrict_to_city=CITY),
+    Layer('yelp_rating_points.json', 'rating', restrict_to_city=CITY),
+    Layer('yelp_review_count_points.json', 'review_count',
+          restrict_to_city=CITY),
+]
+
+# Density normalized layers; see `write_density_layers`. 'price' is already
+# a price level here.
+DENSITY_LAYERS = [
+    Layer('yelp_price_density_points.json', 'price', restrict_to_city=CITY),
+    Layer('yelp_rating_density_points.json', 'rating',
+          restrict_to_city=CITY),
+    # Review counts are long tailed, so average their logs.
+    Layer('yelp_review_count_density_points.json', 'review_count',
+          np.log1p, restrict_to_city=CITY),
+]
+
+# Change layers between two snapshots; see `yelp/snapshots.py`.
+CHANGE_LAYERS = [
+    Layer('yelp_openings_points.json', 'opened', restrict_to_city=CITY),
+    Layer('yelp_closures_points.json', 'closed', restrict_to_city=CITY),
+    Layer('yelp_rating_change_points.json', 'rating_change',
+          restrict_to_city=CITY),
+]
+
+
+def write_change_layers(old, new, layers=CHANGE_LAYERS, path=None):
+    '''
+    Write heatmap points of what changed from snapshot `old` to `new` in the
+    snapshot store at `path`, one file per change layer.
+    '''
+    snapshots = SnapshotStore(path or SNAPSHOTS_PATH)
+    try:
+        # Changes are few next to the whole dataset, so diff once.
+        changes = list(iter_change_businesses(snapshots.diff(old, new)))
+    finally:
+        snapshots.close()
+    for layer in layers:
+        write_heatmap_points(layer.output_path, to_points(
+            layer.value_selector, layer.value_transform_fn,
+            layer.ignore_nulls, layer.restrict_to_city, businesses=changes,
+            categories=layer.categories,
+            match_all_categories=layer.match_all_categories))
+
+
 if __name__ == '__main__':
-    city = 'San Francisco'
-    write_heatmap_points(
-        'yelp_price_points.json',
-        to_points('price', lambda price: len(price), restrict_to_city=city)
-    )
-
-    write_heatmap_points(
-        'yelp_rating_points.json',
-        to_points('rating', restrict_to_city=city)
-    )
-
-    write_heatmap_points(
-        'yelp_review_count_points.json',
-        to_points('review_count', restrict_to_city=city)
-    )
+    if sys.argv[1:2] == ['changes']:
+        # python datavis_transform.py changes <old snapshot> <new snapshot>
+        write_change_layers(int(sys.argv[2]), int(sys.argv[3]))
+    elif sys.argv[1:2] == ['density']:
+        # python datavis_transform.py density [bandwidth m] [cell size m]
+        args = [float(arg) for arg in sys.argv[2:4]]
+        write_density_layers(
+            bandwidth_meters=args[0] if args else DENSITY_BANDWIDTH_METERS,
+            cell_meters=args[1] if len(args) > 1 else DENSITY_CELL_METERS,
+            binary=True)
+    else:
+        write_layers(LAYERS, processes=os.cpu_count(), binary=True)
+        write_tile_pyramid(LAYERS)
@@ -0,0 +1,283 @@
+'''
+Incremental version of `datavis_transform.py`: only recompute points for
+businesses that were added, changed or removed in the business store since
+the last run.
+
+State is kept in a SQLite database at `TRANSFORM_STATE_PATH`:
+    meta: the last business store seq processed, and a signature of the
+        layer and tile configuration
+    hashes: content hash of each business
+    points: each layer's point for each business, with its max zoom tile
+    bins: each layer's tile bin aggregates below max zoom
+
+A re-run reads only the changed businesses, patches their points and bin
+aggregates, and rewrites only the tiles they touched, so its cost is
+proportional to the change. Layer point files are whole-dataset outputs:
+they are re-streamed from the saved points, for layers that changed, which
+takes time proportional to the layer. Pass `layer_files=False` to only keep
+tiles up to date. If the layer configuration changes, everything is rebuilt.
+
+    python incremental_transform.py
+'''
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+
+from datavis_transform import (
+    LAYERS, TILES_DIR, TILES_MAX_ZOOM, TILES_MIN_ZOOM, TeeWriter,
+    iter_layer_points)
+from yelp import tiles
+from yelp.jsonstream import JSONArrayWriter
+from yelp.pointfile import PointFileWriter
+from yelp.settings import BUSINESS_STORE_PATH, TRANSFORM_STATE_PATH
+from yelp.store import BusinessStore
+
+logger = logging.getLogger(__name__)
+
+
+def business_hash(biz):
+    return hashlib.blake2b(
+        json.dumps(biz, sort_keys=True).encode('utf-8'), digest_size=16
+    ).hexdigest()
+
+
+class IncrementalTransform():
+
+    def __init__(
+        self, layers=LAYERS, state_path=TRANSFORM_STATE_PATH,
+        store_path=BUSINESS_STORE_PATH, tiles_root=TILES_DIR,
+        min_zoom=TILES_MIN_ZOOM, max_zoom=TILES_MAX_ZOOM, binary=False,
+        layer_files=True
+    ):
+        self.layers = layers
+        self.binary = binary
+        self.layer_files = layer_files
+        self.store_path = store_path
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        # Output paths are relative to this directory.
+        self.root = os.path.dirname(os.path.abspath(__file__))
+        self.tiles_root = os.path.join(self.root, tiles_root)
+
+        self.conn = sqlite3.connect(state_path)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS hashes (
+                id TEXT PRIMARY KEY, hash TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS points (
+                layer INTEGER, id TEXT, lat REAL, lng REAL, value TEXT,
+                tx INTEGER, ty INTEGER,
+                PRIMARY KEY (layer, id));
+            CREATE INDEX IF NOT EXISTS points_tile ON points (layer, tx, ty);
+            CREATE TABLE IF NOT EXISTS bins (
+                layer INTEGER, z INTEGER, tx INTEGER, ty INTEGER,
+                bx INTEGER, by INTEGER,
+                lat_sum, lng_sum, sum, count INTEGER,
+                PRIMARY KEY (layer, z, tx, ty, bx, by));
+        ''')
+
+    def close(self):
+        self.conn.close()
+
+    def signature(self):
+        return json.dumps([
+            [layer.output_path, layer.value_selector,
+             getattr(layer.value_transform_fn, '__qualname__', None),
+             layer.ignore_nulls, layer.restrict_to_city]
+            for layer in self.layers
+        ] + [self.min_zoom, self.max_zoom])
+
+    def _get_meta(self, key):
+        row = self.conn.execute(
+            'SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def _set_meta(self, key, value):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+            (key, value))
+
+    def _reset(self):
+        for table in ('meta', 'hashes', 'points', 'bins'):
+            self.conn.execute('DELETE FROM %s' % table)
+        self._set_meta('signature', self.signature())
+        self._set_meta('seq', '0')
+
+    # Patching
+
+    def _add_bins(self, layer, point, sign):
+        '''Add a point to (or with `sign=-1`, remove it from) its bins.'''
+        lat, lng, value = point
+        if lat is None or lng is None or value is None:
+            return set()
+        touched = set()
+        for zoom in range(self.min_zoom, self.max_zoom):
+            key = tiles.bin_key(lat, lng, zoom)
+            self.conn.execute(
+                'INSERT INTO bins VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT DO UPDATE SET '
+                'lat_sum = lat_sum + excluded.lat_sum, '
+                'lng_sum = lng_sum + excluded.lng_sum, '
+                'sum = sum + excluded.sum, '
+                'count = count + excluded.count',
+                (layer,) + key +
+                (sign * lat, sign * lng, sign * value, sign))
+            touched.add((layer,) + key[:3])
+        return touched
+
+    def _get_point(self, layer, id):
+        row = self.conn.execute(
+            'SELECT lat, lng, value FROM points WHERE layer = ? AND id = ?',
+            (layer, id)).fetchone()
+        if row is None:
+            return None
+        return [row[0], row[1], json.loads(row[2])]
+
+    def _set_point(self, layer, id, old, new):
+        '''Replace a business's `old` point with `new`. Either may be None.'''
+        touched = set()
+        if old is not None:
+            touched |= self._add_bins(layer, old, -1)
+            self.conn.execute(
+                'DELETE FROM points WHERE layer = ? AND id = ?', (layer, id))
+        if new is not None:
+            touched |= self._add_bins(layer, new, 1)
+            lat, lng, value = new
+            tx = ty = None
+            if lat is not None and lng is not None:
+                tx, ty = tiles.to_tile(lat, lng, self.max_zoom)
+            self.conn.execute(
+                'INSERT INTO points VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (layer, id, lat, lng, json.dumps(value), tx, ty))
+        for point in (old, new):
+            if point is not None and None not in point[:2]:
+                touched.add((layer, self.max_zoom) +
+                            tiles.to_tile(point[0], point[1], self.max_zoom))
+        return touched
+
+    def run(self):
+        '''
+        Bring outputs up to date with the business store.
+        Returns `(businesses reprocessed, tiles rewritten)`.
+        '''
+        if self._get_meta('signature') != self.signature():
+            logger.info('Layer configuration changed. Rebuilding.')
+            self._reset()
+        last_seq = int(self._get_meta('seq'))
+
+        store = BusinessStore(self.store_path)
+        seq = store.last_seq()
+        changed_layers = set()
+        touched_tiles = set()
+        n_changed = 0
+        for id, biz in store.changes_since(last_seq):
+            new_hash = business_hash(biz) if biz is not None else None
+            row = self.conn.execute(
+                'SELECT hash FROM hashes WHERE id = ?', (id,)).fetchone()
+            if new_hash == (row[0] if row is not None else None):
+                continue
+            n_changed += 1
+            if new_hash is None:
+                self.conn.execute('DELETE FROM hashes WHERE id = ?', (id,))
+            else:
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO hashes VALUES (?, ?)',
+                    (id, new_hash))
+
+            new_points = {}
+            if biz is not None:
+                new_points = dict(iter_layer_points(self.layers, [(id, biz)]))
+            for i in range(len(self.layers)):
+                old, new = self._get_point(i, id), new_points.get(i)
+                if old == new:
+                    continue
+                changed_layers.add(i)
+                touched_tiles |= self._set_point(i, id, old, new)
+        store.close()
+        self.conn.execute('DELETE FROM bins WHERE count = 0')
+
+        if self.layer_files:
+            for i in sorted(changed_layers):
+                self._write_layer(i)
+        for tile in touched_tiles:
+            self._write_tile(*tile)
+        self._write_tiles_index()
+
+        self._set_meta('seq', str(seq))
+        self.conn.commit()
+        logger.info('Reprocessed %d businesses; rewrote %d tiles.' % (
+            n_changed, len(touched_tiles)))
+        return n_changed, len(touched_tiles)
+
+    # Output
+
+    def _write_layer(self, layer):
+        '''
+        Stream a layer's saved points, in ID order, to its output path.
+        The file is written alongside and swapped in, so readers never see
+        half of it.
+        '''
+        cursor = self.conn.execute(
+            'SELECT lat, lng, value FROM points WHERE layer = ? ORDER BY id',
+            (layer,))
+        path = os.path.join(self.root, self.layers[layer].output_path)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            writer = JSONArrayWriter(f)
+            if self.binary:
+                writer = TeeWriter(writer, PointFileWriter(
+                    os.path.splitext(path)[0] + '.bin'))
+            for lat, lng, value in cursor:
+                writer.write([lat, lng, json.loads(value)])
+            writer.close()
+        os.replace(tmp_path, path)
+
+    def _write_tile(self, layer, z, x, y):
+        if z == self.max_zoom:
+            contents = [
+                [lat, lng, json.loads(value)] for lat, lng, value in
+                self.conn.execute(
+                    'SELECT lat, lng, value FROM points '
+                    'WHERE layer = ? AND tx = ? AND ty = ? ORDER BY id',
+                    (layer, x, y))
+            ]
+        else:
+            contents = [
+                [lat_sum / count, lng_sum / count, sum, count, sum / count]
+                for lat_sum, lng_sum, sum, count in self.conn.execute(
+                    'SELECT lat_sum, lng_sum, sum, count FROM bins '
+                    'WHERE layer = ? AND z = ? AND tx = ? AND ty = ? '
+                    'ORDER BY bx, by',
+                    (layer, z, x, y))
+            ]
+        path = tiles.tile_path(
+            self.tiles_root, self.layers[layer].name, z, x, y)
+        if not contents:
+            # Empty tiles aren't written.
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(json.dumps(contents))
+
+    def _write_tiles_index(self):
+        os.makedirs(self.tiles_root, exist_ok=True)
+        with open(os.path.join(self.tiles_root, 'index.json'), 'w') as f:
+            f.write(json.dumps({
+                'min_zoom': self.min_zoom,
+                'max_zoom': self.max_zoom,
+                'tile_size': tiles.TILE_SIZE,
+                'layers': [layer.name for layer in self.layers],
+            }))
+
+
+if __name__ == '__main__':
+    logger.setLevel(logging.INFO)
+    transform = IncrementalTransform(binary=True)
+    transform.run()
+    transform.close()
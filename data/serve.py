@@ -0,0 +1,474 @@
+'''
+Local map server: serves the map, and heatmap tiles, points and histograms
+computed on demand from the columnar dataset (see `yelp/columnar.py`), so the
+map only downloads what is in view.
+
+    python serve.py [port]
+
+then open http://localhost:8000/. API:
+    /api/tiles/index.json: the layers served, and the zoom range
+    /api/tiles/<layer>/<z>/<x>/<y>.json: a tile, in the format that
+        `datavis_transform.write_tile_pyramid` writes (see `yelp/tiles.py`)
+    /api/points?layer=<layer>&bbox=<south,west,north,east>&zoom=<z>: a
+        layer's points in a bbox, binned as in tiles below the max zoom
+    /api/histogram?layer=<layer>&bbox=<...>&bins=<n>&scale=<log|linear>:
+        histogram of a layer's values in a bbox (by default, everywhere), in
+        up to `MAX_HISTOGRAM_BINS` bins
+
+Responses are gzipped for clients that accept it, and the most recently used
+tiles are kept, compressed, in an LRU cache. The map's own files (see
+`STATIC_FILES`) are served from the repository root; nothing else is. Tiles
+and histograms are computed in a thread pool, off the event loop.
+'''
+
+import asyncio
+from collections import OrderedDict
+from fnmatch import fnmatchcase
+import gzip
+import json
+import mimetypes
+import os
+import sys
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import numpy as np
+
+import datavis_transform
+from datavis_transform import (
+    TILES_MAX_ZOOM, TILES_MIN_ZOOM, Layer, PointArrays, price_level,
+    select_point_arrays)
+from yelp import tiles
+from yelp.columnar import load_columns
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_PORT = 8000
+
+TILE_CACHE_SIZE = 4096  # tiles
+# Responses smaller than this aren't worth compressing.
+GZIP_MIN_BYTES = 256
+GZIP_LEVEL = 6
+MAX_HEADER_BYTES = 64 * 1024
+
+DEFAULT_HISTOGRAM_BINS = 4
+MAX_HISTOGRAM_BINS = 1000
+# Most tiles, at the zoom requested (or the max zoom, for raw points), that
+# an /api/points bbox may cover.
+MAX_POINTS_TILES = 64
+
+# Files under the root that are served, as paths relative to it: the map,
+# and what it loads. The stores, archive and snapshots under data/yelp/
+# aren't.
+STATIC_FILES = [
+    'index.html',
+    'index.js',
+    'lib/*',
+    'data/yelp_*_points.json',
+    'data/yelp_*_points.bin',
+    'data/yelp_*_points.bin.gz',
+    'data/yelp_*_points.bin.br',
+    'data/tiles/*',
+]
+
+
+def columnar_layer(layer):
+    '''
+    `layer` as selected from the columnar dataset, where 'price' is already a
+    price level.
+    '''
+    transform = layer.value_transform_fn
+    if transform is price_level:
+        transform = None
+    return Layer(
+        layer.output_path, layer.value_selector, transform,
+        layer.ignore_nulls, layer.restrict_to_city, layer.categories,
+        layer.match_all_categories)
+
+
+LAYERS = [columnar_layer(layer) for layer in datavis_transform.LAYERS]
+
+STATUS_REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    500: 'Internal Server Error',
+}
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, message=None):
+        super().__init__(message or STATUS_REASONS[status])
+        self.status = status
+
+
+class LRUCache():
+    '''Least recently used cache of up to `max_entries`.'''
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+def to_pixels(lat, lng, zoom):
+    '''Vectorized `tiles.to_pixel`.'''
+    lat = np.clip(lat, -tiles.MAX_LATITUDE, tiles.MAX_LATITUDE)
+    scale = tiles.TILE_SIZE * (1 << zoom)
+    x = (lng + 180) / 360 * scale
+    sin = np.sin(np.radians(lat))
+    y = (0.5 - np.log((1 + sin) / (1 - sin)) / (4 * np.pi)) * scale
+    return x, y
+
+
+def aggregate(lat, lng, value, zoom):
+    '''
+    Bin points into `tiles.BIN_SIZE` pixel bins at `zoom`, as
+    `[lat, lng, sum, count, mean]` lists in bin order, like `tiles.Bin`.
+    '''
+    x, y = to_pixels(lat, lng, zoom)
+    bx = (x // tiles.BIN_SIZE).astype(np.int64)
+    by = (y // tiles.BIN_SIZE).astype(np.int64)
+    keys, inverse = np.unique(
+        bx * (tiles.TILE_SIZE << zoom) + by, return_inverse=True)
+    count = np.bincount(inverse)
+    lat_sum = np.bincount(inverse, lat)
+    lng_sum = np.bincount(inverse, lng)
+    total = np.bincount(inverse, value)
+    return [
+        [a, b, c, n, c / n] for a, b, c, n in zip(
+            (lat_sum / count).tolist(), (lng_sum / count).tolist(),
+            total.tolist(), count.tolist())
+    ]
+
+
+def histogram(values, bins=DEFAULT_HISTOGRAM_BINS, scale='log'):
+    '''
+    `[{x0, x1, count}]` over the range of `values`, with bins evenly spaced
+    on a `scale` of 'linear' or 'log'. Log bins start at 1 at the lowest,
+    and values below 1 (e.g. no reviews) count in the first bin.
+    '''
+    values = values[~np.isnan(values)] if values.dtype.kind == 'f' \
+        else values
+    if not len(values):
+        return []
+    low, high = float(values.min()), float(values.max())
+    if scale == 'log':
+        low = max(1.0, low)
+        high = max(low, high)
+        values = np.maximum(values, low)
+        edges = np.geomspace(low, high, bins + 1) if high > low \
+            else np.array([low, high])
+    elif scale == 'linear':
+        edges = np.linspace(low, high, bins + 1) if high > low \
+            else np.array([low, high])
+    else:
+        raise ValueError('Unknown scale: %s' % scale)
+    counts, edges = np.histogram(values, edges)
+    return [
+        {'x0': x0, 'x1': x1, 'count': count}
+        for x0, x1, count in zip(
+            edges[:-1].tolist(), edges[1:].tolist(), counts.tolist())
+    ]
+
+
+# Default of query parameters that must be given.
+REQUIRED = object()
+
+
+def _param(query, name, parse=str, default=REQUIRED):
+    values = query.get(name)
+    if not values:
+        if default is REQUIRED:
+            raise HTTPError(400, 'Missing parameter %s' % name)
+        return default
+    try:
+        return parse(values[0])
+    except ValueError:
+        raise HTTPError(400, 'Bad parameter %s' % name)
+
+
+def is_static_file(path):
+    '''Whether `path`, relative to the root, is in `STATIC_FILES`.'''
+    path = path.replace(os.sep, '/')
+    return any(fnmatchcase(path, pattern) for pattern in STATIC_FILES)
+
+
+def tiles_spanned(bbox, zoom):
+    '''How many tiles at `zoom` a `(south, west, north, east)` bbox covers.'''
+    south, west, north, east = bbox
+    x0, y0 = tiles.to_tile(north, west, zoom)
+    x1, y1 = tiles.to_tile(south, east, zoom)
+    return (abs(x1 - x0) + 1) * (abs(y1 - y0) + 1)
+
+
+def _parse_bbox(text):
+    bbox = tuple(float(v) for v in text.split(','))
+    if len(bbox) != 4:
+        raise ValueError(text)
+    return bbox
+
+
+class MapServer():
+
+    def __init__(self, columns, layers=LAYERS, root=ROOT,
+                 min_zoom=TILES_MIN_ZOOM, max_zoom=TILES_MAX_ZOOM,
+                 cache_size=TILE_CACHE_SIZE):
+        self.columns = columns
+        self.layers = {layer.name: layer for layer in layers}
+        self.root = os.path.realpath(root)
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.tile_cache = LRUCache(cache_size)
+
+    # Data
+
+    def get_layer(self, name):
+        layer = self.layers.get(name)
+        if layer is None:
+            raise HTTPError(404, 'No layer %s' % name)
+        return layer
+
+    def select(self, layer, bbox=None):
+        '''A layer's `PointArrays`, in `bbox` if given.'''
+        return select_point_arrays(
+            layer.value_selector, layer.value_transform_fn,
+            layer.ignore_nulls, layer.restrict_to_city, bbox, self.columns,
+            layer.categories, layer.match_all_categories)
+
+    def index(self):
+        return {
+            'min_zoom': self.min_zoom,
+            'max_zoom': self.max_zoom,
+            'tile_size': tiles.TILE_SIZE,
+            'layers': list(self.layers),
+        }
+
+    def tile(self, name, z, x, y):
+        '''Contents of a tile, as in `tiles.TilePyramid.tiles`.'''
+        layer = self.get_layer(name)
+        if not self.min_zoom <= z <= self.max_zoom:
+            raise HTTPError(404, 'No zoom %d' % z)
+        points = self.select(layer, tiles.tile_bounds(z, x, y))
+        # The bbox is inclusive, so drop points on the edges of other tiles.
+        px, py = to_pixels(points.lat, points.lng, z)
+        keep = ((px // tiles.TILE_SIZE == x) &
+                (py // tiles.TILE_SIZE == y))
+        if z == self.max_zoom:
+            return PointArrays(*(a[keep] for a in points)).tolist()
+        keep &= ~points.null
+        return aggregate(
+            points.lat[keep], points.lng[keep],
+            points.value[keep].astype(np.float64), z)
+
+    def points(self, name, bbox, zoom):
+        '''
+        A layer's points in `bbox`, binned below the max zoom. Bboxes covering
+        more than `MAX_POINTS_TILES` tiles at that zoom are refused, so that
+        no request bins or lists the whole dataset.
+        '''
+        layer = self.get_layer(name)
+        if zoom < 0:
+            raise HTTPError(400, 'Bad parameter zoom')
+        if tiles_spanned(bbox, min(zoom, self.max_zoom)) > MAX_POINTS_TILES:
+            raise HTTPError(400, 'bbox too large for zoom %d' % zoom)
+        points = self.select(layer, bbox)
+        if zoom >= self.max_zoom:
+            return points.tolist()
+        keep = ~points.null
+        return aggregate(
+            points.lat[keep], points.lng[keep],
+            points.value[keep].astype(np.float64), zoom)
+
+    def histogram(self, name, bbox=None, bins=DEFAULT_HISTOGRAM_BINS,
+                  scale='log'):
+        points = self.select(self.get_layer(name), bbox)
+        values = points.value[~points.null]
+        return {
+            'count': len(values),
+            'bins': histogram(values, bins, scale),
+        }
+
+    # HTTP
+
+    async def route(self, path, query, accept_gzip):
+        '''Return `(content type, body, whether body is gzipped)`.'''
+        loop = asyncio.get_running_loop()
+        parts = path.strip('/').split('/')
+        if parts[:2] == ['api', 'tiles']:
+            if parts[2:] == ['index.json']:
+                return self.json_response(self.index(), accept_gzip)
+            if len(parts) != 6 or not parts[5].endswith('.json'):
+                raise HTTPError(404)
+            try:
+                z, x, y = int(parts[3]), int(parts[4]), int(parts[5][:-5])
+            except ValueError:
+                raise HTTPError(404)
+            key = (parts[2], z, x, y)
+            body = self.tile_cache.get(key)
+            if body is None:
+                contents = await loop.run_in_executor(
+                    None, self.tile, parts[2], z, x, y)
+                body = gzip.compress(
+                    json.dumps(contents).encode('utf-8'), GZIP_LEVEL)
+                self.tile_cache.put(key, body)
+            if accept_gzip:
+                return 'application/json', body, True
+            return 'application/json', gzip.decompress(body), False
+        if parts == ['api', 'points']:
+            contents = await loop.run_in_executor(
+                None, self.points, _param(query, 'layer'),
+                _param(query, 'bbox', _parse_bbox),
+                _param(query, 'zoom', int, self.max_zoom))
+            return self.json_response(contents, accept_gzip)
+        if parts == ['api', 'histogram']:
+            scale = _param(query, 'scale', default='log')
+            if scale not in ('log', 'linear'):
+                raise HTTPError(400, 'Bad parameter scale')
+            bins = _param(query, 'bins', int, DEFAULT_HISTOGRAM_BINS)
+            if not 1 <= bins <= MAX_HISTOGRAM_BINS:
+                raise HTTPError(400, 'Bad parameter bins')
+            contents = await loop.run_in_executor(
+                None, self.histogram, _param(query, 'layer'),
+                _param(query, 'bbox', _parse_bbox, None),
+                bins, scale)
+            return self.json_response(contents, accept_gzip)
+        if parts[0] == 'api':
+            raise HTTPError(404)
+        return await loop.run_in_executor(
+            None, self.static_file, path, accept_gzip)
+
+    def json_response(self, contents, accept_gzip):
+        return self.encode(
+            'application/json', json.dumps(contents).encode('utf-8'),
+            accept_gzip)
+
+    def encode(self, content_type, body, accept_gzip):
+        if accept_gzip and len(body) >= GZIP_MIN_BYTES:
+            return content_type, gzip.compress(body, GZIP_LEVEL), True
+        return content_type, body, False
+
+    def static_file(self, path, accept_gzip):
+        if path.endswith('/'):
+            path += 'index.html'
+        full_path = os.path.realpath(os.path.join(self.root, path.lstrip('/')))
+        if os.path.commonpath([self.root, full_path]) != self.root or \
+                not is_static_file(os.path.relpath(full_path, self.root)) or \
+                not os.path.isfile(full_path):
+            raise HTTPError(404)
+        with open(full_path, 'rb') as f:
+            body = f.read()
+        content_type, encoding = mimetypes.guess_type(full_path)
+        content_type = content_type or 'application/octet-stream'
+        if encoding is not None or not (
+                content_type.startswith('text/') or
+                content_type in ('application/json',
+                                 'application/javascript')):
+            # Already compressed, or not worth compressing.
+            return content_type, body, False
+        return self.encode(content_type, body, accept_gzip)
+
+    async def handle(self, reader, writer):
+        '''Serve HTTP/1.1 requests on a connection, kept alive.'''
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                        ConnectionError):
+                    return
+                lines = head.decode('latin-1').split('\r\n')
+                request = lines[0].split(' ')
+                headers = {}
+                for line in lines[1:]:
+                    name, sep, value = line.partition(':')
+                    if sep:
+                        headers[name.strip().lower()] = value.strip()
+                keep_alive = len(request) == 3 and \
+                    request[2] == 'HTTP/1.1' and \
+                    headers.get('connection', '').lower() != 'close'
+                # Requests with bodies aren't supported, so don't try to
+                # find the next request after one.
+                if 'content-length' in headers or \
+                        'transfer-encoding' in headers:
+                    keep_alive = False
+
+                status = 200
+                encoded = False
+                try:
+                    if len(request) != 3:
+                        raise HTTPError(400)
+                    method, target = request[:2]
+                    if method not in ('GET', 'HEAD'):
+                        raise HTTPError(405)
+                    url = urlsplit(target)
+                    content_type, body, encoded = await self.route(
+                        unquote(url.path), parse_qs(url.query),
+                        'gzip' in headers.get('accept-encoding', ''))
+                except HTTPError as e:
+                    status = e.status
+                    content_type = 'text/plain; charset=utf-8'
+                    body = str(e).encode('utf-8')
+                except Exception as e:
+                    status = 500
+                    content_type = 'text/plain; charset=utf-8'
+                    body = repr(e).encode('utf-8')
+
+                response_headers = [
+                    'HTTP/1.1 %d %s' % (status, STATUS_REASONS[status]),
+                    'Content-Type: %s' % content_type,
+                    'Content-Length: %d' % len(body),
+                    'Vary: Accept-Encoding',
+                    'Connection: %s' % ('keep-alive' if keep_alive
+                                        else 'close'),
+                ]
+                if encoded:
+                    response_headers.append('Content-Encoding: gzip')
+                writer.write(
+                    ('\r\n'.join(response_headers) + '\r\n\r\n').encode(
+                        'latin-1'))
+                if request[0] != 'HEAD':
+                    writer.write(body)
+                await writer.drain()
+                if not keep_alive:
+                    return
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=DEFAULT_PORT):
+        '''Start serving; returns the `asyncio.Server`.'''
+        return await asyncio.start_server(
+            self.handle, host, port, limit=MAX_HEADER_BYTES)
+
+
+async def serve(port=DEFAULT_PORT):
+    server = await MapServer(load_columns()).start(port=port)
+    print('Serving on http://localhost:%d/' % port)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    asyncio.run(serve(int(sys.argv[1]) if len(sys.argv) > 1
+                      else DEFAULT_PORT))
@@ -0,0 +1,35 @@
+import unittest
+
+import benchmark
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_run_benchmarks(self):
+        results = benchmark.run_benchmarks(
+            200, ['progress_log_writes', 'to_points'], repeat=1)
+        self.assertEqual(results['size'], 200)
+        self.assertEqual(
+            sorted(results['results']), ['progress_log_writes', 'to_points'])
+        for result in results['results'].values():
+            self.assertGreater(result['seconds'], 0)
+            self.assertGreater(result['peak_bytes'], 0)
+
+    def test_compare(self):
+        def results(seconds, peak_bytes):
+            return {'size': 10, 'results': {
+                'a': {'seconds': seconds, 'peak_bytes': peak_bytes}}}
+        baseline = results(1.0, 1000)
+        self.assertEqual(benchmark.compare(baseline, results(1.1, 1000)), [])
+        self.assertEqual(
+            len(benchmark.compare(baseline, results(1.5, 1000))), 1)
+        self.assertEqual(
+            len(benchmark.compare(baseline, results(1.5, 2000))), 2)
+        self.assertEqual(
+            benchmark.compare(baseline, results(1.5, 1000), threshold=1), [])
+        with self.assertRaises(ValueError):
+            benchmark.compare(baseline, dict(results(1, 1), size=20))
+
+
+if __name__ == '__main__':
+    unittest.main()
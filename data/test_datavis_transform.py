@@ -0,0 +1,329 @@
+import json
+import os
+import random
+import tempfile
+import unittest
+
+import numpy as np
+
+import datavis_transform
+from yelp import density, pointfile
+from yelp.columnar import export_columns, load_columns
+from yelp.settings import SEARCH_BOUNDS
+from yelp.snapshots import SnapshotStore
+from yelp.store import BusinessStore
+
+
+CITIES = ['San Francisco', 'San  francisco', 'Oakland', 'Daly City']
+
+
+def make_business(i, rng):
+    biz = {
+        'id': 'biz-%05d' % i,
+        'coordinates': {
+            'latitude': rng.uniform(37.7, 37.82),
+            'longitude': rng.uniform(-122.52, -122.35),
+        },
+        'rating': rng.choice([1.0, 2.5, 3.0, 4.5, 5.0]),
+        'review_count': rng.randint(0, 5000),
+        'location': {'city': rng.choice(CITIES)},
+        'categories': [{'alias': rng.choice(['food', 'bars', 'cafes'])}] + (
+            [{'alias': 'coffee'}] if i % 3 == 0 else []),
+    }
+    if rng.random() < 0.7:
+        biz['price'] = '$' * rng.randint(1, 4)
+    return biz
+
+
+def fail(value):
+    raise ValueError(value)
+
+
+class TestDatavisTransform(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        rng = random.Random(0)
+        cls.dir = tempfile.TemporaryDirectory()
+        cls.store_path = os.path.join(cls.dir.name, 'businesses.sqlite3')
+        cls.columns_path = os.path.join(cls.dir.name, 'columns')
+        store = BusinessStore(cls.store_path)
+        store.upsert([make_business(i, rng) for i in range(500)])
+        export_columns(store.items(), cls.columns_path)
+        store.close()
+        cls.columns = load_columns(cls.columns_path)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.dir.cleanup()
+
+    def to_points(self, *args, **kwargs):
+        return datavis_transform.to_points(
+            *args, path=self.store_path, **kwargs)
+
+    def test_vectorized_matches(self):
+        to_points_vectorized = datavis_transform.to_points_vectorized
+        self.assertEqual(
+            to_points_vectorized('price', columns=self.columns),
+            self.to_points('price', len))
+        self.assertEqual(
+            to_points_vectorized(
+                'rating', restrict_to_city='San Francisco',
+                columns=self.columns),
+            self.to_points('rating', restrict_to_city='San Francisco'))
+        self.assertEqual(
+            to_points_vectorized(
+                'review_count', restrict_to_city='oakland',
+                columns=self.columns),
+            self.to_points('review_count', restrict_to_city='oakland'))
+        # Null prices are kept as None
+        self.assertEqual(
+            to_points_vectorized(
+                'price', ignore_nulls=True, columns=self.columns),
+            self.to_points(
+                'price', lambda p: len(p) if p else None, ignore_nulls=True))
+
+    def test_vectorized_bbox(self):
+        bbox = (37.75, -122.45, 37.8, -122.4)
+        points = datavis_transform.to_points_vectorized(
+            'rating', bbox=bbox, columns=self.columns)
+        self.assertEqual(points, [
+            p for p in self.to_points('rating')
+            if bbox[0] <= p[0] <= bbox[2] and bbox[1] <= p[1] <= bbox[3]
+        ])
+
+    def test_bbox(self):
+        bbox = (37.75, -122.45, 37.8, -122.4)
+        points = self.to_points('rating', bbox=bbox, columns=self.columns)
+        self.assertTrue(points)
+        self.assertEqual(points, [
+            p for p in self.to_points('rating')
+            if bbox[0] <= p[0] <= bbox[2] and bbox[1] <= p[1] <= bbox[3]
+        ])
+
+    def test_categories(self):
+        def expected(*alias_sets):
+            # `alias_sets` per category: it and the categories below it
+            # that businesses here have.
+            return [
+                [b['coordinates']['latitude'], b['coordinates']['longitude'],
+                 b['rating']]
+                for id, b in datavis_transform.iter_business_data(
+                    self.store_path)
+                if all(set(c['alias'] for c in b['categories']) & aliases
+                       for aliases in alias_sets)
+            ]
+        food = {'food', 'coffee'}
+        # Neither has businesses of its own, only below it.
+        nightlife = {'bars'}
+        restaurants = {'cafes'}
+
+        points = self.to_points(
+            'rating', categories='food', columns=self.columns)
+        self.assertTrue(points)
+        self.assertEqual(points, expected(food))
+        self.assertEqual(
+            self.to_points('rating', categories='nightlife',
+                           columns=self.columns),
+            expected(nightlife))
+        self.assertEqual(
+            self.to_points('rating', categories=['nightlife', 'restaurants'],
+                           columns=self.columns),
+            expected(nightlife | restaurants))
+        both = self.to_points(
+            'rating', categories=['food', 'restaurants'],
+            match_all_categories=True, columns=self.columns)
+        self.assertTrue(both)
+        self.assertEqual(both, expected(food, restaurants))
+        self.assertEqual(
+            self.to_points('rating', categories='no-such-category',
+                           columns=self.columns), [])
+
+        # Vectorized, and within a bbox
+        self.assertEqual(
+            datavis_transform.to_points_vectorized(
+                'rating', categories='food', columns=self.columns),
+            expected(food))
+        bbox = (37.75, -122.45, 37.8, -122.4)
+        self.assertEqual(
+            datavis_transform.to_points_vectorized(
+                'rating', bbox=bbox, categories='food', columns=self.columns),
+            [p for p in expected(food)
+             if bbox[0] <= p[0] <= bbox[2] and bbox[1] <= p[1] <= bbox[3]])
+
+        # Businesses not looked up in the index are filtered as they're read
+        changes = list(datavis_transform.iter_business_data(self.store_path))
+        self.assertEqual(
+            datavis_transform.to_points(
+                'rating', categories=['food', 'restaurants'],
+                match_all_categories=True, businesses=changes),
+            both)
+
+    def test_legacy_json(self):
+        json_path = os.path.join(self.dir.name, 'businesses_search.json')
+        with open(json_path, 'w') as f:
+            f.write(json.dumps(
+                dict(datavis_transform.iter_business_data(self.store_path)),
+                indent=4))
+        self.assertEqual(
+            datavis_transform.to_points('rating', path=json_path),
+            self.to_points('rating'))
+
+    def test_write_layers(self):
+        Layer = datavis_transform.Layer
+        expected = {
+            'price.json': self.to_points(
+                'price', len, restrict_to_city='San Francisco'),
+            'rating.json': self.to_points('rating'),
+            'review_count.json': self.to_points(
+                'review_count', restrict_to_city='Oakland'),
+        }
+        for processes in [1, 2]:
+            with tempfile.TemporaryDirectory() as dir:
+                layers = [
+                    Layer(os.path.join(dir, 'price.json'), 'price',
+                          datavis_transform.price_level,
+                          restrict_to_city='San Francisco'),
+                    Layer(os.path.join(dir, 'rating.json'), 'rating'),
+                    Layer(os.path.join(dir, 'review_count.json'),
+                          'review_count', restrict_to_city='Oakland'),
+                ]
+                datavis_transform.write_layers(
+                    layers, path=self.store_path, processes=processes,
+                    chunk_size=7)
+                for fname, points in expected.items():
+                    with open(os.path.join(dir, fname), 'r') as f:
+                        self.assertEqual(f.read(), json.dumps(points))
+
+    def test_write_binary_layers(self):
+        points = self.to_points('rating')
+        with tempfile.TemporaryDirectory() as dir:
+            datavis_transform.write_layers(
+                [datavis_transform.Layer(
+                    os.path.join(dir, 'rating.json'), 'rating')],
+                path=self.store_path, binary=True)
+            with open(os.path.join(dir, 'rating.bin'), 'rb') as f:
+                lat, lng, values = pointfile.decode_points(f.read())
+        decoded = sorted(zip(lat, lng, values))
+        self.assertEqual(len(decoded), len(points))
+        for (dlat, dlng, dvalue), (plat, plng, pvalue) in zip(
+                decoded, sorted(points)):
+            self.assertAlmostEqual(dlat, plat, places=6)
+            self.assertAlmostEqual(dlng, plng, places=6)
+            self.assertEqual(dvalue, pvalue)
+
+    def test_write_tile_pyramid(self):
+        layer = datavis_transform.Layer(
+            'price.json', 'price', datavis_transform.price_level)
+        with tempfile.TemporaryDirectory() as dir:
+            datavis_transform.write_tile_pyramid(
+                [layer], root=dir, min_zoom=11, max_zoom=13,
+                path=self.store_path)
+            with open(os.path.join(dir, 'index.json'), 'r') as f:
+                self.assertEqual(json.loads(f.read())['layers'], ['price'])
+            # Max zoom tiles match the layer's points
+            max_zoom_dir = os.path.join(dir, 'price', '13')
+            points = []
+            for x in os.listdir(max_zoom_dir):
+                for y in os.listdir(os.path.join(max_zoom_dir, x)):
+                    with open(os.path.join(max_zoom_dir, x, y), 'r') as f:
+                        points.extend(json.loads(f.read()))
+        self.assertEqual(
+            sorted(points), sorted(self.to_points('price', len)))
+
+    def test_failed_write_keeps_old_files(self):
+        with tempfile.TemporaryDirectory() as dir:
+            layer = datavis_transform.Layer(
+                os.path.join(dir, 'rating.json'), 'rating')
+            datavis_transform.write_layers([layer], path=self.store_path)
+            datavis_transform.write_tile_pyramid(
+                [layer], root=dir, min_zoom=11, max_zoom=11,
+                path=self.store_path)
+            tiles_dir = os.path.join(dir, 'rating')
+            tiles_before = sorted(os.walk(tiles_dir))
+
+            layer.value_transform_fn = fail
+            with self.assertRaises(ValueError):
+                datavis_transform.write_layers([layer], path=self.store_path)
+            with self.assertRaises(ValueError):
+                datavis_transform.write_tile_pyramid(
+                    [layer], root=dir, min_zoom=11, max_zoom=11,
+                    path=self.store_path)
+            with open(os.path.join(dir, 'rating.json'), 'r') as f:
+                self.assertEqual(
+                    f.read(), json.dumps(self.to_points('rating')))
+            self.assertEqual(sorted(os.walk(tiles_dir)), tiles_before)
+
+    def test_density_points(self):
+        points = datavis_transform.density_points(
+            'rating', restrict_to_city='San Francisco', columns=self.columns,
+            cell_meters=200, bandwidth_meters=1000)
+        self.assertTrue(len(points))
+        self.assertTrue(np.all((points.value >= 1) & (points.value <= 5)))
+        # The kernel-weighted mean is near the mean of the ratings.
+        ratings = self.to_points('rating', restrict_to_city='San Francisco')
+        mean = np.mean([value for lat, lng, value in ratings])
+        self.assertAlmostEqual(np.median(points.value), mean, delta=0.5)
+        # The grid covers the city's search bounds, give or take a cell,
+        # rather than reaching a kernel's width past the businesses
+        south, west, north, east = SEARCH_BOUNDS
+        cell = 2 * 200 / density.METERS_PER_DEGREE
+        self.assertTrue(np.all(
+            (points.lat >= south) & (points.lat <= north + cell)))
+        self.assertTrue(np.all(
+            (points.lng >= west) & (points.lng <= east + cell)))
+
+        with tempfile.TemporaryDirectory() as dir:
+            layer = datavis_transform.Layer(
+                os.path.join(dir, 'rating.json'), 'rating',
+                restrict_to_city='San Francisco')
+            datavis_transform.write_density_layers(
+                [layer], columns=self.columns, cell_meters=200,
+                bandwidth_meters=1000, binary=True)
+            with open(os.path.join(dir, 'rating.json'), 'r') as f:
+                self.assertEqual(json.loads(f.read()), points.tolist())
+            self.assertTrue(os.path.exists(os.path.join(dir, 'rating.bin')))
+
+    def test_write_change_layers(self):
+        Layer = datavis_transform.Layer
+        rng = random.Random(1)
+        with tempfile.TemporaryDirectory() as dir:
+            store = BusinessStore(os.path.join(dir, 'store.sqlite3'))
+            snapshots = SnapshotStore(os.path.join(dir, 'snapshots.sqlite3'))
+            businesses = [make_business(i, rng) for i in range(20)]
+            store.upsert(businesses)
+            old = snapshots.take(store)
+            opened = make_business(20, rng)
+            rerated = dict(businesses[5], rating=businesses[5]['rating'] + 1)
+            store.upsert([opened, rerated])
+            store.delete([businesses[9]['id']])
+            new = snapshots.take(store)
+            store.close()
+            snapshots.close()
+
+            layers = [
+                Layer(os.path.join(dir, 'opened.json'), 'opened'),
+                Layer(os.path.join(dir, 'closed.json'), 'closed'),
+                Layer(os.path.join(dir, 'rating_change.json'),
+                      'rating_change'),
+            ]
+            datavis_transform.write_change_layers(
+                old, new, layers,
+                path=os.path.join(dir, 'snapshots.sqlite3'))
+
+            def read_points(fname):
+                with open(os.path.join(dir, fname), 'r') as f:
+                    return json.loads(f.read())
+
+            def point(biz, value):
+                return [biz['coordinates']['latitude'],
+                        biz['coordinates']['longitude'], value]
+            self.assertEqual(read_points('opened.json'), [point(opened, 1)])
+            self.assertEqual(
+                read_points('closed.json'), [point(businesses[9], 1)])
+            self.assertEqual(
+                read_points('rating_change.json'), [point(rerated, 1.0)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import json
+import os
+import random
+import tempfile
+import unittest
+
+import datavis_transform
+from incremental_transform import IncrementalTransform
+from test_datavis_transform import make_business
+from yelp.store import BusinessStore
+
+
+def read_tiles(root):
+    '''Tile contents by path relative to `root`.'''
+    contents = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for fname in filenames:
+            path = os.path.join(dirpath, fname)
+            with open(path, 'r') as f:
+                contents[os.path.relpath(path, root)] = json.loads(f.read())
+    return contents
+
+
+class TestIncrementalTransform(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = random.Random(0)
+        self.dir = tempfile.TemporaryDirectory()
+        self.store_path = os.path.join(self.dir.name, 'businesses.sqlite3')
+        self.businesses = [make_business(i, self.rng) for i in range(300)]
+        store = BusinessStore(self.store_path)
+        store.upsert(self.businesses)
+        store.close()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def layers(self, name):
+        dir = os.path.join(self.dir.name, name)
+        os.makedirs(dir, exist_ok=True)
+        Layer = datavis_transform.Layer
+        return [
+            Layer(os.path.join(dir, 'price.json'), 'price',
+                  datavis_transform.price_level,
+                  restrict_to_city='San Francisco'),
+            Layer(os.path.join(dir, 'rating.json'), 'rating'),
+        ]
+
+    def transform(self, **kwargs):
+        return IncrementalTransform(
+            self.layers('incremental'),
+            state_path=os.path.join(self.dir.name, 'state.sqlite3'),
+            store_path=self.store_path,
+            tiles_root=os.path.join(self.dir.name, 'incremental_tiles'),
+            min_zoom=11, max_zoom=13, **kwargs)
+
+    def assertMatchesFullRebuild(self):
+        layers = self.layers('full')
+        root = os.path.join(self.dir.name, 'full_tiles')
+        datavis_transform.write_layers(layers, path=self.store_path)
+        datavis_transform.write_tile_pyramid(
+            layers, root=root, min_zoom=11, max_zoom=13,
+            path=self.store_path)
+
+        for layer in layers:
+            fname = os.path.basename(layer.output_path)
+            with open(layer.output_path, 'r') as f:
+                expected = f.read()
+            with open(os.path.join(self.dir.name, 'incremental', fname)) as f:
+                self.assertEqual(f.read(), expected)
+
+        expected = read_tiles(root)
+        actual = read_tiles(os.path.join(self.dir.name, 'incremental_tiles'))
+        self.assertEqual(sorted(actual), sorted(expected))
+        for path, contents in expected.items():
+            self.assertEqual(len(actual[path]), len(contents))
+            for actual_row, row in zip(actual[path], contents):
+                for a, b in zip(actual_row, row):
+                    self.assertAlmostEqual(a, b, places=6)
+
+    def test_incremental(self):
+        transform = self.transform()
+        self.assertEqual(transform.run()[0], 300)
+        self.assertMatchesFullRebuild()
+        # Nothing changed
+        self.assertEqual(transform.run(), (0, 0))
+
+        store = BusinessStore(self.store_path)
+        moved = self.businesses[0]
+        moved['coordinates']['latitude'] += 0.01
+        store.upsert([
+            moved,
+            dict(self.businesses[1], rating=1.0),
+            self.businesses[2],  # Unchanged
+            make_business(1000, self.rng),
+        ])
+        store.delete([self.businesses[3]['id']])
+        store.close()
+
+        self.assertEqual(transform.run()[0], 4)
+        self.assertMatchesFullRebuild()
+        transform.close()
+
+    def test_tiles_only(self):
+        transform = self.transform(layer_files=False, binary=True)
+        transform.run()
+        transform.close()
+        self.assertEqual(
+            os.listdir(os.path.join(self.dir.name, 'incremental')), [])
+        self.assertTrue(read_tiles(
+            os.path.join(self.dir.name, 'incremental_tiles')))
+
+    def test_layer_files_swapped_in(self):
+        transform = self.transform(binary=True)
+        transform.run()
+        transform.close()
+        names = os.listdir(os.path.join(self.dir.name, 'incremental'))
+        self.assertIn('rating.json', names)
+        self.assertIn('rating.bin', names)
+        # Nothing is left behind alongside
+        self.assertFalse([n for n in names if n.endswith('.tmp')])
+
+    def test_layer_change_rebuilds(self):
+        transform = self.transform()
+        transform.run()
+        transform.close()
+
+        transform = self.transform()
+        transform.layers = transform.layers[1:]
+        self.assertEqual(transform.run()[0], 300)
+        transform.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
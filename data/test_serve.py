@@ -0,0 +1,207 @@
+import asyncio
+import gzip
+import http.client
+import json
+import os
+import random
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+
+import datavis_transform
+import serve
+from yelp import tiles
+from yelp.columnar import export_columns, load_columns
+from yelp.store import BusinessStore
+from test_datavis_transform import make_business
+
+
+class TestServe(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        rng = random.Random(0)
+        cls.dir = tempfile.TemporaryDirectory()
+        cls.store_path = os.path.join(cls.dir.name, 'businesses.sqlite3')
+        store = BusinessStore(cls.store_path)
+        store.upsert([make_business(i, rng) for i in range(500)])
+        export_columns(store.items(), os.path.join(cls.dir.name, 'columns'))
+        store.close()
+        cls.columns = load_columns(os.path.join(cls.dir.name, 'columns'))
+        with open(os.path.join(cls.dir.name, 'index.html'), 'w') as f:
+            f.write('<html>%s</html>' % ('map ' * 100))
+        for path in ['lib/leaflet.js', 'data/yelp_rating_points.json',
+                     'data/serve.py', 'data/yelp/businesses.sqlite3',
+                     'data/yelp/archive/0.jsonl']:
+            path = os.path.join(cls.dir.name, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write('[]')
+
+        cls.map_server = serve.MapServer(
+            cls.columns, root=cls.dir.name, min_zoom=11, max_zoom=13,
+            cache_size=4)
+        cls.loop = asyncio.new_event_loop()
+        cls.server = cls.loop.run_until_complete(
+            cls.map_server.start(port=0))
+        cls.port = cls.server.sockets[0].getsockname()[1]
+        cls.thread = threading.Thread(target=cls.loop.run_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.loop.call_soon_threadsafe(cls.loop.stop)
+        cls.thread.join()
+        cls.server.close()
+        cls.loop.run_until_complete(cls.server.wait_closed())
+        cls.loop.close()
+        cls.dir.cleanup()
+
+    def get(self, path, gzip_ok=True, conn=None):
+        '''Request `path`, on a new connection unless given `conn`.'''
+        own_conn = conn is None
+        if own_conn:
+            conn = http.client.HTTPConnection('127.0.0.1', self.port)
+        headers = {'Accept-Encoding': 'gzip'} if gzip_ok else {}
+        conn.request('GET', path, headers=headers)
+        resp = conn.getresponse()
+        body = resp.read()
+        if own_conn:
+            conn.close()
+        if resp.getheader('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return resp, body
+
+    def get_json(self, path):
+        resp, body = self.get(path)
+        self.assertEqual(resp.status, 200, body)
+        return json.loads(body)
+
+    def test_tiles_match_pyramid(self):
+        index = self.get_json('/api/tiles/index.json')
+        self.assertEqual(index['layers'], [
+            'yelp_price_points', 'yelp_rating_points',
+            'yelp_review_count_points'])
+
+        pyramid = tiles.TilePyramid(11, 13)
+        for point in datavis_transform.to_points(
+                'rating', restrict_to_city='San Francisco',
+                path=self.store_path):
+            pyramid.add(point)
+        # All on one kept alive connection
+        conn = http.client.HTTPConnection('127.0.0.1', self.port)
+        n_tiles = 0
+        for (z, x, y), contents in pyramid.tiles():
+            n_tiles += 1
+            resp, body = self.get(
+                '/api/tiles/yelp_rating_points/%d/%d/%d.json' % (z, x, y),
+                conn=conn)
+            served = json.loads(body)
+            if z == 13:
+                self.assertEqual(sorted(served), sorted(contents))
+                continue
+            self.assertEqual(len(served), len(contents))
+            for a, b in zip(served, contents):
+                np.testing.assert_allclose(a, b)
+        conn.close()
+        self.assertGreater(n_tiles, 10)
+
+    def test_tile_cache(self):
+        path = '/api/tiles/yelp_price_points/11/327/791.json'
+        _, first = self.get(path)
+        hits = self.map_server.tile_cache.hits
+        resp, second = self.get(path, gzip_ok=False)
+        self.assertIsNone(resp.getheader('Content-Encoding'))
+        self.assertEqual(first, second)
+        self.assertEqual(self.map_server.tile_cache.hits, hits + 1)
+        self.assertLessEqual(len(self.map_server.tile_cache), 4)
+
+    def test_points(self):
+        bbox = (37.72, -122.5, 37.8, -122.4)
+        raw = self.get_json(
+            '/api/points?layer=yelp_rating_points&bbox=%s,%s,%s,%s&zoom=13'
+            % bbox)
+        expected = datavis_transform.to_points(
+            'rating', restrict_to_city='San Francisco', bbox=bbox,
+            columns=self.columns, path=self.store_path)
+        self.assertEqual(sorted(raw), sorted(expected))
+        binned = self.get_json(
+            '/api/points?layer=yelp_rating_points&bbox=%s,%s,%s,%s&zoom=11'
+            % bbox)
+        self.assertEqual(sum(b[3] for b in binned), len(expected))
+        self.assertLess(len(binned), len(expected))
+
+    def test_points_bbox_limit(self):
+        world = '/api/points?layer=yelp_rating_points&bbox=-80,-180,80,180'
+        for zoom in [13, 11, -1]:
+            resp, body = self.get('%s&zoom=%d' % (world, zoom))
+            self.assertEqual(resp.status, 400, zoom)
+        self.assertEqual(self.get_json(world + '&zoom=1'), self.get_json(
+            '/api/points?layer=yelp_rating_points&bbox=37,-123,38,-122'
+            '&zoom=1'))
+
+    def test_histogram(self):
+        hist = self.get_json(
+            '/api/histogram?layer=yelp_review_count_points&bins=3')
+        values = [p[2] for p in datavis_transform.to_points(
+            'review_count', restrict_to_city='San Francisco',
+            path=self.store_path)]
+        self.assertEqual(hist['count'], len(values))
+        self.assertEqual(len(hist['bins']), 3)
+        self.assertEqual(
+            sum(b['count'] for b in hist['bins']), len(values))
+        linear = self.get_json(
+            '/api/histogram?layer=yelp_rating_points&scale=linear'
+            '&bbox=37.7,-122.6,37.9,-122.3')
+        self.assertEqual(
+            sum(b['count'] for b in linear['bins']), linear['count'])
+
+    def test_static_and_errors(self):
+        resp, body = self.get('/')
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(resp.getheader('Content-Encoding'), 'gzip')
+        self.assertTrue(body.startswith(b'<html>'))
+        for path, status in [
+            ('/lib/leaflet.js', 200),
+            ('/data/yelp_rating_points.json', 200),
+            ('/data/serve.py', 404),
+            ('/data/yelp/businesses.sqlite3', 404),
+            ('/data/yelp/archive/0.jsonl', 404),
+            ('/data/yelp/../yelp/businesses.sqlite3', 404),
+            ('/../etc/passwd', 404),
+            ('/nope.js', 404),
+            ('/api/tiles/nope/11/0/0.json', 404),
+            ('/api/tiles/yelp_rating_points/3/0/0.json', 404),
+            ('/api/points?layer=yelp_rating_points', 400),
+            ('/api/histogram?layer=yelp_rating_points&scale=cubic', 400),
+            ('/api/histogram?layer=yelp_rating_points&bins=1000000000', 400),
+            ('/api/histogram?layer=yelp_rating_points&bins=0', 400),
+        ]:
+            resp, body = self.get(path)
+            self.assertEqual(resp.status, status, path)
+
+    def test_layers(self):
+        self.assertEqual(
+            [layer.name for layer in serve.LAYERS],
+            [layer.name for layer in datavis_transform.LAYERS])
+        price = self.map_server.get_layer('yelp_price_points')
+        self.assertIsNone(price.value_transform_fn)
+
+    def test_histogram_function(self):
+        self.assertEqual(serve.histogram(np.array([])), [])
+        self.assertEqual(
+            serve.histogram(np.array([1.0, 10.0, 100.0, np.nan]), 2),
+            [{'x0': 1.0, 'x1': 10.0, 'count': 1},
+             {'x0': 10.0, 'x1': 100.0, 'count': 2}])
+        # Values below 1 count in the first log bin
+        self.assertEqual(
+            serve.histogram(np.array([0, 0, 1, 10, 100]), 2),
+            [{'x0': 1.0, 'x1': 10.0, 'count': 3},
+             {'x0': 10.0, 'x1': 100.0, 'count': 2}])
+
+
+if __name__ == '__main__':
+    unittest.main()
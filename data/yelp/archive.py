@@ -0,0 +1,208 @@
+'''
+Append-only archive of businesses exactly as the Yelp API returned them, for
+reprocessing and audits, while the business store only keeps the trimmed
+"hot" records that the transforms read (see `store.trim_business`).
+
+Businesses are archived in compressed frames, one per page of search results,
+which can be read back individually without decompressing the whole archive.
+Archive format, at directory `path`:
+    frames.bin: frames, each a `FRAME_HEADER` (magic, compressed size, record
+        count) followed by zlib-compressed, newline-separated JSON records
+    index.sqlite3:
+        frames: frame number, byte offset in `frames.bin`, compressed size,
+            record count, and when the frame was written
+        records: business ID -> frame and position of its latest version
+
+Every version of a business stays in the archive; the index points at the
+latest. Appends are serialized across processes with `persist.file_lock`. A
+frame written by a writer that crashed before indexing it is never read.
+
+To move the full businesses of an existing store into the archive, and trim
+the store:
+    python -m yelp.archive
+'''
+
+import json
+import logging
+import os
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+
+from . import persist
+from .settings import BUSINESS_STORE_PATH, RAW_ARCHIVE_PATH
+from .store import (
+    SQLITE_MAX_VARIABLES, BusinessStore, fingerprint, trim_business)
+
+logger = logging.getLogger(__name__)
+
+FRAME_MAGIC = b'CPF1'
+FRAME_HEADER = struct.Struct('<4sII')
+
+COMPRESSION_LEVEL = 6
+
+
+class ArchiveError(Exception):
+    pass
+
+
+class ResponseArchive():
+
+    def __init__(self, path, level=COMPRESSION_LEVEL):
+        self.path = path
+        self.level = level
+        os.makedirs(path, exist_ok=True)
+        self.frames_path = os.path.join(path, 'frames.bin')
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            os.path.join(path, 'index.sqlite3'), timeout=60,
+            check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS frames ('
+                'frame INTEGER PRIMARY KEY, offset INTEGER NOT NULL, '
+                'size INTEGER NOT NULL, count INTEGER NOT NULL, '
+                'written REAL NOT NULL)')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS records ('
+                'id TEXT PRIMARY KEY, frame INTEGER NOT NULL, '
+                'position INTEGER NOT NULL)')
+
+    def close(self):
+        self.conn.close()
+
+    # Read-only
+
+    def __len__(self):
+        '''Number of distinct businesses archived.'''
+        return self.conn.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+
+    def __contains__(self, id):
+        return self.conn.execute(
+            'SELECT 1 FROM records WHERE id = ?', (id,)).fetchone() is not None
+
+    def frames(self):
+        '''Frame numbers, in the order they were written.'''
+        return [row[0] for row in self.conn.execute(
+            'SELECT frame FROM frames ORDER BY frame')]
+
+    def read_frame(self, frame):
+        '''The list of businesses in a frame.'''
+        row = self.conn.execute(
+            'SELECT offset, size, count FROM frames WHERE frame = ?',
+            (frame,)).fetchone()
+        if row is None:
+            raise KeyError(frame)
+        offset, size, count = row
+        with open(self.frames_path, 'rb') as f:
+            f.seek(offset)
+            header = f.read(FRAME_HEADER.size)
+            payload = f.read(size)
+        if len(header) < FRAME_HEADER.size or \
+                FRAME_HEADER.unpack(header) != (FRAME_MAGIC, size, count) or \
+                len(payload) != size:
+            raise ArchiveError('Corrupt frame %d at offset %d of %s' % (
+                frame, offset, self.frames_path))
+        lines = zlib.decompress(payload).decode('utf-8').split('\n')
+        return [json.loads(line) for line in lines]
+
+    def get(self, id):
+        '''The latest archived version of a business, or None.'''
+        row = self.conn.execute(
+            'SELECT frame, position FROM records WHERE id = ?',
+            (id,)).fetchone()
+        if row is None:
+            return None
+        return self.read_frame(row[0])[row[1]]
+
+    def get_many(self, ids):
+        '''
+        Yield `(id, business)` for the latest versions of the given IDs that
+        we have, decompressing each frame once.
+        '''
+        by_frame = {}
+        ids = list(ids)
+        for i in range(0, len(ids), SQLITE_MAX_VARIABLES):
+            chunk = ids[i:i + SQLITE_MAX_VARIABLES]
+            cursor = self.conn.execute(
+                'SELECT id, frame, position FROM records WHERE id IN (%s)' %
+                ','.join('?' * len(chunk)),
+                chunk)
+            for id, frame, position in cursor:
+                by_frame.setdefault(frame, []).append((id, position))
+        for frame in sorted(by_frame):
+            records = self.read_frame(frame)
+            for id, position in by_frame[frame]:
+                yield id, records[position]
+
+    def __iter__(self):
+        '''Yield every archived version of every business, oldest first.'''
+        for frame in self.frames():
+            yield from self.read_frame(frame)
+
+    # Write
+
+    def append(self, businesses):
+        '''Archive businesses as one frame. Returns its frame number.'''
+        businesses = list(businesses)
+        if not businesses:
+            return None
+        payload = zlib.compress('\n'.join(
+            json.dumps(biz, separators=(',', ':')) for biz in businesses
+        ).encode('utf-8'), self.level)
+        with self.lock, persist.file_lock(self.frames_path):
+            with open(self.frames_path, 'ab') as f:
+                offset = f.seek(0, os.SEEK_END)
+                f.write(FRAME_HEADER.pack(
+                    FRAME_MAGIC, len(payload), len(businesses)))
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            with self.conn:
+                frame = self.conn.execute(
+                    'INSERT INTO frames (offset, size, count, written) '
+                    'VALUES (?, ?, ?, ?)',
+                    (offset, len(payload), len(businesses), time.time())
+                ).lastrowid
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO records (id, frame, position) '
+                    'VALUES (?, ?, ?)',
+                    [(biz['id'], frame, i)
+                     for i, biz in enumerate(businesses)])
+        return frame
+
+
+def archive_store(store, archive, batch_size=1000):
+    '''
+    Move the full businesses of a store written before it was trimmed into
+    the archive, leaving trimmed records in the store, and compact it.
+    Returns the number of businesses archived.
+    '''
+    archived = 0
+    # Read by ID, rather than hold a cursor over the rows being rewritten.
+    ids = list(store.ids())
+    for i in range(0, len(ids), batch_size):
+        batch = [
+            biz for id, biz in store.get_many(ids[i:i + batch_size])
+            if trim_business(biz) != biz
+        ]
+        if not batch:
+            continue
+        archive.append(batch)
+        store.upsert([trim_business(biz) for biz in batch],
+                     fingerprints=[fingerprint(biz) for biz in batch])
+        archived += len(batch)
+    store.vacuum()
+    return archived
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    store = BusinessStore(BUSINESS_STORE_PATH)
+    archive = ResponseArchive(RAW_ARCHIVE_PATH)
+    logger.info('Archived %d businesses from %s into %s' % (
+        archive_store(store, archive), BUSINESS_STORE_PATH, RAW_ARCHIVE_PATH))
+    archive.close()
+    store.close()
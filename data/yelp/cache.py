@@ -0,0 +1,120 @@
+'''
+On-disk record/replay cache of API responses, so that re-running a crawl
+doesn't spend API quota on pages we've already seen.
+
+Responses are stored as JSON files named by a hash of the normalized request
+(URL + params), and evicted by age (`ttl`, in seconds) and total size
+(`max_bytes`, oldest first).
+
+Modes:
+    record: serve fresh cached responses, fetch and store misses
+    replay: fully offline; serve cached responses, raise `CacheMiss` on miss
+    refresh: always fetch, and overwrite the cache
+'''
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from . import persist
+
+logger = logging.getLogger(__name__)
+
+
+class CacheMode:
+    RECORD = 'record'
+    REPLAY = 'replay'
+    REFRESH = 'refresh'
+
+
+class CacheMiss(Exception):
+    pass
+
+
+def cache_key(url, params):
+    '''Hash of a request, insensitive to param order and value types.'''
+    normalized = json.dumps(
+        [url, sorted((str(k), str(v)) for k, v in params.items())])
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+class ResponseCache():
+
+    def __init__(self, path, mode=CacheMode.RECORD, ttl=None, max_bytes=None):
+        if mode not in (CacheMode.RECORD, CacheMode.REPLAY, CacheMode.REFRESH):
+            raise ValueError('Unknown cache mode: %s' % mode)
+        self.path = path
+        self.mode = mode
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self.total_bytes = sum(size for _, _, size in self._entries())
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[:2], key + '.json')
+
+    def _entries(self):
+        '''Yield `(path, mtime, size)` for every cached response.'''
+        for dirpath, _, fnames in os.walk(self.path):
+            for fname in fnames:
+                path = os.path.join(dirpath, fname)
+                stat = os.stat(path)
+                yield path, stat.st_mtime, stat.st_size
+
+    def get(self, url, params):
+        '''Return a cached response, or None if missing or expired.'''
+        path = self._entry_path(cache_key(url, params))
+        try:
+            if self.ttl is not None and \
+                    time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+            with open(path, 'r') as f:
+                return json.loads(f.read())
+        except FileNotFoundError:
+            return None
+
+    def put(self, url, params, response_json):
+        path = self._entry_path(cache_key(url, params))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self.lock:
+            try:
+                self.total_bytes -= os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+            persist.write_json_file(path, response_json, pretty_print=False)
+            self.total_bytes += os.path.getsize(path)
+            if self.max_bytes is not None and \
+                    self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        '''Delete oldest responses until we are under `max_bytes`.'''
+        for path, _, size in sorted(self._entries(), key=lambda e: e[1]):
+            if self.total_bytes <= self.max_bytes:
+                break
+            os.remove(path)
+            self.total_bytes -= size
+            logger.debug('Evicted cached response %s' % path)
+
+    def fetch(self, url, params, fetch_fn):
+        '''
+        Return the response for a request according to the cache mode,
+        calling `fetch_fn(params)` for the decoded response on a miss.
+        Only successful responses are cached.
+        '''
+        if self.mode != CacheMode.REFRESH:
+            response_json = self.get(url, params)
+            if response_json is not None:
+                return response_json
+            if self.mode == CacheMode.REPLAY:
+                raise CacheMiss('No cached response for %s %s' % (
+                    url, json.dumps(params, sort_keys=True)))
+
+        response_json = fetch_fn(params)
+        if response_json.get('error') is None:
+            self.put(url, params, response_json)
+        return response_json
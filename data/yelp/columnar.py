@@ -0,0 +1,275 @@
+'''
+Columnar export of the business store, for transforms that only need a few
+fields of every business.
+
+Each column is a `.npy` file in the dataset directory, which `load_columns`
+memory-maps, so opening a dataset is near-instant and only pages that are
+actually read take up memory.
+
+Columns (one row per business, in sorted business ID order):
+    id: business ID
+    latitude, longitude: float64, NaN if missing
+    price_level: int8, length of the '$$' price string; 0 if missing
+    rating: float32, NaN if missing
+    review_count: int32, -1 if missing
+    city: int32 index into `cities.json`
+    category_offsets, category_ids: the categories of row `i` are
+        `category_ids[category_offsets[i]:category_offsets[i + 1]]`, as
+        int32 indices into `categories.json`
+    category_index_offsets, category_index_rows: inverted category index;
+        the sorted rows of businesses in category `c`, or in any category
+        below it in the hierarchy, are
+        `category_index_rows[category_index_offsets[c]:
+                             category_index_offsets[c + 1]]`
+
+`categories.json` lists the aliases businesses have, then their ancestors,
+so every category of the rolled-up index has a code.
+
+A spatial index over the coordinates is saved alongside (see `spatial.py`).
+
+To export the business store:
+    python -m yelp.columnar
+'''
+
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+
+from . import persist
+from . import yelp_categories
+from .settings import BUSINESS_STORE_PATH, COLUMNAR_DATA_PATH
+from .spatial import GridIndex
+from .store import BusinessStore
+
+logger = logging.getLogger(__name__)
+
+# Bump when the layout of the dataset changes.
+COLUMNAR_VERSION = 4
+
+COLUMNS = [
+    'id', 'latitude', 'longitude', 'price_level', 'rating', 'review_count',
+    'city', 'category_offsets', 'category_ids', 'category_index_offsets',
+    'category_index_rows',
+]
+
+
+class Vocabulary():
+    '''Dictionary encoding of strings to consecutive ints.'''
+
+    def __init__(self, values=None):
+        self.values = list(values or [])
+        self.codes = {v: i for i, v in enumerate(self.values)}
+
+    def encode(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+class BusinessColumns():
+    '''A loaded columnar dataset. Columns are attributes, by name.'''
+
+    def __init__(self, path, columns, cities, categories, meta):
+        self.path = path
+        self.cities = cities
+        self.categories = categories
+        self.meta = meta
+        for name, column in columns.items():
+            setattr(self, name, column)
+        self._spatial = None
+        self._category_codes = None
+
+    @property
+    def spatial(self):
+        '''Spatial index over the coordinates.'''
+        if self._spatial is None:
+            self._spatial = GridIndex.load(
+                self.path, self.latitude, self.longitude)
+        return self._spatial
+
+    def __len__(self):
+        return len(self.latitude)
+
+    def row_categories(self, row):
+        '''Category aliases of a row.'''
+        start, end = self.category_offsets[row], self.category_offsets[row + 1]
+        return [self.categories[i] for i in self.category_ids[start:end]]
+
+    def category_postings(self, category):
+        '''
+        Sorted rows of businesses in a category or any category below it;
+        empty if no business is.
+        '''
+        if self._category_codes is None:
+            self._category_codes = {
+                c: i for i, c in enumerate(self.categories)}
+        code = self._category_codes.get(category)
+        if code is None:
+            return np.zeros(0, dtype=np.int32)
+        return self.category_index_rows[
+            self.category_index_offsets[code]:
+            self.category_index_offsets[code + 1]]
+
+    def category_rows(self, categories, match_all=False):
+        '''
+        Sorted rows of businesses in any of `categories` (an alias, or a
+        collection of aliases), or with `match_all`, in all of them, counting
+        categories below each in the hierarchy.
+        '''
+        if isinstance(categories, str):
+            categories = [categories]
+        postings = sorted(
+            (self.category_postings(c) for c in set(categories)), key=len)
+        if not postings:
+            return np.zeros(0, dtype=np.int32)
+        if match_all:
+            # Shortest first, so intermediate results stay small.
+            rows = postings[0]
+            for p in postings[1:]:
+                rows = np.intersect1d(rows, p, assume_unique=True)
+            return rows
+        return np.unique(np.concatenate(postings))
+
+
+def _get(biz, *keys):
+    for key in keys:
+        if biz is None:
+            return None
+        biz = biz.get(key)
+    return biz
+
+
+def build_category_index(category_offsets, category_ids, categories,
+                         category_index=None):
+    '''
+    Invert rows' category IDs into `(offsets, rows)` posting lists, one per
+    code of the `categories` vocabulary, rolled up through the hierarchy of
+    `category_index` (by default, that of `categories.json`): a category's
+    rows include those of all categories below it. Ancestors missing from
+    `categories` are added to it.
+    '''
+    if category_index is None:
+        category_index = yelp_categories.get_category_index()
+    # Codes each direct category rolls up to: itself and its ancestors.
+    rollup = [
+        [code] + [categories.encode(a)
+                  for a in category_index.ancestors.get(alias, ())]
+        for code, alias in enumerate(list(categories.values))
+    ]
+    rollup_lengths = np.array([len(r) for r in rollup], dtype=np.int64)
+    rollup_offsets = np.concatenate(([0], np.cumsum(rollup_lengths)))
+    rollup_codes = np.array(
+        [c for r in rollup for c in r], dtype=np.int64)
+
+    # Expand each (row, category) pair to (row, rolled up category) pairs.
+    n_rows = len(category_offsets) - 1
+    n_codes = len(categories.values)
+    category_ids = np.asarray(category_ids)
+    entry_rows = np.repeat(np.arange(n_rows), np.diff(category_offsets))
+    counts = rollup_lengths[category_ids]
+    ends = np.cumsum(counts)
+    gather = np.arange(ends[-1] if len(ends) else 0) + np.repeat(
+        rollup_offsets[category_ids] - (ends - counts), counts)
+    # Sort by code, then row, dropping rows reached twice.
+    keys = np.unique(
+        rollup_codes[gather] * n_rows + np.repeat(entry_rows, counts))
+    offsets = np.zeros(n_codes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys // max(n_rows, 1), minlength=n_codes),
+              out=offsets[1:])
+    return offsets, (keys % max(n_rows, 1)).astype(np.int32)
+
+
+def export_columns(businesses, path, category_index=None):
+    '''
+    Write `(id, business)` pairs to a columnar dataset at directory `path`,
+    replacing any existing dataset there. Categories are rolled up through
+    the hierarchy of `category_index` (see `build_category_index`).
+    Returns the number of rows written.
+    '''
+    cities = Vocabulary()
+    categories = Vocabulary()
+    ids, lat, lng, price, rating, review_count, city = (
+        [], [], [], [], [], [], [])
+    category_offsets, category_ids = [0], []
+
+    for id, biz in businesses:
+        ids.append(id)
+        lat.append(_get(biz, 'coordinates', 'latitude'))
+        lng.append(_get(biz, 'coordinates', 'longitude'))
+        price.append(len(biz.get('price') or ''))
+        rating.append(biz.get('rating'))
+        review_count.append(biz.get('review_count'))
+        city.append(cities.encode(_get(biz, 'location', 'city')))
+        category_ids.extend(
+            categories.encode(c['alias']) for c in biz.get('categories') or [])
+        category_offsets.append(len(category_ids))
+
+    def floats(values, dtype):
+        return np.array(
+            [np.nan if v is None else v for v in values], dtype=dtype)
+
+    columns = {
+        'id': np.array(ids, dtype=str),
+        'latitude': floats(lat, np.float64),
+        'longitude': floats(lng, np.float64),
+        'price_level': np.array(price, dtype=np.int8),
+        'rating': floats(rating, np.float32),
+        'review_count': np.array(
+            [-1 if v is None else v for v in review_count], dtype=np.int32),
+        'city': np.array(city, dtype=np.int32),
+        'category_offsets': np.array(category_offsets, dtype=np.int64),
+        'category_ids': np.array(category_ids, dtype=np.int32),
+    }
+    (columns['category_index_offsets'],
+     columns['category_index_rows']) = build_category_index(
+        columns['category_offsets'], columns['category_ids'], categories,
+        category_index)
+
+    # Build alongside, then swap in, so readers never see half a dataset.
+    tmp_path = path.rstrip(os.sep) + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for name, column in columns.items():
+        np.save(os.path.join(tmp_path, name + '.npy'), column)
+    for name, values in (('cities', cities.values),
+                         ('categories', categories.values)):
+        with open(os.path.join(tmp_path, name + '.json'), 'w') as f:
+            f.write(json.dumps(values))
+    GridIndex.build(columns['latitude'], columns['longitude']).save(tmp_path)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        f.write(json.dumps({'version': COLUMNAR_VERSION, 'rows': len(ids)}))
+    persist.replace_dir(tmp_path, path)
+
+    logger.info('Exported %d businesses to %s' % (len(ids), path))
+    return len(ids)
+
+
+def load_columns(path=COLUMNAR_DATA_PATH):
+    '''Memory-map a columnar dataset.'''
+    with open(os.path.join(path, 'meta.json'), 'r') as f:
+        meta = json.loads(f.read())
+    if meta.get('version') != COLUMNAR_VERSION:
+        raise ValueError(
+            'Columnar dataset %s is version %s, expected %d. Re-export it.' %
+            (path, meta.get('version'), COLUMNAR_VERSION))
+    columns = {
+        name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+        for name in COLUMNS
+    }
+    vocabularies = []
+    for name in ('cities', 'categories'):
+        with open(os.path.join(path, name + '.json'), 'r') as f:
+            vocabularies.append(json.loads(f.read()))
+    return BusinessColumns(path, columns, *vocabularies, meta=meta)
+
+
+if __name__ == '__main__':
+    logger.setLevel(logging.INFO)
+    store = BusinessStore(BUSINESS_STORE_PATH)
+    export_columns(store.items(), COLUMNAR_DATA_PATH)
+    store.close()
@@ -0,0 +1,181 @@
+'''
+Crawl many locations with a pool of worker processes.
+
+Work items, `(location, progress key)`, are claimed from a shared
+`LeaseQueue` (see `leases.py`), so workers never fetch the same item at
+once, and an item whose worker died is picked up again when its lease
+expires. Workers share `YELP_MAX_QPS` between them through the queue (see
+`SharedRateLimiter`), and all stop once one of them hits the daily quota.
+Businesses are stored per city, in `<CITY_STORES_PATH>/<city>.sqlite3`, and
+archived in `<CITY_STORES_PATH>/<city>.archive`. Workers look up whether a
+business changed in the city store as they go, so they don't rewrite what
+another worker just stored.
+
+Workers on other hosts can join a crawl by running `run_worker` against the
+same queue and stores on shared storage, which needs working `flock` and
+POSIX locks (e.g. NFSv4). City stores use SQLite's rollback journal rather
+than WAL, which needs memory shared between processes. Workers on every host
+count against the same `max_qps`.
+
+    python -m yelp.crawl [location ...]
+'''
+
+import logging
+import multiprocessing
+import os
+import re
+import socket
+import sys
+import time
+
+from .archive import ResponseArchive
+from .leases import (
+    DEFAULT_LEASE_TTL, QUOTA_EXCEEDED, LeaseProgress, LeaseQueue,
+    SharedRateLimiter)
+from .metrics import NULL_METRICS, Metrics
+from .progress import ProgressStatus
+from .settings import *
+from .store import BusinessStore
+from .yelp import YELP_SEARCH_API_URL, Fetcher
+from . import yelp_categories
+
+logger = logging.getLogger(__name__)
+
+# Seconds an idle worker waits for other workers' items to finish or expire.
+POLL_INTERVAL = 1
+
+
+def _slug(location):
+    return re.sub('[^a-z0-9]+', '_', location.lower()).strip('_')
+
+
+def city_store_path(location, root=CITY_STORES_PATH):
+    return os.path.join(root, _slug(location) + '.sqlite3')
+
+
+def city_archive_path(location, root=CITY_STORES_PATH):
+    return os.path.join(root, _slug(location) + '.archive')
+
+
+def worker_metrics(worker_id):
+    '''Each worker exports metrics to its own file, if metrics are enabled.'''
+    if not YELP_METRICS_PATH:
+        return NULL_METRICS
+    root, ext = os.path.splitext(YELP_METRICS_PATH)
+    return Metrics('%s.%s%s' % (root, worker_id, ext), YELP_METRICS_INTERVAL)
+
+
+def run_worker(queue_path=CRAWL_QUEUE_PATH, stores_path=CITY_STORES_PATH,
+               worker_id=None, api_url=YELP_SEARCH_API_URL,
+               max_qps=YELP_MAX_QPS, ttl=DEFAULT_LEASE_TTL,
+               locations=SEARCH_LOCATIONS, poll_interval=POLL_INTERVAL):
+    '''
+    Claim and fetch work items until there are none left, or the daily quota
+    is reached. Returns the number of items this worker finished.
+    `max_qps` is shared by all workers of the queue.
+    '''
+    if worker_id is None:
+        worker_id = '%s-%d' % (socket.gethostname(), os.getpid())
+    queue = LeaseQueue(queue_path)
+    rate_limiter = SharedRateLimiter(queue, max_qps)
+    metrics = worker_metrics(worker_id)
+    metrics.start()
+    fetchers = {}
+    finished = 0
+    try:
+        while not queue.get_flag(QUOTA_EXCEEDED):
+            item = queue.claim(worker_id, ttl)
+            if item is None:
+                if not queue.pending():
+                    break
+                time.sleep(poll_interval)
+                continue
+            location, key = item
+
+            fetcher = fetchers.get(location)
+            if fetcher is None:
+                fetcher = fetchers[location] = Fetcher(
+                    api_url=api_url, concurrency=1, max_qps=max_qps,
+                    metrics=metrics, location=location,
+                    bounds=locations.get(
+                        location, SEARCH_LOCATIONS.get(location)),
+                    progress=LeaseProgress(queue, location, worker_id, ttl),
+                    store=BusinessStore(
+                        city_store_path(location, stores_path),
+                        journal_mode='DELETE'),
+                    archive=ResponseArchive(
+                        city_archive_path(location, stores_path)),
+                    rate_limiter=rate_limiter)
+            fetcher.fetch_category(key)
+
+            quota_exceeded = fetcher.quota_exceeded.is_set()
+            if quota_exceeded:
+                queue.set_flag(QUOTA_EXCEEDED, str(time.time()))
+            if queue.get_status(location, key) == ProgressStatus.INCOMPLETE:
+                # Quota errors aren't the item's fault, so don't count them.
+                queue.release(
+                    location, key, worker_id, failed=not quota_exceeded)
+            else:
+                finished += 1
+    finally:
+        for fetcher in fetchers.values():
+            fetcher.store.close()
+            fetcher.archive.close()
+        metrics.stop()
+        queue.close()
+    logger.info('Worker %s finished %d items.' % (worker_id, finished))
+    return finished
+
+
+def crawl(locations=None, workers=CRAWL_WORKERS, queue_path=CRAWL_QUEUE_PATH,
+          stores_path=CITY_STORES_PATH, categories=None,
+          api_url=YELP_SEARCH_API_URL, max_qps=YELP_MAX_QPS,
+          ttl=DEFAULT_LEASE_TTL):
+    '''
+    Crawl `locations`, `{<location>: <bounds or None>}`, for `categories`
+    (by default, all top level categories) with `workers` processes.
+    Returns the number of work items by `ProgressStatus`.
+    '''
+    if locations is None:
+        locations = SEARCH_LOCATIONS
+    if categories is None:
+        categories = yelp_categories.get_top_level_categories()
+
+    queue = LeaseQueue(queue_path)
+    for location in locations:
+        queue.add(location, categories)
+    # A new run may be on a new day's quota.
+    queue.set_flag(QUOTA_EXCEEDED, None)
+    os.makedirs(stores_path, exist_ok=True)
+
+    workers = max(1, workers)
+    processes = [
+        multiprocessing.Process(target=run_worker, kwargs={
+            'queue_path': queue_path,
+            'stores_path': stores_path,
+            'worker_id': 'worker%d' % i,
+            'api_url': api_url,
+            'max_qps': max_qps,
+            'ttl': ttl,
+            'locations': locations,
+        })
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    counts = queue.counts()
+    queue.close()
+    print("complete %d, wontfix %d, incomplete %d" % (
+        counts.get(ProgressStatus.COMPLETE, 0),
+        counts.get(ProgressStatus.WONTFIX, 0),
+        counts.get(ProgressStatus.INCOMPLETE, 0)))
+    return counts
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    names = sys.argv[1:]
+    crawl({name: SEARCH_LOCATIONS.get(name) for name in names} or None)
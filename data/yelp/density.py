@@ -0,0 +1,191 @@
+'''
+Density normalization of heatmap layers.
+
+Raw `[lat, lng, value]` points are dominated by where businesses are: a
+heatmap of ratings is mostly a map of downtown. Instead, rasterize business
+counts and value sums onto a grid of `cell_meters` square cells, smooth both
+with a Gaussian kernel of standard deviation `bandwidth_meters` by FFT
+convolution, and divide. Each cell then gets the kernel-weighted mean value
+of the businesses around it, e.g. the mean rating of its neighbourhood,
+however many businesses the neighbourhood has.
+
+Rasterizing is a single `np.bincount`, and the grid is small next to the
+number of businesses, so millions of businesses take about a second.
+'''
+
+from collections import namedtuple
+import math
+
+import numpy as np
+
+METERS_PER_DEGREE = 111320.0
+
+DEFAULT_CELL_METERS = 100
+DEFAULT_BANDWIDTH_METERS = 400
+# Cells get no value, rather than one extrapolated from a few businesses far
+# away, unless the businesses around them weigh at least as much as this
+# many businesses right at the cell would. 0.5 is about one business within
+# 1.2 bandwidths, whatever the cell size.
+DEFAULT_MIN_WEIGHT = 0.5
+
+# The kernel is cut off this many standard deviations from its centre.
+KERNEL_RADIUS_SIGMAS = 4
+
+# Most cells a grid may have: about a 200km square of 100m cells, a few
+# hundred MB per FFT. Grids spanning several cities, or stretched by a bogus
+# coordinate, should be given bounds instead.
+MAX_CELLS = 4000000
+
+
+class Grid():
+    '''
+    Grid of `cell_meters` square cells (at its middle latitude) over
+    `bounds`, `(south, west, north, east)`, in rows of latitude.
+    Raises ValueError if that's more than `MAX_CELLS` cells.
+    '''
+
+    def __init__(self, bounds, cell_meters=DEFAULT_CELL_METERS):
+        south, west, north, east = bounds
+        self.south = south
+        self.west = west
+        self.cell_meters = cell_meters
+        self.cell_lat = cell_meters / METERS_PER_DEGREE
+        self.cell_lng = cell_meters / (
+            METERS_PER_DEGREE * math.cos(math.radians((south + north) / 2)))
+        self.shape = (
+            int((north - south) / self.cell_lat) + 1,
+            int((east - west) / self.cell_lng) + 1,
+        )
+        if self.shape[0] * self.shape[1] > MAX_CELLS:
+            raise ValueError(
+                'A grid of %gm cells over %s would have %d x %d cells, over '
+                'the maximum of %d. Pass narrower bounds.' % (
+                    cell_meters, tuple(bounds), self.shape[0], self.shape[1],
+                    MAX_CELLS))
+
+    @classmethod
+    def covering(cls, lat, lng, cell_meters=DEFAULT_CELL_METERS,
+                 pad_meters=0):
+        '''The grid over the bounding box of some points, plus a margin.'''
+        pad_lat = pad_meters / METERS_PER_DEGREE
+        pad_lng = pad_meters / (METERS_PER_DEGREE * math.cos(
+            math.radians((lat.min() + lat.max()) / 2)))
+        return cls(
+            (lat.min() - pad_lat, lng.min() - pad_lng,
+             lat.max() + pad_lat, lng.max() + pad_lng),
+            cell_meters)
+
+    def cells(self, lat, lng):
+        '''
+        Row and column arrays of the cells that points fall in. Points
+        outside the grid are put in the nearest cell on its edge.
+        '''
+        rows = ((lat - self.south) / self.cell_lat).astype(np.intp)
+        cols = ((lng - self.west) / self.cell_lng).astype(np.intp)
+        return (np.clip(rows, 0, self.shape[0] - 1),
+                np.clip(cols, 0, self.shape[1] - 1))
+
+    def rasterize(self, lat, lng, weights=None):
+        '''Sum `weights` (by default, 1 per point) into an array of cells.'''
+        rows, cols = self.cells(lat, lng)
+        return np.bincount(
+            rows * self.shape[1] + cols, weights=weights,
+            minlength=self.shape[0] * self.shape[1],
+        ).astype(np.float64).reshape(self.shape)
+
+    def centers(self):
+        '''Latitudes of row centres and longitudes of column centres.'''
+        return (self.south + (np.arange(self.shape[0]) + 0.5) * self.cell_lat,
+                self.west + (np.arange(self.shape[1]) + 0.5) * self.cell_lng)
+
+
+def gaussian_kernel(sigma):
+    '''Normalized 2D Gaussian kernel, with `sigma` in cells.'''
+    radius = max(1, int(math.ceil(KERNEL_RADIUS_SIGMAS * sigma)))
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 * (x / sigma) ** 2)
+    kernel = np.outer(kernel, kernel)
+    return kernel / kernel.sum()
+
+
+def fast_length(n):
+    '''
+    The smallest length >= `n` with no prime factors but 2, 3 and 5, which
+    FFTs are several times faster on than on lengths with large factors.
+    '''
+    best = 1 << max(0, (n - 1).bit_length())
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            # Smallest power of two taking p35 to at least n.
+            length = p35
+            while length < n:
+                length *= 2
+            best = min(best, length)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+
+def fft_convolve(image, kernel):
+    '''
+    Convolve `image` with an odd-sized `kernel`, returning an array of the
+    same shape as `image`. Zero padded, so nothing wraps around the edges.
+    '''
+    shape = tuple(
+        fast_length(n + k - 1) for n, k in zip(image.shape, kernel.shape))
+    out = np.fft.irfft2(
+        np.fft.rfft2(image, shape) * np.fft.rfft2(kernel, shape), shape)
+    top, left = kernel.shape[0] // 2, kernel.shape[1] // 2
+    return out[top:top + image.shape[0], left:left + image.shape[1]]
+
+
+class DensitySurface(
+        namedtuple('DensitySurface', ['grid', 'weight', 'mean'])):
+    '''
+    Smoothed business count (`weight`) and kernel-weighted mean value per
+    cell of `grid`, NaN where the weight is below the minimum.
+    '''
+
+    def points(self):
+        '''`(lat, lng, mean)` arrays at the centres of cells with a mean.'''
+        rows, cols = np.nonzero(~np.isnan(self.mean))
+        lat, lng = self.grid.centers()
+        return lat[rows], lng[cols], self.mean[rows, cols]
+
+
+def normalize(lat, lng, values, cell_meters=DEFAULT_CELL_METERS,
+              bandwidth_meters=DEFAULT_BANDWIDTH_METERS,
+              min_weight=DEFAULT_MIN_WEIGHT, bounds=None):
+    '''
+    The `DensitySurface` of values at points, over `bounds` if given, else
+    over the points' bounding box plus the reach of the kernel. Points with
+    a NaN coordinate or value, or outside `bounds`, are left out.
+    '''
+    lat = np.asarray(lat, dtype=np.float64)
+    lng = np.asarray(lng, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    keep = ~(np.isnan(lat) | np.isnan(lng) | np.isnan(values))
+    if bounds is not None:
+        south, west, north, east = bounds
+        keep &= (lat >= south) & (lat <= north) & \
+            (lng >= west) & (lng <= east)
+    lat, lng, values = lat[keep], lng[keep], values[keep]
+    if bounds is not None:
+        grid = Grid(bounds, cell_meters)
+    elif len(lat):
+        grid = Grid.covering(
+            lat, lng, cell_meters, KERNEL_RADIUS_SIGMAS * bandwidth_meters)
+    else:
+        return DensitySurface(
+            Grid((0, 0, 0, 0), cell_meters), np.zeros((1, 1)),
+            np.full((1, 1), np.nan))
+
+    kernel = gaussian_kernel(bandwidth_meters / cell_meters)
+    weight = fft_convolve(grid.rasterize(lat, lng), kernel)
+    sums = fft_convolve(grid.rasterize(lat, lng, values), kernel)
+    mean = np.full(grid.shape, np.nan)
+    dense = weight >= min_weight * kernel.max()
+    mean[dense] = sums[dense] / weight[dense]
+    return DensitySurface(grid, weight, mean)
@@ -0,0 +1,126 @@
+'''
+Geographic partitioning of searches, for categories that exceed the API's
+max fetch limit and can't be narrowed down by child category.
+
+A search is identified by a progress key, which is either a bare category
+alias (search the whole `SEARCH_LOCATION`) or a category restricted to a
+lat/lng bounding box cell:
+    <category>@<south>,<west>,<north>,<east>
+Cells are searched with the circle circumscribing them, so a cell's results
+are a superset of the businesses inside it.
+'''
+
+from collections import namedtuple
+import math
+
+EARTH_RADIUS_METERS = 6371000
+
+# The API rejects larger search radii.
+YELP_MAX_RADIUS_METERS = 40000
+# Don't split cells smaller than this; they'd just be refetching the same
+# businesses.
+MIN_CELL_RADIUS_METERS = 25
+
+KEY_SEPARATOR = '@'
+
+
+class SplitStrategy:
+    CATEGORY = 'category'
+    GEO = 'geo'
+
+
+class Cell(namedtuple('Cell', ['south', 'west', 'north', 'east'])):
+    '''A lat/lng bounding box.'''
+
+    @property
+    def center(self):
+        return ((self.south + self.north) / 2, (self.west + self.east) / 2)
+
+    @property
+    def radius(self):
+        '''Radius in meters of the circle circumscribing this cell.'''
+        lat, lng = self.center
+        return math.ceil(max(
+            haversine(lat, lng, corner_lat, corner_lng)
+            for corner_lat in (self.south, self.north)
+            for corner_lng in (self.west, self.east)))
+
+    def contains(self, lat, lng):
+        return (self.south <= lat <= self.north and
+                self.west <= lng <= self.east)
+
+    def split(self):
+        '''Split into 4 quadrants: SW, SE, NW, NE.'''
+        lat, lng = self.center
+        return [
+            Cell(self.south, self.west, lat, lng),
+            Cell(self.south, lng, lat, self.east),
+            Cell(lat, self.west, self.north, lng),
+            Cell(lat, lng, self.north, self.east),
+        ]
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    '''Great-circle distance in meters.'''
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_METERS * math.asin(math.sqrt(a))
+
+
+def make_key(category, cell=None):
+    if cell is None:
+        return category
+    return '%s%s%s' % (
+        category, KEY_SEPARATOR, ','.join('%.6f' % x for x in cell))
+
+
+def parse_key(key):
+    '''Return `(category, cell)` for a progress key. `cell` may be None.'''
+    if KEY_SEPARATOR not in key:
+        return key, None
+    category, bounds = key.split(KEY_SEPARATOR, 1)
+    return category, Cell(*[float(x) for x in bounds.split(',')])
+
+
+def search_params(key, location):
+    '''API search params (other than paging) for a progress key.'''
+    category, cell = parse_key(key)
+    if cell is None:
+        return {'location': location, 'categories': category}
+    lat, lng = cell.center
+    return {
+        'latitude': lat,
+        'longitude': lng,
+        'radius': min(cell.radius, YELP_MAX_RADIUS_METERS),
+        'categories': category,
+    }
+
+
+def estimate_calls(total, n_parts, page_size, max_fetch_limit):
+    '''
+    Estimate the number of requests to fetch `total` results by splitting
+    them evenly across `n_parts` searches, assuming any part still over
+    `max_fetch_limit` is split again into geo quadrants.
+    '''
+    per_part = total / n_parts
+    if per_part > max_fetch_limit:
+        return n_parts * (1 + estimate_calls(
+            per_part, 4, page_size, max_fetch_limit))
+    return n_parts * max(1, math.ceil(per_part / page_size))
+
+
+def choose_split(total, n_children, page_size, max_fetch_limit):
+    '''
+    Pick how to narrow a search with `total` results: by its `n_children`
+    child categories, or by splitting its cell into quadrants; whichever is
+    estimated to take fewer requests. Leaf categories can only split by geo.
+    '''
+    if n_children == 0:
+        return SplitStrategy.GEO
+    by_category = estimate_calls(
+        total, n_children, page_size, max_fetch_limit)
+    by_geo = estimate_calls(total, 4, page_size, max_fetch_limit)
+    if by_category <= by_geo:
+        return SplitStrategy.CATEGORY
+    return SplitStrategy.GEO
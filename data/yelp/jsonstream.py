@@ -0,0 +1,127 @@
+'''
+Incremental reading of large JSON files, so we don't need to hold the whole
+file (and the whole parsed object) in memory at once.
+'''
+
+import json
+
+CHUNK_SIZE = 1 << 16
+
+_WHITESPACE = ' \t\n\r'
+_NUMBER_CHARS = '0123456789+-.eE'
+
+
+class _Reader():
+    '''Buffer over a text file, refilled a chunk at a time.'''
+
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        '''Read another chunk. Returns False at end of file.'''
+        if self.eof:
+            return False
+        # Drop what we've already consumed
+        if self.pos:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf += chunk
+        return True
+
+    def peek(self):
+        '''Next non-whitespace char, or '' at end of file.'''
+        while True:
+            while self.pos < len(self.buf) and \
+                    self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise json.JSONDecodeError(
+                'Expecting %r' % char, self.buf, self.pos)
+        self.pos += 1
+
+    def decode(self, decoder):
+        '''Decode the next complete JSON value.'''
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self.fill():
+                    continue
+                raise
+            # A number cut off by the end of the buffer may have been parsed
+            # as a shorter number (e.g. '-0' of '-0.25'), so make sure a
+            # delimiter follows it.
+            if (end == len(self.buf) or self.buf[end] in _NUMBER_CHARS) \
+                    and self.fill():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_object_items(f, chunk_size=CHUNK_SIZE):
+    '''
+    Yield `(key, value)` pairs of the top-level JSON object in text file `f`,
+    parsing one value at a time.
+    '''
+    decoder = json.JSONDecoder()
+    reader = _Reader(f, chunk_size)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        key = reader.decode(decoder)
+        reader.expect(':')
+        yield key, reader.decode(decoder)
+        if reader.peek() == '}':
+            return
+        reader.expect(',')
+
+
+def iter_json_file_items(path, chunk_size=CHUNK_SIZE):
+    '''`iter_object_items` over the JSON file at `path`.'''
+    with open(path, 'r') as f:
+        yield from iter_object_items(f, chunk_size)
+
+
+class JSONArrayWriter():
+    '''
+    Stream items to text file `f` as a JSON array, formatted the same as
+    `json.dumps` of a list. Call `close()` to end the array.
+    '''
+
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+        self.f.write('[')
+
+    def write(self, item):
+        if self.count:
+            self.f.write(', ')
+        self.f.write(json.dumps(item))
+        self.count += 1
+
+    def close(self):
+        self.f.write(']')
+
+
+def write_json_array(f, items):
+    '''Stream an iterable to text file `f` as a JSON array.'''
+    writer = JSONArrayWriter(f)
+    for item in items:
+        writer.write(item)
+    writer.close()
@@ -0,0 +1,300 @@
+'''
+Shared queue of crawl work items, claimed by worker processes through
+leases, so that many workers (on one host, or several hosts on shared
+storage) can crawl without doing the same work twice.
+
+Work items are `(location, progress key)` pairs, backed by SQLite:
+    items: status (a `ProgressStatus`), the lease holder and its expiry, the
+        number of failed attempts, and the pagination cursor
+    meta: flags shared by all workers, e.g. that the daily quota is used up,
+        and the time of the next request slot of `SharedRateLimiter`
+
+A worker claims an incomplete item whose lease is free or expired, renews
+the lease as it makes progress, and finishes it as complete or wontfix,
+splits it into smaller searches, or releases it to be retried. If a worker
+dies, its item is picked up again once the lease expires, resuming at the
+saved cursor.
+'''
+
+from contextlib import contextmanager
+import json
+import sqlite3
+import time
+
+from .progress import ProgressStatus
+
+# Seconds a claimed item is held before other workers may take it over.
+DEFAULT_LEASE_TTL = 300
+
+# Items released after this many failed attempts aren't claimed again.
+MAX_ATTEMPTS = 3
+
+QUOTA_EXCEEDED = 'quota_exceeded'
+NEXT_REQUEST = 'next_request'
+
+
+class LeaseQueue():
+
+    def __init__(self, path, max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.max_attempts = max_attempts
+        # Autocommit, with explicit `BEGIN IMMEDIATE` transactions. The
+        # default rollback journal, unlike WAL, works on network filesystems.
+        self.conn = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False)
+        with self._transaction():
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS items ('
+                'location TEXT, key TEXT, status INTEGER NOT NULL, '
+                'owner TEXT, expires REAL, attempts INTEGER DEFAULT 0, '
+                'cursor TEXT, '
+                'PRIMARY KEY (location, key))')
+            self.conn.execute(
+                'CREATE INDEX IF NOT EXISTS items_status ON items (status)')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS meta ('
+                'key TEXT PRIMARY KEY, value TEXT)')
+
+    def close(self):
+        self.conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+
+    # Read-only
+
+    def get_status(self, location, key):
+        row = self.conn.execute(
+            'SELECT status FROM items WHERE location = ? AND key = ?',
+            (location, key)).fetchone()
+        return row[0] if row is not None else None
+
+    def get_statuses(self, location):
+        '''`{<key>: <status>}` for all of a location's items.'''
+        return dict(self.conn.execute(
+            'SELECT key, status FROM items WHERE location = ?', (location,)))
+
+    def get_cursor(self, location, key):
+        row = self.conn.execute(
+            'SELECT cursor FROM items WHERE location = ? AND key = ?',
+            (location, key)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return tuple(json.loads(row[0]))
+
+    def pending(self):
+        '''Number of incomplete items that may still be claimed.'''
+        return self.conn.execute(
+            'SELECT COUNT(*) FROM items WHERE status = ? AND attempts < ?',
+            (ProgressStatus.INCOMPLETE, self.max_attempts)).fetchone()[0]
+
+    def counts(self):
+        '''`{<status>: <number of items>}`.'''
+        return dict(self.conn.execute(
+            'SELECT status, COUNT(*) FROM items GROUP BY status'))
+
+    # Write
+
+    def add(self, location, keys):
+        '''Add incomplete items. Existing items are left as they are.'''
+        with self._transaction():
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO items (location, key, status) '
+                'VALUES (?, ?, ?)',
+                [(location, key, ProgressStatus.INCOMPLETE) for key in keys])
+
+    def claim(self, owner, ttl=DEFAULT_LEASE_TTL):
+        '''
+        Lease an incomplete item to `owner` for `ttl` seconds.
+        Returns `(location, key)`, or None if there is nothing to claim.
+        '''
+        now = time.time()
+        with self._transaction():
+            row = self.conn.execute(
+                'SELECT location, key FROM items WHERE status = ? '
+                'AND attempts < ? AND (owner IS NULL OR expires < ?) '
+                'ORDER BY attempts, rowid LIMIT 1',
+                (ProgressStatus.INCOMPLETE, self.max_attempts, now)
+            ).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(
+                'UPDATE items SET owner = ?, expires = ? '
+                'WHERE location = ? AND key = ?',
+                (owner, now + ttl) + tuple(row))
+        return tuple(row)
+
+    def set_cursor(self, location, key, cursor, owner=None,
+                   ttl=DEFAULT_LEASE_TTL):
+        '''
+        Save an item's pagination cursor, renewing `owner`'s lease. Does
+        nothing if another worker holds the lease.
+        '''
+        with self._transaction():
+            self.conn.execute(
+                'UPDATE items SET cursor = ? WHERE location = ? AND key = ? '
+                'AND (owner = ? OR owner IS NULL)',
+                (json.dumps(cursor), location, key, owner))
+            if owner is not None:
+                self.conn.execute(
+                    'UPDATE items SET expires = ? '
+                    'WHERE location = ? AND key = ? AND owner = ?',
+                    (time.time() + ttl, location, key, owner))
+
+    def finish(self, location, key, status, owner=None):
+        '''
+        Mark an item complete or wontfix, ending `owner`'s lease on it.
+        Does nothing if another worker holds the lease, e.g. after taking
+        over `owner`'s expired one. Returns whether the item was marked.
+        '''
+        with self._transaction():
+            return self._finish(location, key, status, owner)
+
+    def _finish(self, location, key, status, owner):
+        return self.conn.execute(
+            'INSERT INTO items (location, key, status) VALUES (?, ?, ?) '
+            'ON CONFLICT DO UPDATE SET status = excluded.status, '
+            'owner = NULL, expires = NULL, cursor = NULL '
+            'WHERE owner = ? OR owner IS NULL',
+            (location, key, status, owner)).rowcount > 0
+
+    def split(self, location, key, children, owner=None):
+        '''
+        Mark an item wontfix and add incomplete `children` in its place, in
+        one transaction, so that a worker dying partway doesn't lose them.
+        Does nothing if another worker holds the lease, as for `finish`.
+        Returns whether the item was split.
+        '''
+        with self._transaction():
+            if not self._finish(
+                    location, key, ProgressStatus.WONTFIX, owner):
+                return False
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO items (location, key, status) '
+                'VALUES (?, ?, ?)',
+                [(location, child, ProgressStatus.INCOMPLETE)
+                 for child in children])
+        return True
+
+    def release(self, location, key, owner, failed=True):
+        '''
+        Give up `owner`'s lease on an unfinished item, counting a failed
+        attempt unless `failed` is False.
+        '''
+        with self._transaction():
+            self.conn.execute(
+                'UPDATE items SET owner = NULL, expires = NULL, '
+                'attempts = attempts + ? '
+                'WHERE location = ? AND key = ? AND owner = ? AND status = ?',
+                (int(failed), location, key, owner,
+                 ProgressStatus.INCOMPLETE))
+
+    # Shared flags
+
+    def get_flag(self, name):
+        row = self.conn.execute(
+            'SELECT value FROM meta WHERE key = ?', (name,)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_flag(self, name, value):
+        with self._transaction():
+            if value is None:
+                self.conn.execute('DELETE FROM meta WHERE key = ?', (name,))
+            else:
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                    (name, value))
+
+    def take_slot(self, name, interval):
+        '''
+        Reserve the next time slot of the schedule `name`: now, or
+        `interval` seconds after the last slot taken, whichever is later.
+        Returns the slot's time.
+        '''
+        with self._transaction():
+            slot = max(time.time(), float(self.get_flag(name) or 0))
+            self.conn.execute(
+                'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                (name, repr(slot + interval)))
+        return slot
+
+
+class SharedRateLimiter():
+    '''
+    Rate limit shared by every worker of a `LeaseQueue`, on any host: each
+    request takes the next free slot, `1 / rate` seconds after the one
+    before, from the queue. Drop-in for `TokenBucket` in `Fetcher`, with no
+    bursts. Hosts' clocks are assumed to roughly agree.
+    '''
+
+    def __init__(self, queue, rate):
+        self.queue = queue
+        self.interval = 1.0 / rate
+
+    def acquire(self):
+        '''Block until this worker's request slot.'''
+        slot = self.queue.take_slot(NEXT_REQUEST, self.interval)
+        time.sleep(max(0, slot - time.time()))
+
+
+class LeaseProgress():
+    '''
+    The parts of the `ProgressMeter` interface that `Fetcher` uses, over one
+    location's items in a `LeaseQueue`. Saving a cursor renews `owner`'s
+    lease.
+    '''
+
+    def __init__(self, queue, location, owner=None, ttl=DEFAULT_LEASE_TTL):
+        self.queue = queue
+        self.location = location
+        self.owner = owner
+        self.ttl = ttl
+
+    def get_data(self):
+        return self.queue.get_statuses(self.location)
+
+    def keys(self):
+        return list(self.get_data().keys())
+
+    def get_value(self, key):
+        return self.queue.get_status(self.location, key)
+
+    def is_complete(self, key):
+        return self.get_value(key) == ProgressStatus.COMPLETE
+
+    def is_incomplete(self, key):
+        return self.get_value(key) == ProgressStatus.INCOMPLETE
+
+    def is_wontfix(self, key):
+        return self.get_value(key) == ProgressStatus.WONTFIX
+
+    def get_cursor(self, key):
+        return self.queue.get_cursor(self.location, key)
+
+    def add_keys(self, keys):
+        self.queue.add(self.location, keys)
+
+    def mark_complete(self, key):
+        self.queue.finish(
+            self.location, key, ProgressStatus.COMPLETE, self.owner)
+
+    def mark_wontfix(self, key):
+        self.queue.finish(
+            self.location, key, ProgressStatus.WONTFIX, self.owner)
+
+    def split(self, key, new_keys):
+        self.queue.split(self.location, key, new_keys, self.owner)
+
+    def set_cursor(self, key, offset, total):
+        self.queue.set_cursor(
+            self.location, key, [offset, total], self.owner, self.ttl)
+
+    def close(self):
+        pass
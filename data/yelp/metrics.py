@@ -0,0 +1,222 @@
+'''
+In-process fetcher metrics, periodically exported to a file in the Prometheus
+text format, e.g. for node_exporter's textfile collector.
+
+Counters, gauges and histograms are created on first use and identified by
+name plus keyword labels:
+    metrics.inc('yelp_api_errors_total', code='ACCESS_LIMIT_REACHED')
+    metrics.set('yelp_quota_remaining', 4000)
+    with metrics.time('yelp_request_seconds'):
+        ...
+
+When metrics are disabled, use `NULL_METRICS`, whose methods do nothing.
+'''
+
+from bisect import bisect_left
+import os
+import tempfile
+import threading
+import time
+
+# Upper bounds, in seconds.
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram():
+    '''Counts of observations per bucket, plus their sum and count.'''
+    __slots__ = ['buckets', 'counts', 'sum', 'count']
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Timer():
+    __slots__ = ['metrics', 'name', 'labels', 'start']
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(
+            self.name, time.perf_counter() - self.start, **self.labels)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in labels)
+
+
+class Metrics():
+    '''
+    Thread-safe metrics registry. With a `path`, `start()` writes the metrics
+    there every `interval` seconds until `stop()`.
+    '''
+    enabled = True
+
+    def __init__(self, path=None, interval=15):
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.types = {}  # name -> 'counter' / 'gauge' / 'histogram'
+        self.values = {}  # (name, labels) -> number or Histogram
+        self._stopped = threading.Event()
+        self._exporter = None
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        '''Increment a counter.'''
+        key = self._key(name, labels)
+        with self.lock:
+            self.types.setdefault(name, 'counter')
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        '''Set a gauge.'''
+        key = self._key(name, labels)
+        with self.lock:
+            self.types.setdefault(name, 'gauge')
+            self.values[key] = value
+
+    def observe(self, name, value, **labels):
+        '''Add an observation to a histogram.'''
+        key = self._key(name, labels)
+        with self.lock:
+            self.types.setdefault(name, 'histogram')
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = Histogram()
+            histogram.observe(value)
+
+    def time(self, name, **labels):
+        '''Context manager observing its duration in a histogram.'''
+        return _Timer(self, name, labels)
+
+    def get(self, name, **labels):
+        '''Current value of a metric, or None if it hasn't been recorded.'''
+        with self.lock:
+            return self.values.get(self._key(name, labels))
+
+    # Export
+
+    def to_prometheus(self):
+        '''All metrics in the Prometheus text exposition format.'''
+        lines = []
+        with self.lock:
+            for name in sorted(self.types):
+                lines.append('# TYPE %s %s' % (name, self.types[name]))
+                for (key_name, labels), value in sorted(
+                        self.values.items(), key=lambda item: item[0]):
+                    if key_name != name:
+                        continue
+                    if not isinstance(value, Histogram):
+                        lines.append('%s%s %s' % (
+                            name, _format_labels(labels), value))
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(value.buckets, value.counts):
+                        cumulative += count
+                        lines.append('%s_bucket%s %d' % (
+                            name, _format_labels(labels + (('le', bound),)),
+                            cumulative))
+                    lines.append('%s_bucket%s %d' % (
+                        name, _format_labels(labels + (('le', '+Inf'),)),
+                        value.count))
+                    lines.append('%s_sum%s %s' % (
+                        name, _format_labels(labels), value.sum))
+                    lines.append('%s_count%s %d' % (
+                        name, _format_labels(labels), value.count))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path=None):
+        '''Atomically write metrics to `path`, so scrapers never see half.'''
+        path = path or self.path
+        dir = os.path.dirname(os.path.abspath(path))
+        with tempfile.NamedTemporaryFile(
+                'w', dir=dir, delete=False, suffix='.tmp') as f:
+            f.write(self.to_prometheus())
+        os.replace(f.name, path)
+
+    def start(self):
+        '''Start writing metrics to `path` every `interval` seconds.'''
+        if self.path is None or self._exporter is not None:
+            return
+        self._stopped.clear()
+        self._exporter = threading.Thread(target=self._export)
+        self._exporter.daemon = True
+        self._exporter.start()
+
+    def stop(self):
+        '''Stop the periodic export, writing the final values.'''
+        if self._exporter is None:
+            return
+        self._stopped.set()
+        self._exporter.join()
+        self._exporter = None
+
+    def _export(self):
+        while not self._stopped.wait(self.interval):
+            self.write()
+        self.write()
+
+
+class _NullTimer():
+    __slots__ = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class NullMetrics():
+    '''Metrics that are never recorded, for when metrics are disabled.'''
+    enabled = False
+    _timer = _NullTimer()
+
+    def inc(self, name, value=1, **labels):
+        pass
+
+    def set(self, name, value, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+    def time(self, name, **labels):
+        return self._timer
+
+    def get(self, name, **labels):
+        return None
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+NULL_METRICS = NullMetrics()
@@ -2,24 +2,55 @@
 Handle updates to local key-value store
 '''
 
+from contextlib import contextmanager
 import json
 import logging
 import os
+import shutil
 import sys
 import tempfile
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
 from . import util
 
 logger = logging.getLogger(__name__)
 
 
+@contextmanager
+def file_lock(fname):
+    '''
+    Exclusive lock on `<fname>.lock`, held across processes (and hosts, on
+    shared storage that supports `flock`). A no-op where `fcntl` is missing.
+    '''
+    if fcntl is None:
+        yield
+        return
+    with open(fname + '.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
 def update_json_file(fname, new_data, update_fn=None, pretty_print=True):
     '''
     Update a JSON file with new data.
     If no `update_fn` function is provided, do a standard dictionary update.
     `fname` is an absolute path.
     Atomic file swap, so that if we crash, we will still have the old file.
+    The read-update-write is done under `file_lock`, so concurrent updates
+    from several processes don't overwrite each other.
     '''
+    with file_lock(fname):
+        _update_json_file(fname, new_data, update_fn, pretty_print)
+
+
+def _update_json_file(fname, new_data, update_fn, pretty_print):
     # If file already exists, read existing data.
     try:
         with open(fname, 'r') as f:
@@ -43,7 +74,18 @@ def update_json_file(fname, new_data, update_fn=None, pretty_print=True):
         data = update_fn(data, new_data)
 
     # Print to file
-    with open(tempfile.NamedTemporaryFile().name, 'w') as f:
+    write_json_file(fname, data, pretty_print=pretty_print)
+
+
+def write_json_file(fname, data, pretty_print=True):
+    '''
+    Overwrite a JSON file with `data`, without reading the old contents.
+    Atomic file swap, so that if we crash, we will still have the old file.
+    '''
+    # Temp file alongside, so the swap is on one filesystem.
+    with tempfile.NamedTemporaryFile(
+            'w', dir=os.path.dirname(os.path.abspath(fname)),
+            delete=False) as f:
         logger.debug('Writing new data to tempfile: %s' % f.name)
         if pretty_print:
             f.write(json.dumps(data, indent=4, separators=(',', ': ')))
@@ -58,3 +100,20 @@ def update_json_file(fname, new_data, update_fn=None, pretty_print=True):
             })
         )
         os.replace(f.name, fname)
+
+
+def replace_dir(tmp_path, path):
+    '''
+    Swap directory `tmp_path` in for `path`, removing what was there.
+    Directories can't be replaced while they have files, so the old one is
+    moved aside first; only between the two renames is there nothing at
+    `path`.
+    '''
+    old_path = path.rstrip(os.sep) + '.old'
+    shutil.rmtree(old_path, ignore_errors=True)
+    try:
+        os.replace(path, old_path)
+    except FileNotFoundError:
+        pass
+    os.replace(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
@@ -0,0 +1,119 @@
+'''
+Plan a crawl before spending quota on it.
+
+Rather than find out a search is over the API limit by downloading its first
+page and throwing it away, probe each key with a `limit=1` request, which
+costs a request but downloads one business, to get its total. Keys over
+`max_fetch_limit` are split, as the fetcher would (see `Fetcher.split_key`),
+and their children probed, until every key left can be paged through.
+
+Plan format:
+    location: the search location
+    totals: {<key to fetch>: <total results>}
+    split: keys split into smaller searches
+    unfetchable: keys over the limit that can't be split any further
+    pending: children of split keys whose probe failed, or that weren't
+        probed before the quota ran out, for the crawl to fetch as usual
+    probes: number of probe requests made
+    pages: number of page requests the crawl will need
+
+To plan a crawl of the incomplete keys in the progress file, then run it:
+    python -m yelp.planner
+    python fetch_yelp_data.py yelp/crawl_plan.json
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import math
+
+from . import geo
+from . import persist
+from .settings import CRAWL_PLAN_PATH
+from .yelp import YELP_REQUEST_FETCH_LIMIT, Fetcher
+
+logger = logging.getLogger(__name__)
+
+
+def probe(fetcher, key):
+    '''Total results for a key, or None if the request failed.'''
+    params = {'term': '', 'offset': 0, 'limit': 1}
+    params.update(geo.search_params(key, fetcher.location))
+    response_json = fetcher.request(params)
+    if response_json is None or response_json.get('error') is not None:
+        logger.error('Probe of %s failed: %s' % (key, response_json))
+        return None
+    return response_json['total']
+
+
+def pages_needed(total, page_size=YELP_REQUEST_FETCH_LIMIT):
+    return math.ceil(total / page_size)
+
+
+def make_plan(fetcher, keys=None):
+    '''
+    Probe `keys` (by default, the fetcher's incomplete keys), splitting any
+    over the fetcher's `max_fetch_limit`, level by level.
+    Keys whose probe fails, or that aren't probed because the quota ran
+    out, are left for the crawl to handle as usual: the given keys stay
+    incomplete in progress, and children of split keys are `pending`.
+    '''
+    if keys is None:
+        keys = fetcher.get_incomplete_categories()
+    plan = {
+        'location': fetcher.location,
+        'totals': {},
+        'split': [],
+        'unfetchable': [],
+        'pending': [],
+        'probes': 0,
+    }
+    seen = set(keys)
+    frontier = list(keys)
+    with ThreadPoolExecutor(max_workers=fetcher.concurrency) as executor:
+        while frontier and not fetcher.quota_exceeded.is_set():
+            totals = list(executor.map(
+                lambda key: probe(fetcher, key), frontier))
+            plan['probes'] += len(frontier)
+            next_frontier = []
+            for key, total in zip(frontier, totals):
+                if total is None:
+                    if key not in keys:
+                        plan['pending'].append(key)
+                    continue
+                if total <= fetcher.max_fetch_limit:
+                    plan['totals'][key] = total
+                    continue
+                children = fetcher.split_key(key, total)
+                if not children:
+                    plan['unfetchable'].append(key)
+                    continue
+                plan['split'].append(key)
+                for child in children:
+                    if child not in seen:
+                        seen.add(child)
+                        next_frontier.append(child)
+            frontier = next_frontier
+    # Split keys' children left unprobed when the quota ran out.
+    plan['pending'].extend(key for key in frontier if key not in keys)
+
+    plan['pages'] = sum(pages_needed(t) for t in plan['totals'].values())
+    print("plan: %d probes; %d keys to fetch in %d page requests; "
+          "%d split, %d unfetchable, %d pending" % (
+              plan['probes'], len(plan['totals']), plan['pages'],
+              len(plan['split']), len(plan['unfetchable']),
+              len(plan['pending'])))
+    return plan
+
+
+def save_plan(plan, path=CRAWL_PLAN_PATH):
+    persist.write_json_file(path, plan)
+
+
+def load_plan(path=CRAWL_PLAN_PATH):
+    with open(path, 'r') as f:
+        return json.loads(f.read())
+
+
+if __name__ == '__main__':
+    save_plan(make_plan(Fetcher()))
@@ -0,0 +1,171 @@
+'''
+Compact binary format for heatmap points, as a smaller and faster to parse
+alternative to a JSON array of `[lat, lng, value]`.
+
+Layout (little-endian):
+    header:
+        magic: 4 bytes, b'CPPT'
+        version: uint8
+        value type: uint8, one of `VALUE_TYPES`
+        reserved: uint16
+        count: uint32
+        origin lat, origin lng: float64
+        scale: float64, quantization steps per degree
+    lat deltas: int32[count]
+    lng deltas: int32[count]
+    values: <value type>[count]
+
+Coordinates are quantized to `round((x - origin) * scale)`, and each point is
+stored as the delta from the previous one, with points sorted by latitude
+then longitude so the deltas stay small. Null values are stored as float32
+NaN. Points without coordinates are dropped.
+
+Alongside `<name>.bin`, precompressed `<name>.bin.gz` (and `<name>.bin.br` if
+the `brotli` package is installed) are written, to serve as-is.
+'''
+
+from array import array
+import gzip
+import os
+import struct
+
+import numpy as np
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MAGIC = b'CPPT'
+VERSION = 1
+HEADER = struct.Struct('<4sBBHIddd')
+
+NAN = float('nan')
+
+# About 10cm.
+DEFAULT_SCALE = 1e6
+
+VALUE_TYPES = {
+    0: np.dtype('<u1'),
+    1: np.dtype('<i4'),
+    2: np.dtype('<f4'),
+}
+
+
+def _value_type(values, nulls):
+    '''Smallest type code that represents `values` exactly.'''
+    if nulls.any() or not np.all(np.mod(values, 1) == 0):
+        return 2
+    if len(values) == 0 or (values.min() >= 0 and values.max() <= 255):
+        return 0
+    if values.min() >= -2 ** 31 and values.max() < 2 ** 31:
+        return 1
+    return 2
+
+
+def encode_points(lat, lng, values, nulls=None, scale=DEFAULT_SCALE):
+    '''Encode parallel arrays of points to bytes.'''
+    lat = np.asarray(lat, dtype=np.float64)
+    lng = np.asarray(lng, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    if nulls is None:
+        nulls = np.isnan(values)
+
+    placed = ~(np.isnan(lat) | np.isnan(lng))
+    lat, lng, values, nulls = lat[placed], lng[placed], values[placed], \
+        nulls[placed]
+    origin_lat = float(lat.min()) if len(lat) else 0.0
+    origin_lng = float(lng.min()) if len(lng) else 0.0
+    qlat = np.rint((lat - origin_lat) * scale).astype(np.int64)
+    qlng = np.rint((lng - origin_lng) * scale).astype(np.int64)
+    order = np.lexsort((qlng, qlat))
+    qlat, qlng = qlat[order], qlng[order]
+    values, nulls = values[order], nulls[order]
+
+    value_type = _value_type(values, nulls)
+    values = np.where(nulls, np.nan, values).astype(VALUE_TYPES[value_type])
+    header = HEADER.pack(
+        MAGIC, VERSION, value_type, 0, len(qlat),
+        origin_lat, origin_lng, scale)
+    return b''.join([
+        header,
+        np.diff(qlat, prepend=0).astype('<i4').tobytes(),
+        np.diff(qlng, prepend=0).astype('<i4').tobytes(),
+        values.tobytes(),
+    ])
+
+
+def encode_point_list(points, scale=DEFAULT_SCALE):
+    '''Encode `[lat, lng, value]` lists to bytes.'''
+    def column(i):
+        return np.array(
+            [np.nan if p[i] is None else p[i] for p in points],
+            dtype=np.float64)
+    nulls = np.array([p[2] is None for p in points], dtype=bool)
+    return encode_points(column(0), column(1), column(2), nulls, scale)
+
+
+def decode_points(data):
+    '''Decode bytes to `(lat, lng, values)` arrays. Null values are NaN.'''
+    magic, version, value_type, _, count, origin_lat, origin_lng, scale = \
+        HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Not a version %d point file' % VERSION)
+    offset = HEADER.size
+    dlat = np.frombuffer(data, '<i4', count, offset)
+    dlng = np.frombuffer(data, '<i4', count, offset + 4 * count)
+    values = np.frombuffer(
+        data, VALUE_TYPES[value_type], count, offset + 8 * count)
+    lat = origin_lat + np.cumsum(dlat, dtype=np.int64) / scale
+    lng = origin_lng + np.cumsum(dlng, dtype=np.int64) / scale
+    return lat, lng, values
+
+
+def _replace_file(path, data):
+    '''Write `data` alongside `path`, then swap it in.'''
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+
+
+def write_point_file(path, data):
+    '''
+    Write encoded points to `path`, plus precompressed variants. Each file
+    is swapped in whole, so readers never see half of one.
+    '''
+    _replace_file(path, data)
+    # mtime=0 so unchanged data gives byte-identical files.
+    _replace_file(path + '.gz', gzip.compress(data, compresslevel=9, mtime=0))
+    if brotli is not None:
+        _replace_file(path + '.br', brotli.compress(data))
+
+
+class PointFileWriter():
+    '''
+    Collect `[lat, lng, value]` points one at a time, like
+    `JSONArrayWriter`, and write them as a point file on `close()`.
+    Points are buffered in typed arrays, 25 bytes each, since the origin
+    and sort order of the file aren't known until every point is in.
+    '''
+
+    def __init__(self, path, scale=DEFAULT_SCALE):
+        self.path = path
+        self.scale = scale
+        self.lat = array('d')
+        self.lng = array('d')
+        self.values = array('d')
+        self.nulls = array('b')
+
+    def write(self, point):
+        lat, lng, value = point
+        self.lat.append(NAN if lat is None else lat)
+        self.lng.append(NAN if lng is None else lng)
+        self.values.append(NAN if value is None else value)
+        self.nulls.append(value is None)
+
+    def close(self):
+        write_point_file(self.path, encode_points(
+            np.frombuffer(self.lat), np.frombuffer(self.lng),
+            np.frombuffer(self.values),
+            np.frombuffer(self.nulls, dtype=np.int8).astype(bool),
+            self.scale))
@@ -7,12 +7,31 @@ by the download limit.
 import json
 import logging
 import os
+import threading
 
 from . import persist
 from . import util
+from .metrics import NULL_METRICS
 
 logger = logging.getLogger(__name__)
 
+# In log mode, compact the write-ahead log into the snapshot file once it
+# holds this many records.
+LOG_COMPACT_THRESHOLD = 1000
+
+
+def _ends_line(path):
+    '''Whether file `path` is missing, empty or ends with a newline.'''
+    try:
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() == 0:
+                return True
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+    except FileNotFoundError:
+        return True
+
 
 class ProgressStatus:
     INCOMPLETE = 1
@@ -30,23 +49,55 @@ class ProgressMeter():
     limit.
     Save format:
         {<key>: <ProgressStatus>}
+
+    In log mode (`use_log=True`), the in-memory dict is the source of truth.
+    Each status change is appended to `<path>.log` as a `[<key>, <status>]`
+    JSON line (status `null` means deleted), and the log is periodically
+    compacted into the snapshot at `path` in a background thread. On startup
+    the snapshot is loaded and the log replayed over it, so existing progress
+    files load unchanged.
+
+    Keys that are partway through paginating also have a cursor, the
+    `[<next offset>, <total results>]` to resume at, saved the same way in
+    `<path>.cursors`. A key's cursor is cleared when it is marked complete or
+    wontfix.
     '''
     data = None
 
-    def __init__(self, path):
+    def __init__(self, path, use_log=False,
+                 compact_threshold=LOG_COMPACT_THRESHOLD,
+                 metrics=NULL_METRICS):
         '''
         Get a new ProgressMeter instance.
         If no path set, use the default path.
         If file does not exist, instantiate.
         '''
         self.path = path
+        self.use_log = use_log
+        self.log_path = path + '.log'
+        self.old_log_path = path + '.log.old'
+        self.compact_threshold = compact_threshold
+        self.metrics = metrics
+        self.cursors_path = path + '.cursors'
+        self._cursors = None
+        self._lock = threading.RLock()
+        self._log_file = None
+        self._log_records = 0
+        self._compaction = None
         try:
             self.get_data()
         except FileNotFoundError:
             self.destructive_reset([])
+        # A leftover rotated log means a previous compaction didn't finish.
+        if self.use_log and os.path.exists(self.old_log_path):
+            self.compact(block=True)
 
     def refresh_data(self):
         '''Update cache'''
+        if self.use_log:
+            with self._lock:
+                self.data = self._replay()
+            return
         with open(self.path, 'r') as f:
             self.data = json.loads(f.read()) or {}
 
@@ -75,6 +126,13 @@ class ProgressMeter():
     def is_wontfix(self, key):
         return self.get_value(key) == ProgressStatus.WONTFIX
 
+    def get_cursor(self, key):
+        '''Return `(offset, total)` to resume paginating `key` at, or None.'''
+        if not self._has_cursors():
+            return None
+        cursor = self.cursors.get_value(key)
+        return tuple(cursor) if cursor is not None else None
+
     # Write primitives
 
     def add_keys(self, keys):
@@ -88,7 +146,10 @@ class ProgressMeter():
         keys = list(set(keys).difference(set(old_keys)))
 
         # Update with default value=INCOMPLETE
-        persist.update_json_file(
+        if self.use_log:
+            self._append({k: ProgressStatus.INCOMPLETE for k in keys})
+            return
+        self._update_json_file(
             self.path,
             {k: ProgressStatus.INCOMPLETE for k in keys}
         )
@@ -96,30 +157,203 @@ class ProgressMeter():
 
     def mark_complete(self, key):
         '''Mark a key's value as complete.'''
-        persist.update_json_file(self.path, {key: ProgressStatus.COMPLETE})
+        self._set_value(key, ProgressStatus.COMPLETE)
+        self.clear_cursor(key)
         logger.debug("%s - COMPLETE" % key)
-        self.refresh_data()
 
     def mark_wontfix(self, key):
         '''Mark a key as wontfix so that we know not to try it again.'''
-        persist.update_json_file(self.path, {key: ProgressStatus.WONTFIX})
+        self._set_value(key, ProgressStatus.WONTFIX)
+        self.clear_cursor(key)
         logger.debug("%s - WONTFIX" % key)
-        self.refresh_data()
+
+    def split(self, key, new_keys):
+        '''
+        Replace `key` by `new_keys`, marking it wontfix. The new keys are
+        added first, so a crash in between leaves `key` to be split again.
+        '''
+        self.add_keys(new_keys)
+        self.mark_wontfix(key)
+
+    def set_cursor(self, key, offset, total):
+        '''Save where to resume paginating `key`.'''
+        self.cursors._set_value(key, [offset, total])
+
+    def clear_cursor(self, key):
+        if self.get_cursor(key) is not None:
+            self.cursors.delete_key(key)
 
     def delete_key(self, key):
         '''Remove a key-value pair from the store.'''
+        if self.use_log:
+            self._append({key: None})
+            logger.debug("%s - DELETED KEY" % key)
+            return
+
         def del_fn(data, new_data):
             del data[key]
-        persist.update_json_file(self.path, {}, update_fn=del_fn)
-        logger.debug("%s - DELETED KEY")
+        self._update_json_file(self.path, {}, update_fn=del_fn)
+        logger.debug("%s - DELETED KEY" % key)
         self.refresh_data()
 
-    # Other write functions
+    def _set_value(self, key, value):
+        if self.use_log:
+            self._append({key: value})
+            return
+        self._update_json_file(self.path, {key: value})
+        self.refresh_data()
 
-    def destructive_reset(self, keys):
-        '''Destroy savefile and recreate with new keys.'''
+    def _update_json_file(self, *args, **kwargs):
+        with self.metrics.time('yelp_progress_write_seconds', mode='json'):
+            persist.update_json_file(*args, **kwargs)
+
+    def _has_cursors(self):
+        '''Whether there are any saved cursors, without creating the file.'''
+        return self._cursors is not None or any(
+            os.path.exists(p) for p in (
+                self.cursors_path, self.cursors_path + '.log',
+                self.cursors_path + '.log.old'))
+
+    @property
+    def cursors(self):
+        '''Pagination cursors, as a progress meter of their own.'''
+        with self._lock:
+            if self._cursors is None:
+                self._cursors = ProgressMeter(
+                    self.cursors_path, use_log=self.use_log,
+                    compact_threshold=self.compact_threshold,
+                    metrics=self.metrics)
+            return self._cursors
+
+    # Log mode
+
+    def _replay(self):
+        '''Load the snapshot, then replay rotated and current logs over it.'''
+        try:
+            with open(self.path, 'r') as f:
+                data = json.loads(f.read()) or {}
+        except FileNotFoundError:
+            data = {}
+        self._log_records = 0
+        for log_path in (self.old_log_path, self.log_path):
+            try:
+                f = open(log_path, 'r')
+            except FileNotFoundError:
+                continue
+            with f:
+                for line in f:
+                    try:
+                        key, value = json.loads(line)
+                    except ValueError:
+                        # A write torn by a crash. Writes made after a
+                        # restart follow it, so skip just this line.
+                        logger.warning(
+                            'Skipping unparseable progress log line in %s'
+                            % log_path)
+                        continue
+                    self._apply(data, key, value)
+                    if log_path == self.log_path:
+                        self._log_records += 1
+        return data
+
+    @staticmethod
+    def _apply(data, key, value):
+        if value is None:
+            data.pop(key, None)
+        else:
+            data[key] = value
+
+    def _append(self, updates):
+        '''Apply `updates` in memory and append them to the log.'''
+        if not updates:
+            return
+        with self._lock, self.metrics.time(
+                'yelp_progress_write_seconds', mode='log'):
+            data = self.get_data()
+            if self._log_file is None:
+                torn = not _ends_line(self.log_path)
+                self._log_file = open(self.log_path, 'a')
+                if torn:
+                    # End a write torn by a crash, so it doesn't swallow
+                    # the next one.
+                    self._log_file.write('\n')
+            for key, value in updates.items():
+                self._apply(data, key, value)
+                self._log_file.write(json.dumps([key, value]) + '\n')
+            self._log_file.flush()
+            self._log_records += len(updates)
+            if self._log_records >= self.compact_threshold:
+                self.compact()
+
+    def compact(self, block=False):
+        '''
+        Fold the log into the snapshot file.
+        The current log is rotated aside under the lock, so appends can carry
+        on into a fresh log while the snapshot is written.
+        '''
+        with self._lock:
+            if self._compaction is not None and self._compaction.is_alive():
+                if not block:
+                    return
+                self._compaction.join()
+            if self._log_file is not None:
+                self._log_file.close()
+                self._log_file = None
+            if os.path.exists(self.log_path):
+                if os.path.exists(self.old_log_path):
+                    # Unfinished compaction: its log isn't in the snapshot
+                    # yet, so fold both logs into the next rotated one.
+                    with open(self.old_log_path, 'a') as old, \
+                            open(self.log_path, 'r') as cur:
+                        old.write(cur.read())
+                    os.remove(self.log_path)
+                else:
+                    os.replace(self.log_path, self.old_log_path)
+            snapshot = dict(self.get_data())
+            self._log_records = 0
+            self._compaction = threading.Thread(
+                target=self._write_snapshot, args=(snapshot,))
+            self._compaction.start()
+            if block:
+                self._compaction.join()
+
+    def _write_snapshot(self, snapshot):
+        with self.metrics.time('yelp_progress_write_seconds', mode='snapshot'):
+            persist.write_json_file(self.path, snapshot)
         try:
-            os.remove(self.path)
+            os.remove(self.old_log_path)
         except FileNotFoundError:
             pass
+        logger.debug('Compacted progress log into %s' % self.path)
+
+    def close(self):
+        '''Wait for any background compaction and close the log.'''
+        with self._lock:
+            if self._compaction is not None:
+                self._compaction.join()
+            if self._log_file is not None:
+                self._log_file.close()
+                self._log_file = None
+            if self._cursors is not None:
+                self._cursors.close()
+
+    # Other write functions
+
+    def destructive_reset(self, keys):
+        '''Destroy savefile and recreate with new keys.'''
+        if self.use_log:
+            self.close()
+            paths = (self.path, self.log_path, self.old_log_path)
+        else:
+            paths = (self.path,)
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.data = {}
+        if self.use_log:
+            persist.write_json_file(self.path, {})
+        if self._has_cursors():
+            self.cursors.destructive_reset([])
         self.add_keys(keys)
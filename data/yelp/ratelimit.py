@@ -0,0 +1,47 @@
+'''
+Client-side rate limiting for API requests.
+'''
+
+import threading
+import time
+
+
+class TokenBucket():
+    '''
+    Thread-safe token bucket.
+    Tokens refill continuously at `rate` per second, up to `capacity`, which
+    bounds how big a burst of requests can go out at once.
+    '''
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens=1):
+        '''Take tokens if available. Return whether we got them.'''
+        with self.lock:
+            self._refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens=1):
+        '''Block until tokens are available, then take them.'''
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
@@ -5,8 +5,53 @@ from . import util
 # Local storage
 PROGRESS_PATH = util.localize_path('businesses_search_progress.json')
 SEARCH_API_DATA_PATH = util.localize_path('businesses_search.json')
+BUSINESS_STORE_PATH = util.localize_path('businesses.sqlite3')
+RAW_ARCHIVE_PATH = util.localize_path('businesses_archive')
+SNAPSHOTS_PATH = util.localize_path('snapshots.sqlite3')
+COLUMNAR_DATA_PATH = util.localize_path('businesses_columnar')
+RESPONSE_CACHE_PATH = util.localize_path('response_cache')
+TRANSFORM_STATE_PATH = util.localize_path('transform_state.sqlite3')
+CRAWL_PLAN_PATH = util.localize_path('crawl_plan.json')
+CRAWL_QUEUE_PATH = util.localize_path('crawl_queue.sqlite3')
+CITY_STORES_PATH = util.localize_path('businesses_by_city')
+
+# Search region
+SEARCH_LOCATION = 'San Francisco'
+# (south, west, north, east), for splitting searches into geo cells.
+SEARCH_BOUNDS = (37.708, -122.52, 37.816, -122.35)
+
+# Locations for a multi-city crawl (see `crawl.py`), with their search bounds,
+# or None if unknown, in which case searches are only split by category.
+SEARCH_LOCATIONS = {
+    SEARCH_LOCATION: SEARCH_BOUNDS,
+    'Oakland': (37.699, -122.355, 37.885, -122.114),
+}
 
 # Yelp API auth
 YELP_APP_ID = 'JIHiA3VnvdRPHoeZRKfBCA'
 YELP_API_SECRET = os.environ.get("YELP_API_SECRET", None)
 YELP_AUTH_HEADER = {'Authorization': 'Bearer %s' % YELP_API_SECRET}
+
+# Fetcher concurrency
+FETCH_CONCURRENCY = int(os.environ.get('YELP_FETCH_CONCURRENCY', 4))
+YELP_MAX_QPS = 5  # Stay under Yelp's per-second request limit
+# Worker processes for a multi-city crawl. They share `YELP_MAX_QPS`.
+CRAWL_WORKERS = int(os.environ.get('YELP_CRAWL_WORKERS', 4))
+
+# Retries of transient API errors (5xx, per-second rate limiting, dropped
+# connections), with exponential backoff from `YELP_BACKOFF_BASE` seconds up
+# to `YELP_BACKOFF_MAX`, jittered.
+YELP_MAX_RETRIES = 5
+YELP_BACKOFF_BASE = 0.5
+YELP_BACKOFF_MAX = 30
+
+# API response cache: unset to disable, or one of record / replay / refresh.
+# See `cache.py`.
+YELP_CACHE_MODE = os.environ.get('YELP_CACHE_MODE', None)
+YELP_CACHE_TTL = 7 * 24 * 60 * 60  # seconds
+YELP_CACHE_MAX_BYTES = 1024 ** 3
+
+# Fetcher metrics: set a path to export them there in the Prometheus text
+# format every interval. See `metrics.py`.
+YELP_METRICS_PATH = os.environ.get('YELP_METRICS_PATH', None)
+YELP_METRICS_INTERVAL = 15  # seconds
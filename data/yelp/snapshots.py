@@ -0,0 +1,339 @@
+'''
+Versioned snapshots of the business store, to study how a city changes from
+crawl to crawl (openings, closures, rating drift) without keeping a full copy
+of every crawl.
+
+A snapshot is stored either in full, as a base, or as a delta against the
+latest base: only the businesses added, changed or removed since then. Once a
+delta would hold more than `REBASE_FRACTION` of its base, a new base is
+stored instead. Entries are kept in business ID order, so snapshots are read
+and diffed by merge-joining sorted streams, never by loading whole datasets
+into memory.
+
+Save format, in SQLite:
+    snapshots: id, base (ID of the base snapshot, or NULL for a base), label,
+        creation time, the store's `last_seq()` when taken, and the number of
+        businesses
+    entries: (snapshot, business ID) -> fingerprint, and JSON data or NULL
+        for a business removed since the base; clustered on business ID
+
+Snapshots are taken by the fetcher at the end of a complete crawl, or:
+    python -m yelp.snapshots take [label]
+    python -m yelp.snapshots list
+    python -m yelp.snapshots diff <old snapshot> <new snapshot>
+'''
+
+from collections import Counter
+import json
+import sqlite3
+import sys
+import time
+
+from .settings import BUSINESS_STORE_PATH, SNAPSHOTS_PATH
+from .store import SQLITE_MAX_VARIABLES, BusinessStore
+
+# A delta bigger than this fraction of its base is stored as a new base.
+REBASE_FRACTION = 0.5
+
+# Entries read or written per query.
+BATCH_SIZE = 1000
+
+ADDED = 'added'
+REMOVED = 'removed'
+CHANGED = 'changed'
+
+
+def merge_join(old, new):
+    '''
+    Merge-join two streams of tuples sorted on their first item, an ID.
+    Yield `(id, old tuple or None, new tuple or None)`.
+    '''
+    old = iter(old)
+    new = iter(new)
+    a = next(old, None)
+    b = next(new, None)
+    while a is not None or b is not None:
+        if b is None or (a is not None and a[0] < b[0]):
+            yield a[0], a, None
+            a = next(old, None)
+        elif a is None or b[0] < a[0]:
+            yield b[0], None, b
+            b = next(new, None)
+        else:
+            yield a[0], a, b
+            a = next(old, None)
+            b = next(new, None)
+
+
+def change_type(old, new):
+    '''`ADDED`, `REMOVED`, `CHANGED`, or None, for two `(id, fp, ...)`.'''
+    if old is None:
+        return ADDED if new is not None else None
+    if new is None:
+        return REMOVED
+    return CHANGED if old[1] != new[1] else None
+
+
+class SnapshotStore():
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS snapshots ('
+            'id INTEGER PRIMARY KEY, base INTEGER, label TEXT, '
+            'created REAL NOT NULL, seq INTEGER NOT NULL, size INTEGER)')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            'snapshot INTEGER NOT NULL, id TEXT NOT NULL, '
+            'fingerprint INTEGER NOT NULL, data TEXT, '
+            'PRIMARY KEY (snapshot, id)) WITHOUT ROWID')
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    # Read-only
+
+    def _select(self, where='', params=()):
+        cursor = self.conn.execute(
+            'SELECT id, base, label, created, seq, size FROM snapshots %s '
+            'ORDER BY id' % where, params)
+        names = [d[0] for d in cursor.description]
+        return [dict(zip(names, row)) for row in cursor]
+
+    def snapshots(self):
+        '''All snapshots, oldest first, as dicts.'''
+        return self._select()
+
+    def get_snapshot(self, snapshot):
+        rows = self._select('WHERE id = ?', (snapshot,))
+        if not rows:
+            raise KeyError('No snapshot %s' % snapshot)
+        return rows[0]
+
+    def latest(self):
+        '''The latest snapshot, or None if there aren't any.'''
+        rows = self._select('WHERE id = (SELECT MAX(id) FROM snapshots)')
+        return rows[0] if rows else None
+
+    def _entries(self, snapshot, ids=None):
+        '''
+        Yield a snapshot's own `(id, fingerprint, data)` entries, in ID
+        order, a batch at a time, so no cursor is held open between batches.
+        With `ids`, only those entries.
+        '''
+        if ids is not None:
+            ids = sorted(ids)
+            for i in range(0, len(ids), SQLITE_MAX_VARIABLES):
+                chunk = ids[i:i + SQLITE_MAX_VARIABLES]
+                yield from self.conn.execute(
+                    'SELECT id, fingerprint, data FROM entries '
+                    'WHERE snapshot = ? AND id IN (%s) ORDER BY id' %
+                    ','.join('?' * len(chunk)),
+                    [snapshot] + chunk).fetchall()
+            return
+        last = ''
+        while True:
+            rows = self.conn.execute(
+                'SELECT id, fingerprint, data FROM entries '
+                'WHERE snapshot = ? AND id > ? ORDER BY id LIMIT ?',
+                (snapshot, last, BATCH_SIZE)).fetchall()
+            yield from rows
+            if len(rows) < BATCH_SIZE:
+                return
+            last = rows[-1][0]
+
+    def rows(self, snapshot, ids=None):
+        '''
+        Yield `(id, fingerprint, data)` for the businesses in a snapshot, in
+        ID order, with `data` left as JSON. With `ids`, only those businesses.
+        '''
+        info = self.get_snapshot(snapshot)
+        if info['base'] is None:
+            yield from self._entries(snapshot, ids)
+            return
+        for id, base_row, delta_row in merge_join(
+                self._entries(info['base'], ids),
+                self._entries(snapshot, ids)):
+            row = delta_row or base_row
+            if row[2] is not None:
+                yield row
+
+    def items(self, snapshot):
+        '''Yield `(id, business)` for the businesses in a snapshot.'''
+        for id, fp, data in self.rows(snapshot):
+            yield id, json.loads(data)
+
+    def _changed_ids(self, old, new):
+        '''
+        IDs that may differ between two snapshots, or None if they don't
+        share a base, in which case any ID may.
+        '''
+        def base_of(info):
+            return info['base'] if info['base'] is not None else info['id']
+        if base_of(old) != base_of(new):
+            return None
+        deltas = [info['id'] for info in (old, new)
+                  if info['base'] is not None]
+        return set(
+            row[0] for row in self.conn.execute(
+                'SELECT id FROM entries WHERE snapshot IN (%s)' %
+                ','.join('?' * len(deltas)),
+                deltas)
+        ) if deltas else set()
+
+    def diff(self, old, new):
+        '''
+        Yield `(id, change, old business, new business)` for businesses
+        added, removed or changed from snapshot `old` to `new`, in ID order,
+        where `change` is `ADDED`, `REMOVED` or `CHANGED`, and the business
+        missing from either side is None.
+        Snapshots of the same base are only compared on the IDs in their
+        deltas.
+        '''
+        ids = self._changed_ids(
+            self.get_snapshot(old), self.get_snapshot(new))
+        for id, a, b in merge_join(
+                self.rows(old, ids), self.rows(new, ids)):
+            change = change_type(a, b)
+            if change is None:
+                continue
+            yield (id, change,
+                   json.loads(a[2]) if a is not None else None,
+                   json.loads(b[2]) if b is not None else None)
+
+    def diff_counts(self, old, new):
+        '''Number of businesses by change, from snapshot `old` to `new`.'''
+        return Counter(change for id, change, a, b in self.diff(old, new))
+
+    # Write
+
+    def take(self, store, label=None):
+        '''
+        Snapshot a `BusinessStore`, as a delta against the latest base when
+        that's small enough. Returns the new snapshot's ID.
+        '''
+        latest = self.latest()
+        base = None
+        if latest is not None:
+            base = self.get_snapshot(
+                latest['base'] if latest['base'] is not None
+                else latest['id'])
+        with self.conn:
+            snapshot = self.conn.execute(
+                'INSERT INTO snapshots (base, label, created, seq) '
+                'VALUES (?, ?, ?, ?)',
+                (base['id'] if base is not None else None, label,
+                 time.time(), store.last_seq())
+            ).lastrowid
+            if base is None or not self._write_delta(snapshot, base, store):
+                self.conn.execute(
+                    'DELETE FROM entries WHERE snapshot = ?', (snapshot,))
+                self.conn.execute(
+                    'UPDATE snapshots SET base = NULL WHERE id = ?',
+                    (snapshot,))
+                self._write_entries(snapshot, store.rows())
+            self.conn.execute(
+                'UPDATE snapshots SET size = ? WHERE id = ?',
+                (len(store), snapshot))
+        return snapshot
+
+    def _write_entries(self, snapshot, rows):
+        batch = []
+        for row in rows:
+            batch.append((snapshot,) + tuple(row))
+            if len(batch) == BATCH_SIZE:
+                self._insert(batch)
+                batch = []
+        self._insert(batch)
+
+    def _insert(self, batch):
+        self.conn.executemany(
+            'INSERT INTO entries (snapshot, id, fingerprint, data) '
+            'VALUES (?, ?, ?, ?)', batch)
+
+    def _write_delta(self, snapshot, base, store):
+        '''
+        Write the changes from `base` to `store` as `snapshot`'s entries.
+        Returns False, part way through, if there are too many for a delta.
+        '''
+        max_entries = REBASE_FRACTION * base['size']
+        n_entries = 0
+
+        def iter_delta():
+            nonlocal n_entries
+            for id, a, b in merge_join(
+                    self._entries(base['id']), store.rows()):
+                change = change_type(a, b)
+                if change is None:
+                    continue
+                n_entries += 1
+                if n_entries > max_entries:
+                    return
+                yield (id, a[1], None) if change == REMOVED else b
+
+        self._write_entries(snapshot, iter_delta())
+        return n_entries <= max_entries
+
+
+def iter_change_businesses(changes):
+    '''
+    Turn a `SnapshotStore.diff` into businesses for change heatmap layers:
+    the new version of each added or changed business, or the old version of
+    a removed one, with
+        opened: 1 if it was added
+        closed: 1 if it was removed
+        rating_change: its change in rating, if any
+    '''
+    for id, change, old, new in changes:
+        biz = dict(new if new is not None else old)
+        if change == ADDED:
+            biz['opened'] = 1
+        elif change == REMOVED:
+            biz['closed'] = 1
+        elif old.get('rating') is not None and \
+                new.get('rating') is not None and \
+                old['rating'] != new['rating']:
+            biz['rating_change'] = new['rating'] - old['rating']
+        yield id, biz
+
+
+def take_snapshot(label=None, path=SNAPSHOTS_PATH,
+                  store_path=BUSINESS_STORE_PATH):
+    '''
+    Snapshot the business store, unless it hasn't changed since the latest
+    snapshot. Returns the snapshot's ID.
+    '''
+    snapshots = SnapshotStore(path)
+    store = BusinessStore(store_path)
+    try:
+        latest = snapshots.latest()
+        if latest is not None and latest['seq'] == store.last_seq():
+            return latest['id']
+        return snapshots.take(store, label)
+    finally:
+        store.close()
+        snapshots.close()
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'list'
+    if command == 'take':
+        print(take_snapshot(sys.argv[2] if len(sys.argv) > 2 else None))
+    elif command == 'diff':
+        snapshots = SnapshotStore(SNAPSHOTS_PATH)
+        old, new = int(sys.argv[2]), int(sys.argv[3])
+        counts = Counter()
+        for id, change, a, b in snapshots.diff(old, new):
+            counts[change] += 1
+            print('%s\t%s' % (change, id))
+        print(dict(counts))
+        snapshots.close()
+    else:
+        snapshots = SnapshotStore(SNAPSHOTS_PATH)
+        for info in snapshots.snapshots():
+            print('%(id)d\t%(label)s\tbase=%(base)s\tsize=%(size)s\t'
+                  'seq=%(seq)d' % info)
+        snapshots.close()
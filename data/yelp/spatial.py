@@ -0,0 +1,160 @@
+'''
+Uniform grid spatial index over business coordinates, for bounding box,
+radius and nearest neighbour queries that don't scan every business.
+
+Rows (indices into the columnar dataset, see `columnar.py`) are sorted by
+grid cell, with cells numbered row-major from the south-west corner, so the
+rows of a horizontal run of cells are one contiguous slice. Only cells with
+rows are stored, as a sorted array of cell numbers that queries binary
+search, so the index stays small however far apart the businesses are, e.g.
+for stores of several cities, or with a bogus coordinate at (0, 0).
+'''
+
+import json
+import math
+import os
+
+import numpy as np
+
+from .geo import EARTH_RADIUS_METERS
+
+# About 500m north-south.
+DEFAULT_CELL_SIZE = 0.005  # degrees
+
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS_METERS / 180
+
+
+def haversine_array(lat, lng, lats, lngs):
+    '''Distances in meters from one point to arrays of points.'''
+    lat, lng = math.radians(lat), math.radians(lng)
+    lats, lngs = np.radians(lats), np.radians(lngs)
+    a = (np.sin((lats - lat) / 2) ** 2 +
+         math.cos(lat) * np.cos(lats) * np.sin((lngs - lng) / 2) ** 2)
+    return 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(a))
+
+
+class GridIndex():
+
+    def __init__(self, lat, lng, rows, cells, offsets, south, west,
+                 cell_size, n_cols, n_rows):
+        self.lat = lat  # Coordinates, by dataset row
+        self.lng = lng
+        self.rows = rows  # Dataset rows, sorted by cell
+        self.cells = cells  # Sorted numbers of the cells with rows
+        # Cell cells[i] holds rows[offsets[i]:offsets[i + 1]]
+        self.offsets = offsets
+        self.south = south
+        self.west = west
+        self.cell_size = cell_size
+        self.n_cols = n_cols
+        self.n_rows = n_rows
+
+    @classmethod
+    def build(cls, lat, lng, cell_size=DEFAULT_CELL_SIZE):
+        '''Index coordinate arrays. Rows with NaN coordinates are skipped.'''
+        lat = np.asarray(lat, dtype=np.float64)
+        lng = np.asarray(lng, dtype=np.float64)
+        rows = np.flatnonzero(~(np.isnan(lat) | np.isnan(lng)))
+        if len(rows):
+            south, west = lat[rows].min(), lng[rows].min()
+            n_rows = int((lat[rows].max() - south) // cell_size) + 1
+            n_cols = int((lng[rows].max() - west) // cell_size) + 1
+        else:
+            south = west = 0.0
+            n_rows = n_cols = 1
+        index = cls(lat, lng, rows, None, None, south, west, cell_size,
+                    n_cols, n_rows)
+        cells = index._cell_ids(lat[rows], lng[rows])
+        order = np.argsort(cells, kind='stable')
+        index.rows = rows[order]
+        index.cells, counts = np.unique(cells, return_counts=True)
+        index.offsets = np.concatenate([[0], np.cumsum(counts)])
+        return index
+
+    def _cell_ids(self, lat, lng):
+        iy = ((lat - self.south) // self.cell_size).astype(np.int64)
+        ix = ((lng - self.west) // self.cell_size).astype(np.int64)
+        return iy * self.n_cols + ix
+
+    def _clamp(self, value, n):
+        return min(max(int(value), 0), n - 1)
+
+    def bbox(self, south, west, north, east):
+        '''Sorted rows with coordinates inside the box, inclusive.'''
+        if north < self.south or east < self.west:
+            return np.zeros(0, dtype=np.int64)
+        iy0 = self._clamp((south - self.south) // self.cell_size, self.n_rows)
+        iy1 = self._clamp((north - self.south) // self.cell_size, self.n_rows)
+        ix0 = self._clamp((west - self.west) // self.cell_size, self.n_cols)
+        ix1 = self._clamp((east - self.west) // self.cell_size, self.n_cols)
+        # Each row of cells in the box is a run of cell numbers.
+        starts = np.arange(iy0, iy1 + 1, dtype=np.int64) * self.n_cols
+        lo = np.searchsorted(self.cells, starts + ix0, 'left')
+        hi = np.searchsorted(self.cells, starts + ix1, 'right')
+        candidates = [
+            self.rows[self.offsets[i]:self.offsets[j]]
+            for i, j in zip(lo.tolist(), hi.tolist()) if i < j
+        ]
+        if not candidates:
+            return np.zeros(0, dtype=np.int64)
+        candidates = np.concatenate(candidates)
+        lat, lng = self.lat[candidates], self.lng[candidates]
+        inside = ((lat >= south) & (lat <= north) &
+                  (lng >= west) & (lng <= east))
+        return np.sort(candidates[inside])
+
+    def radius(self, lat, lng, meters):
+        '''Sorted rows within `meters` of a point.'''
+        dlat = meters / METERS_PER_DEGREE
+        dlng = dlat / max(math.cos(math.radians(lat)), 1e-6)
+        candidates = self.bbox(lat - dlat, lng - dlng, lat + dlat, lng + dlng)
+        distances = haversine_array(
+            lat, lng, self.lat[candidates], self.lng[candidates])
+        return candidates[distances <= meters]
+
+    def nearest(self, lat, lng, k):
+        '''The `k` rows nearest a point, nearest first.'''
+        n = len(self.rows)
+        k = min(k, n)
+        if k == 0:
+            return np.zeros(0, dtype=np.int64)
+        # Grow the search radius until it holds k rows; anything outside it
+        # is further away than all of those.
+        meters = self.cell_size * METERS_PER_DEGREE
+        while True:
+            candidates = self.radius(lat, lng, meters)
+            if len(candidates) >= k or len(candidates) == n:
+                break
+            meters *= 2
+        distances = haversine_array(
+            lat, lng, self.lat[candidates], self.lng[candidates])
+        order = np.argsort(distances, kind='stable')[:k]
+        return candidates[order]
+
+    # Persistence
+
+    def save(self, path):
+        '''Save to directory `path`, e.g. alongside a columnar dataset.'''
+        np.save(os.path.join(path, 'spatial_rows.npy'), self.rows)
+        np.save(os.path.join(path, 'spatial_cells.npy'), self.cells)
+        np.save(os.path.join(path, 'spatial_offsets.npy'), self.offsets)
+        with open(os.path.join(path, 'spatial.json'), 'w') as f:
+            f.write(json.dumps({
+                'south': float(self.south),
+                'west': float(self.west),
+                'cell_size': self.cell_size,
+                'n_cols': self.n_cols,
+                'n_rows': self.n_rows,
+            }))
+
+    @classmethod
+    def load(cls, path, lat, lng):
+        '''Memory-map an index saved to `path`, over coordinate arrays.'''
+        with open(os.path.join(path, 'spatial.json'), 'r') as f:
+            meta = json.loads(f.read())
+        return cls(
+            lat, lng,
+            np.load(os.path.join(path, 'spatial_rows.npy'), mmap_mode='r'),
+            np.load(os.path.join(path, 'spatial_cells.npy'), mmap_mode='r'),
+            np.load(os.path.join(path, 'spatial_offsets.npy'), mmap_mode='r'),
+            **meta)
@@ -0,0 +1,338 @@
+'''
+Indexed local store of Yelp businesses, keyed on unique Yelp business ID.
+
+Backed by SQLite, so upserting a page of search results only touches the rows
+in that page instead of rewriting the whole dataset.
+
+To import an existing `businesses_search.json`:
+    python -m yelp.store
+'''
+
+import hashlib
+import json
+import logging
+import sqlite3
+import sys
+
+from .settings import BUSINESS_STORE_PATH, SEARCH_API_DATA_PATH
+
+logger = logging.getLogger(__name__)
+
+# Max number of bound parameters per `IN (...)` query.
+SQLITE_MAX_VARIABLES = 500
+
+# The fields of a business that the transforms read, as
+# `{<field>: <subfields to keep, or None to keep it whole>}`. Categories are
+# kept by alias.
+HOT_FIELDS = {
+    'id': None,
+    'coordinates': ('latitude', 'longitude'),
+    'location': ('city',),
+    'price': None,
+    'rating': None,
+    'review_count': None,
+    'categories': ('alias',),
+}
+
+# Fields of a business that depend on the search it came from rather than on
+# the business, e.g. its distance from the search's center, which differs
+# between the geo cells of a split search.
+SEARCH_FIELDS = ('distance',)
+
+
+def fingerprint(biz):
+    '''
+    Compact content hash of a business, as a signed 64-bit int. Ignores
+    `SEARCH_FIELDS`, so a business found by two searches is unchanged.
+    '''
+    biz = {k: v for k, v in biz.items() if k not in SEARCH_FIELDS}
+    digest = hashlib.blake2b(
+        json.dumps(biz, sort_keys=True).encode('utf-8'), digest_size=8
+    ).digest()
+    return int.from_bytes(digest, 'little', signed=True)
+
+
+def trim_business(biz):
+    '''
+    The "hot" record of a business: only its `HOT_FIELDS`. The full
+    business goes to the raw archive (see `archive.py`).
+    '''
+    hot = {}
+    for field, subfields in HOT_FIELDS.items():
+        if field not in biz:
+            continue
+        value = biz[field]
+        if subfields is not None:
+            if isinstance(value, list):
+                value = [{k: v[k] for k in subfields if k in v}
+                         for v in value]
+            elif value is not None:
+                value = {k: value[k] for k in subfields if k in value}
+        hot[field] = value
+    return hot
+
+
+class BusinessStore():
+    '''
+    Persist businesses as returned by the Yelp API, or trimmed to their hot
+    records (see `trim_business`).
+    Save format: table `businesses` where
+        id = unique yelp business ID (primary key)
+        data = JSON representation of business
+        seq = change sequence number of the write that last changed it
+        fingerprint = `fingerprint` of the business as returned by the API,
+            to tell whether a business changed
+
+    Deleted IDs are kept in table `deleted`, with the seq of the deletion,
+    so that `changes_since` can report exactly what changed.
+
+    IDs returned by the current crawl, changed or not, are kept in table
+    `seen`, so that businesses a complete crawl didn't return can be told
+    apart (see `Fetcher.finish_crawl`).
+    '''
+
+    def __init__(self, path, journal_mode='WAL'):
+        '''
+        `journal_mode` is SQLite's. WAL lets readers run alongside a writer,
+        but needs shared memory, so doesn't work for stores that processes
+        on several hosts share over a network filesystem; use 'DELETE' for
+        those.
+        '''
+        self.path = path
+        # Callers sharing a store across threads must serialize writes.
+        self.conn = sqlite3.connect(
+            path, timeout=60, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=%s' % journal_mode)
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        # Processes may open a new store at once, so only one at a time
+        # checks and migrates the schema.
+        self.conn.execute('BEGIN IMMEDIATE')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS businesses ('
+            'id TEXT PRIMARY KEY, data TEXT NOT NULL)'
+        )
+        columns = [
+            row[1] for row in
+            self.conn.execute('PRAGMA table_info(businesses)')
+        ]
+        if 'seq' not in columns:
+            self.conn.execute(
+                'ALTER TABLE businesses ADD COLUMN seq INTEGER NOT NULL '
+                'DEFAULT 0')
+        if 'fingerprint' not in columns:
+            self.conn.execute(
+                'ALTER TABLE businesses ADD COLUMN fingerprint INTEGER')
+        self.conn.execute(
+            'CREATE INDEX IF NOT EXISTS businesses_seq ON businesses (seq)')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS deleted ('
+            'id TEXT PRIMARY KEY, seq INTEGER NOT NULL)'
+        )
+        self.conn.execute(
+            'CREATE INDEX IF NOT EXISTS deleted_seq ON deleted (seq)')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS seen (id TEXT PRIMARY KEY)')
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    # Read-only
+
+    def __len__(self):
+        return self.conn.execute(
+            'SELECT COUNT(*) FROM businesses').fetchone()[0]
+
+    def __contains__(self, id):
+        return self.conn.execute(
+            'SELECT 1 FROM businesses WHERE id = ?', (id,)
+        ).fetchone() is not None
+
+    def get(self, id):
+        '''Return a single business, or None if we don't have it.'''
+        row = self.conn.execute(
+            'SELECT data FROM businesses WHERE id = ?', (id,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def get_many(self, ids):
+        '''
+        Yield `(id, business)` pairs for the given IDs that we have.
+        If `ids` are sorted, so are the results.
+        '''
+        ids = list(ids)
+        for i in range(0, len(ids), SQLITE_MAX_VARIABLES):
+            chunk = ids[i:i + SQLITE_MAX_VARIABLES]
+            cursor = self.conn.execute(
+                'SELECT id, data FROM businesses WHERE id IN (%s) '
+                'ORDER BY id' %
+                ','.join('?' * len(chunk)),
+                chunk)
+            for id, data in cursor:
+                yield id, json.loads(data)
+
+    def ids(self):
+        '''Yield all business IDs, in sorted order.'''
+        for row in self.conn.execute('SELECT id FROM businesses ORDER BY id'):
+            yield row[0]
+
+    def items(self):
+        '''Yield all `(id, business)` pairs, in sorted ID order.'''
+        cursor = self.conn.execute(
+            'SELECT id, data FROM businesses ORDER BY id')
+        for id, data in cursor:
+            yield id, json.loads(data)
+
+    def rows(self):
+        '''
+        Yield `(id, fingerprint, data)` for all businesses, in sorted ID
+        order, with `data` left as JSON.
+        '''
+        cursor = self.conn.execute(
+            'SELECT id, fingerprint, data FROM businesses ORDER BY id')
+        for id, fp, data in cursor:
+            # Rows written before fingerprints were stored don't have one.
+            if fp is None:
+                fp = fingerprint(json.loads(data))
+            yield id, fp, data
+
+    def get_fingerprints(self, ids):
+        '''`{<id>: <fingerprint>}` for the given IDs that we have.'''
+        fingerprints = {}
+        ids = list(ids)
+        for i in range(0, len(ids), SQLITE_MAX_VARIABLES):
+            chunk = ids[i:i + SQLITE_MAX_VARIABLES]
+            cursor = self.conn.execute(
+                'SELECT id, fingerprint, data FROM businesses '
+                'WHERE id IN (%s)' % ','.join('?' * len(chunk)),
+                chunk)
+            for id, fp, data in cursor:
+                # Rows written before fingerprints were stored don't have one.
+                fingerprints[id] = fp if fp is not None else \
+                    fingerprint(json.loads(data))
+        return fingerprints
+
+    def fingerprints(self):
+        '''Yield `(id, fingerprint)` for all businesses.'''
+        cursor = self.conn.execute(
+            'SELECT id, fingerprint, data FROM businesses')
+        for id, fp, data in cursor:
+            # Rows written before fingerprints were stored don't have one.
+            yield id, fp if fp is not None else fingerprint(json.loads(data))
+
+    def unseen_ids(self):
+        '''IDs of businesses that the current crawl hasn't returned.'''
+        return [row[0] for row in self.conn.execute(
+            'SELECT id FROM businesses WHERE id NOT IN (SELECT id FROM seen) '
+            'ORDER BY id')]
+
+    def n_seen(self):
+        return self.conn.execute('SELECT COUNT(*) FROM seen').fetchone()[0]
+
+    # Change tracking
+
+    def last_seq(self):
+        '''Sequence number of the latest write.'''
+        return self.conn.execute(
+            'SELECT MAX(seq) FROM (SELECT MAX(seq) AS seq FROM businesses '
+            'UNION ALL SELECT MAX(seq) FROM deleted)'
+        ).fetchone()[0] or 0
+
+    def changes_since(self, seq):
+        '''
+        Yield `(id, business)` for businesses written after `seq`, in ID
+        order, and then `(id, None)` for businesses deleted after `seq`.
+        '''
+        cursor = self.conn.execute(
+            'SELECT id, data FROM businesses WHERE seq > ? ORDER BY id',
+            (seq,))
+        for id, data in cursor:
+            yield id, json.loads(data)
+        cursor = self.conn.execute(
+            'SELECT id FROM deleted WHERE seq > ? ORDER BY id', (seq,))
+        for row in cursor:
+            yield row[0], None
+
+    # Write
+
+    def _begin_write(self):
+        '''
+        Start a write transaction, holding the database's write lock from
+        the start, and return the seq for the write. Otherwise two writers
+        could read the same `last_seq()` before either writes.
+        '''
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.last_seq() + 1
+
+    def upsert(self, businesses, fingerprints=None):
+        '''
+        Insert or overwrite businesses along their 'id' field.
+        `fingerprints` are those of the full businesses, when storing trimmed
+        ones; by default, the fingerprints of `businesses`.
+        '''
+        businesses = list(businesses)
+        if fingerprints is None:
+            fingerprints = [fingerprint(biz) for biz in businesses]
+        with self.conn:
+            seq = self._begin_write()
+            rows = [
+                (biz['id'], json.dumps(biz, separators=(',', ':')), seq, fp)
+                for biz, fp in zip(businesses, fingerprints)
+            ]
+            self.conn.executemany(
+                'INSERT INTO businesses (id, data, seq, fingerprint) '
+                'VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(id) DO UPDATE SET data = excluded.data, '
+                'seq = excluded.seq, fingerprint = excluded.fingerprint',
+                rows
+            )
+            self.conn.executemany(
+                'DELETE FROM deleted WHERE id = ?', [row[:1] for row in rows])
+
+    def delete(self, ids):
+        with self.conn:
+            seq = self._begin_write()
+            ids = [(id,) for id in ids]
+            self.conn.executemany('DELETE FROM businesses WHERE id = ?', ids)
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO deleted (id, seq) VALUES (?, ?)',
+                [(id, seq) for (id,) in ids])
+
+    def mark_seen(self, ids):
+        '''Record IDs as returned by the current crawl.'''
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO seen (id) VALUES (?)',
+                [(id,) for id in ids])
+
+    def clear_seen(self):
+        '''Start a new crawl.'''
+        with self.conn:
+            self.conn.execute('DELETE FROM seen')
+
+    def vacuum(self):
+        '''Reclaim the space of deleted and shrunk rows.'''
+        self.conn.execute('VACUUM')
+
+
+def import_json_file(json_path, store_path, batch_size=1000):
+    '''
+    One-shot import of a legacy JSON save file, of format:
+        {<business id>: <business>}
+    Returns the number of businesses imported.
+    '''
+    with open(json_path, 'r') as f:
+        data = json.loads(f.read()) or {}
+    store = BusinessStore(store_path)
+    businesses = list(data.values())
+    for i in range(0, len(businesses), batch_size):
+        store.upsert(businesses[i:i + batch_size])
+    store.close()
+    logger.info('Imported %d businesses from %s into %s' % (
+        len(businesses), json_path, store_path))
+    return len(businesses)
+
+
+if __name__ == '__main__':
+    logger.setLevel(logging.INFO)
+    json_path = sys.argv[1] if len(sys.argv) > 1 else SEARCH_API_DATA_PATH
+    import_json_file(json_path, BUSINESS_STORE_PATH)
@@ -0,0 +1,129 @@
+'''
+Local stand-in for the Yelp v3/businesses/search API, for exercising the
+fetcher without spending API quota.
+
+    api = StubYelpAPI({'food': [<business>, ...]}, daily_quota=100)
+    api.start()
+    Fetcher(is_test=True, api_url=api.url).fetch_all_businesses()
+    api.stop()
+'''
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import math
+import threading
+from urllib.parse import parse_qs, urlparse
+
+from .geo import haversine
+
+
+def make_businesses(prefix, n, bounds=(37.708, -122.52, 37.816, -122.35)):
+    '''
+    Generate `n` minimal Yelp-shaped businesses with unique IDs, spread over
+    a grid within `bounds` (south, west, north, east).
+    '''
+    south, west, north, east = bounds
+    side = math.ceil(math.sqrt(n))
+    return [{
+        'id': '%s-%d' % (prefix, i),
+        'name': '%s %d' % (prefix, i),
+        'coordinates': {
+            'latitude': south + (north - south) * (i // side + 0.5) / side,
+            'longitude': west + (east - west) * (i % side + 0.5) / side,
+        },
+    } for i in range(n)]
+
+
+class StubYelpAPI():
+    '''
+    Serve search results from `businesses_by_category`:
+        {<category alias>: [<business>, ...]}
+    Searches by latitude/longitude/radius are filtered by distance.
+    Unknown categories have no results. After `daily_quota` requests, every
+    request fails with the same error the real API returns. Statuses queued
+    in `failures` fail the next requests with transient errors.
+    '''
+
+    def __init__(self, businesses_by_category, daily_quota=None):
+        self.businesses_by_category = businesses_by_category
+        self.daily_quota = daily_quota
+        self.requests = []  # Query params of every request served
+        self.failures = []  # e.g. [503, 429]
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d/v3/businesses/search' % self.server.server_address
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def respond(self, params):
+        '''Return `(status, response JSON)` for a request.'''
+        with self.lock:
+            self.requests.append(params)
+            if (self.daily_quota is not None and
+                    len(self.requests) > self.daily_quota):
+                return 429, {'error': {
+                    'code': 'ACCESS_LIMIT_REACHED',
+                    'description': 'You\'ve reached the access limit.',
+                }}
+            if self.failures:
+                status = self.failures.pop(0)
+                return status, {'error': {
+                    'code': 'TOO_MANY_REQUESTS_PER_SECOND' if status == 429
+                            else 'INTERNAL_ERROR',
+                    'description': 'Transient error.',
+                }}
+        results = self.businesses_by_category.get(
+            params.get('categories'), [])
+        if 'latitude' in params:
+            lat = float(params['latitude'])
+            lng = float(params['longitude'])
+            radius = float(params['radius'])
+            results = [
+                b for b in results
+                if haversine(lat, lng, b['coordinates']['latitude'],
+                             b['coordinates']['longitude']) <= radius
+            ]
+        offset = int(params.get('offset', 0))
+        limit = int(params.get('limit', 20))
+        return 200, {
+            'total': len(results),
+            'businesses': results[offset:offset + limit],
+        }
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                params = {
+                    k: v[0] for k, v in
+                    parse_qs(urlparse(self.path).query).items()
+                }
+                status, response_json = api.respond(params)
+                body = json.dumps(response_json).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                if api.daily_quota is not None:
+                    self.send_header(
+                        'RateLimit-DailyLimit', str(api.daily_quota))
+                    self.send_header('RateLimit-Remaining', str(max(
+                        0, api.daily_quota - len(api.requests))))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # Keep test output quiet
+
+        return Handler
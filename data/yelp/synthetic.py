@@ -0,0 +1,132 @@
+'''
+Deterministic generator of Yelp-shaped data, for benchmarks and tests at
+sizes we don't have real data for.
+
+Businesses have the fields of a v3/businesses/search result, clustered
+around a handful of neighbourhoods in `SEARCH_BOUNDS`, with categories drawn
+from a generated category tree in the format of `categories.json`. The same
+seed always generates the same data.
+'''
+
+import math
+import random
+import string
+
+from .settings import SEARCH_BOUNDS
+
+ID_ALPHABET = string.ascii_letters + string.digits + '-_'
+ID_LENGTH = 22
+
+CITIES = [
+    ('San Francisco', 0.85),
+    ('San  Francisco', 0.03),
+    ('SF', 0.02),
+    ('Daly City', 0.05),
+    ('Oakland', 0.05),
+]
+
+TRANSACTIONS = ['pickup', 'delivery', 'restaurant_reservation']
+
+
+def make_categories(n=1500, seed=0, top_level=22, max_depth=4):
+    '''
+    Generate a category tree of `n` categories, `top_level` of them roots,
+    as a list of `{'alias', 'title', 'parents'}` in alias order.
+    '''
+    rng = random.Random(seed)
+    aliases = ['cat%05d' % i for i in range(n)]
+    depths = {}
+    categories = []
+    for i, alias in enumerate(aliases):
+        if i < top_level:
+            parents = []
+            depths[alias] = 0
+        else:
+            # Bias parents towards the top of the tree, like Yelp's.
+            candidates = [
+                a for a in (aliases[int(rng.random() ** 2 * i)]
+                            for _ in range(2 if rng.random() < 0.03 else 1))
+                if depths[a] < max_depth
+            ] or [aliases[rng.randrange(top_level)]]
+            parents = sorted(set(candidates))
+            depths[alias] = 1 + min(depths[p] for p in parents)
+        categories.append({
+            'alias': alias,
+            'title': 'Category %d' % i,
+            'parents': parents,
+        })
+    return categories
+
+
+def _neighbourhoods(rng, n=20, bounds=SEARCH_BOUNDS):
+    south, west, north, east = bounds
+    return [
+        (rng.uniform(south, north), rng.uniform(west, east),
+         rng.uniform(0.002, 0.01))
+        for _ in range(n)
+    ]
+
+
+def _weighted_choice(rng, weighted):
+    r = rng.random()
+    for value, weight in weighted:
+        r -= weight
+        if r < 0:
+            return value
+    return weighted[-1][0]
+
+
+def iter_businesses(n, seed=0, categories=None, bounds=SEARCH_BOUNDS):
+    '''
+    Yield `n` businesses. `categories` is a category tree as returned by
+    `make_categories`, by default one generated from `seed`.
+    '''
+    rng = random.Random(seed)
+    if categories is None:
+        categories = make_categories(seed=seed)
+    neighbourhoods = _neighbourhoods(rng, bounds=bounds)
+    south, west, north, east = bounds
+
+    for i in range(n):
+        lat, lng, spread = rng.choice(neighbourhoods)
+        lat = min(north, max(south, rng.gauss(lat, spread)))
+        lng = min(east, max(west, rng.gauss(lng, spread)))
+        city = _weighted_choice(rng, CITIES)
+        business_categories = [
+            {'alias': c['alias'], 'title': c['title']}
+            for c in rng.sample(categories, rng.randint(1, 3))
+        ]
+        name = 'Business %d' % i
+        street = '%d Market St' % rng.randint(1, 3000)
+        biz = {
+            'id': ''.join(rng.choices(ID_ALPHABET, k=ID_LENGTH)),
+            'alias': 'business-%d-%s' % (i, city.lower().replace(' ', '-')),
+            'name': name,
+            'image_url': 'https://s3-media1.fl.yelpcdn.com/bphoto/%d/o.jpg'
+                         % i,
+            'is_closed': rng.random() < 0.02,
+            'url': 'https://www.yelp.com/biz/business-%d' % i,
+            # Long tailed, like real review counts.
+            'review_count': int(rng.lognormvariate(3, 1.5)),
+            'categories': business_categories,
+            'rating': rng.choice([1.0, 1.5, 2.0, 2.5, 3.0, 3.5, 4.0, 4.5,
+                                  5.0]),
+            'coordinates': {'latitude': lat, 'longitude': lng},
+            'transactions': [t for t in TRANSACTIONS if rng.random() < 0.3],
+            'location': {
+                'address1': street,
+                'address2': '',
+                'address3': '',
+                'city': city,
+                'zip_code': '941%02d' % rng.randint(2, 34),
+                'country': 'US',
+                'state': 'CA',
+                'display_address': [street, '%s, CA' % city],
+            },
+            'phone': '+1415%07d' % rng.randrange(10 ** 7),
+            'display_phone': '',
+            'distance': math.floor(rng.uniform(0, 40000) * 100) / 100,
+        }
+        if rng.random() < 0.7:
+            biz['price'] = '$' * rng.randint(1, 4)
+        yield biz
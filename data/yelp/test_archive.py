@@ -0,0 +1,92 @@
+import os
+import tempfile
+import unittest
+
+from yelp.archive import ArchiveError, ResponseArchive, archive_store
+from yelp.store import BusinessStore, trim_business
+from yelp.synthetic import iter_businesses
+
+
+class TestResponseArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'archive')
+        self.businesses = list(iter_businesses(120))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_append_and_read(self):
+        archive = ResponseArchive(self.path)
+        self.assertIsNone(archive.append([]))
+        first = archive.append(self.businesses[:50])
+        second = archive.append(self.businesses[50:])
+        self.assertEqual(archive.frames(), [first, second])
+        self.assertEqual(len(archive), 120)
+        self.assertEqual(archive.read_frame(second), self.businesses[50:])
+        self.assertEqual(list(archive), self.businesses)
+
+        biz = self.businesses[70]
+        self.assertIn(biz['id'], archive)
+        self.assertEqual(archive.get(biz['id']), biz)
+        self.assertIsNone(archive.get('nope'))
+        ids = [self.businesses[i]['id'] for i in (3, 99, 10)]
+        self.assertEqual(
+            dict(archive.get_many(ids + ['nope'])),
+            {self.businesses[i]['id']: self.businesses[i]
+             for i in (3, 99, 10)})
+        archive.close()
+
+        # Frames are compressed
+        self.assertLess(
+            os.path.getsize(os.path.join(self.path, 'frames.bin')),
+            sum(len(str(biz)) for biz in self.businesses) / 4)
+
+    def test_latest_version(self):
+        archive = ResponseArchive(self.path)
+        archive.append(self.businesses[:2])
+        changed = dict(self.businesses[1], rating=1.0)
+        archive.append([changed])
+        self.assertEqual(archive.get(changed['id']), changed)
+        self.assertEqual(len(archive), 2)
+        # Every version is kept
+        self.assertEqual(list(archive), self.businesses[:2] + [changed])
+        archive.close()
+
+        # And survives reopening
+        archive = ResponseArchive(self.path)
+        self.assertEqual(archive.get(changed['id']), changed)
+        archive.close()
+
+    def test_corrupt_frame(self):
+        archive = ResponseArchive(self.path)
+        frame = archive.append(self.businesses[:10])
+        with open(os.path.join(self.path, 'frames.bin'), 'r+b') as f:
+            f.write(b'XXXX')
+        with self.assertRaises(ArchiveError):
+            archive.read_frame(frame)
+        archive.close()
+
+    def test_archive_store(self):
+        store = BusinessStore(os.path.join(self.dir.name, 'store.sqlite3'))
+        store.upsert(self.businesses)
+        fingerprints = dict(store.fingerprints())
+        archive = ResponseArchive(self.path)
+
+        self.assertEqual(archive_store(store, archive, batch_size=50), 120)
+        self.assertEqual(len(archive), 120)
+        for biz in self.businesses:
+            self.assertEqual(archive.get(biz['id']), biz)
+            self.assertEqual(store.get(biz['id']), trim_business(biz))
+        # Fingerprints are still those of the full businesses
+        self.assertEqual(dict(store.fingerprints()), fingerprints)
+
+        # Already trimmed businesses aren't archived again
+        self.assertEqual(archive_store(store, archive), 0)
+        archive.close()
+        store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
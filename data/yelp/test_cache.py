@@ -0,0 +1,74 @@
+import os
+import tempfile
+import unittest
+
+from yelp.cache import CacheMiss, CacheMode, ResponseCache, cache_key
+
+
+URL = 'http://localhost/search'
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.calls = []
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def fetch_fn(self, params):
+        self.calls.append(params)
+        return {'total': 1, 'offset': params['offset']}
+
+    def test_cache_key(self):
+        self.assertEqual(
+            cache_key(URL, {'a': 1, 'b': 'x'}),
+            cache_key(URL, {'b': 'x', 'a': '1'}))
+        self.assertNotEqual(
+            cache_key(URL, {'a': 1}), cache_key(URL, {'a': 2}))
+
+    def test_modes(self):
+        params = {'categories': 'foo', 'offset': 0}
+        cache = ResponseCache(self.dir.name, mode=CacheMode.RECORD)
+        self.assertEqual(
+            cache.fetch(URL, params, self.fetch_fn), {'total': 1, 'offset': 0})
+        cache.fetch(URL, params, self.fetch_fn)
+        self.assertEqual(len(self.calls), 1)
+
+        # Replay is fully offline
+        cache = ResponseCache(self.dir.name, mode=CacheMode.REPLAY)
+        self.assertEqual(
+            cache.fetch(URL, params, self.fetch_fn), {'total': 1, 'offset': 0})
+        with self.assertRaises(CacheMiss):
+            cache.fetch(URL, {'categories': 'bar'}, self.fetch_fn)
+        self.assertEqual(len(self.calls), 1)
+
+        # Refresh always refetches
+        cache = ResponseCache(self.dir.name, mode=CacheMode.REFRESH)
+        cache.fetch(URL, params, self.fetch_fn)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_errors_not_cached(self):
+        cache = ResponseCache(self.dir.name)
+        cache.fetch(URL, {}, lambda params: {'error': {}})
+        self.assertEqual(cache.get(URL, {}), None)
+
+    def test_eviction(self):
+        cache = ResponseCache(self.dir.name, ttl=-1)
+        cache.put(URL, {'offset': 0}, {'total': 1})
+        # Expired
+        self.assertEqual(cache.get(URL, {'offset': 0}), None)
+
+        cache = ResponseCache(self.dir.name, max_bytes=30)
+        for offset in range(5):
+            cache.put(URL, {'offset': offset}, {'total': 1})
+            os.utime(cache._entry_path(cache_key(URL, {'offset': offset})),
+                     (offset, offset))
+        self.assertLessEqual(cache.total_bytes, 30)
+        self.assertEqual(cache.get(URL, {'offset': 4}), {'total': 1})
+        self.assertEqual(cache.get(URL, {'offset': 0}), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
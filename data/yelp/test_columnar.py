@@ -0,0 +1,111 @@
+import math
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from yelp.columnar import export_columns, load_columns
+from yelp.yelp_categories import CategoryIndex
+
+
+BUSINESSES = [
+    ('a', {
+        'coordinates': {'latitude': 37.7, 'longitude': -122.4},
+        'price': '$$',
+        'rating': 4.5,
+        'review_count': 10,
+        'location': {'city': 'San Francisco'},
+        'categories': [{'alias': 'food'}, {'alias': 'bakeries'}],
+    }),
+    ('b', {
+        'coordinates': {'latitude': None, 'longitude': None},
+        'location': {'city': 'Oakland'},
+        'categories': [],
+    }),
+    ('c', {
+        'coordinates': {'latitude': 37.8, 'longitude': -122.3},
+        'price': '$',
+        'rating': 3.0,
+        'review_count': 0,
+        'location': {'city': 'San Francisco'},
+        'categories': [{'alias': 'bakeries'}],
+    }),
+]
+
+
+class TestColumnar(unittest.TestCase):
+
+    def test_export_and_load(self):
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, 'columns')
+            self.assertEqual(export_columns(BUSINESSES, path), 3)
+            cols = load_columns(path)
+
+            self.assertEqual(len(cols), 3)
+            self.assertEqual(list(cols.id), ['a', 'b', 'c'])
+            self.assertEqual(cols.latitude[0], 37.7)
+            self.assertTrue(math.isnan(cols.latitude[1]))
+            self.assertEqual(list(cols.price_level), [2, 0, 1])
+            self.assertTrue(math.isnan(cols.rating[1]))
+            self.assertEqual(list(cols.review_count), [10, -1, 0])
+            self.assertEqual(
+                [cols.cities[i] for i in cols.city],
+                ['San Francisco', 'Oakland', 'San Francisco'])
+            self.assertEqual(cols.row_categories(0), ['food', 'bakeries'])
+            self.assertEqual(cols.row_categories(1), [])
+            self.assertEqual(cols.row_categories(2), ['bakeries'])
+
+            # Re-exporting replaces the dataset, leaving nothing else behind,
+            # and readers of the old one can carry on.
+            export_columns(BUSINESSES[:1], path)
+            self.assertEqual(len(load_columns(path)), 1)
+            self.assertEqual(os.listdir(dir), ['columns'])
+            self.assertEqual(list(cols.id), ['a', 'b', 'c'])
+
+    def test_category_index(self):
+        index = CategoryIndex([
+            {'alias': 'food', 'parents': []},
+            {'alias': 'bakeries', 'parents': ['food']},
+            {'alias': 'restaurants', 'parents': []},
+            {'alias': 'cafes', 'parents': ['restaurants']},
+            {'alias': 'themedcafes', 'parents': ['cafes']},
+        ])
+        businesses = BUSINESSES + [
+            ('d', {'categories': [{'alias': 'themedcafes'}]}),
+            ('e', {'categories': [
+                {'alias': 'bakeries'}, {'alias': 'cafes'}]}),
+        ]
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, 'columns')
+            export_columns(businesses, path, index)
+            cols = load_columns(path)
+
+            def rows(*args, **kwargs):
+                return list(cols.category_rows(*args, **kwargs))
+            # Direct categories only
+            self.assertEqual(rows('bakeries'), [0, 2, 4])
+            self.assertEqual(rows('themedcafes'), [3])
+            # Rolled up to ancestors, counting rows once
+            self.assertEqual(rows('food'), [0, 2, 4])
+            self.assertEqual(rows('cafes'), [3, 4])
+            self.assertEqual(rows('restaurants'), [3, 4])
+            self.assertEqual(rows(['food', 'restaurants']), [0, 2, 3, 4])
+            self.assertEqual(
+                rows(['food', 'restaurants'], match_all=True), [4])
+            self.assertEqual(rows('unknown'), [])
+            self.assertEqual(rows(['food', 'unknown'], match_all=True), [])
+            self.assertEqual(rows([]), [])
+            self.assertEqual(cols.category_index_rows.dtype, np.int32)
+            # Ancestors are added after the categories businesses have
+            self.assertEqual(cols.row_categories(4), ['bakeries', 'cafes'])
+            self.assertEqual(cols.categories[-1], 'restaurants')
+
+            # An empty dataset has an empty index
+            export_columns([], path, index)
+            self.assertEqual(list(load_columns(path).category_rows('food')),
+                             [])
+
+
+if __name__ == '__main__':
+    unittest.main()
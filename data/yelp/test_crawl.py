@@ -0,0 +1,67 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from yelp.archive import ResponseArchive
+from yelp.crawl import city_archive_path, city_store_path, crawl
+from yelp.progress import ProgressStatus
+from yelp.store import BusinessStore
+from yelp.stub_api import StubYelpAPI, make_businesses
+
+
+class TestCrawl(unittest.TestCase):
+
+    def setUp(self):
+        self.api = StubYelpAPI({
+            'foo': make_businesses('foo', 120),
+            'bar': make_businesses('bar', 3),
+        })
+        self.api.start()
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.api.stop()
+        self.dir.cleanup()
+
+    def crawl(self, **kwargs):
+        return crawl(
+            {'San Francisco': None, 'Oakland': None},
+            queue_path=os.path.join(self.dir.name, 'queue.sqlite3'),
+            stores_path=os.path.join(self.dir.name, 'stores'),
+            categories=['foo', 'bar', 'empty'],
+            api_url=self.api.url, max_qps=1000, **kwargs)
+
+    def test_crawl(self):
+        counts = self.crawl(workers=3)
+        self.assertEqual(counts, {ProgressStatus.COMPLETE: 6})
+        for city in ['San Francisco', 'Oakland']:
+            path = city_store_path(city, os.path.join(self.dir.name, 'stores'))
+            # WAL doesn't work across hosts
+            conn = sqlite3.connect(path)
+            self.assertEqual(
+                conn.execute('PRAGMA journal_mode').fetchone()[0], 'delete')
+            conn.close()
+            store = BusinessStore(path, journal_mode='DELETE')
+            self.assertEqual(len(store), 123)
+            store.close()
+            archive = ResponseArchive(city_archive_path(
+                city, os.path.join(self.dir.name, 'stores')))
+            self.assertEqual(len(archive), 123)
+            archive.close()
+        # Each page was fetched once per city
+        self.assertEqual(len(self.api.requests), 2 * 5)
+        self.assertEqual(
+            sorted(r['location'] for r in self.api.requests),
+            ['Oakland'] * 5 + ['San Francisco'] * 5)
+
+    def test_daily_quota(self):
+        self.api.daily_quota = 4
+        counts = self.crawl(workers=2)
+        self.assertTrue(counts.get(ProgressStatus.INCOMPLETE))
+        # Workers stop soon after the quota is hit
+        self.assertLessEqual(len(self.api.requests), 4 + 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
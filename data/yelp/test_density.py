@@ -0,0 +1,88 @@
+import unittest
+
+import numpy as np
+
+from yelp import density
+
+
+class TestDensity(unittest.TestCase):
+
+    def test_fast_length(self):
+        self.assertEqual(
+            [density.fast_length(n) for n in [1, 7, 11, 17, 1000, 4547]],
+            [1, 8, 12, 18, 1000, 4608])
+
+    def test_fft_convolve(self):
+        rng = np.random.default_rng(0)
+        image = rng.random((13, 21))
+        kernel = density.gaussian_kernel(1.5)
+        # Direct zero padded convolution
+        r = kernel.shape[0] // 2
+        padded = np.pad(image, r)
+        expected = np.zeros_like(image)
+        for dy in range(kernel.shape[0]):
+            for dx in range(kernel.shape[1]):
+                expected += kernel[dy, dx] * padded[
+                    dy:dy + image.shape[0], dx:dx + image.shape[1]]
+        np.testing.assert_allclose(
+            density.fft_convolve(image, kernel), expected, atol=1e-12)
+
+    def test_rasterize(self):
+        grid = density.Grid((37.7, -122.5, 37.8, -122.4), cell_meters=1000)
+        lat = np.array([37.7001, 37.7002, 37.7999])
+        lng = np.array([-122.4999, -122.4998, -122.4001])
+        counts = grid.rasterize(lat, lng)
+        self.assertEqual(counts.sum(), 3)
+        self.assertEqual(counts[0, 0], 2)
+        self.assertEqual(counts[-1, -1], 1)
+        sums = grid.rasterize(lat, lng, np.array([1.0, 2.0, 3.0]))
+        self.assertEqual(sums[0, 0], 3)
+
+    def test_normalize(self):
+        rng = np.random.default_rng(0)
+        # A dense cluster of low values and, 5km away, a sparse cluster of
+        # high values.
+        dense, sparse = 5000, 50
+        lat = np.concatenate([
+            rng.normal(37.75, 0.002, dense),
+            rng.normal(37.795, 0.002, sparse)])
+        lng = np.concatenate([
+            rng.normal(-122.45, 0.002, dense),
+            rng.normal(-122.45, 0.002, sparse)])
+        values = np.concatenate([np.ones(dense), 5 * np.ones(sparse)])
+        values[-1] = np.nan
+
+        surface = density.normalize(
+            lat, lng, values, cell_meters=50, bandwidth_meters=200)
+        self.assertAlmostEqual(surface.weight.sum(), dense + sparse - 1,
+                               delta=1)
+        pt_lat, pt_lng, mean = surface.points()
+        self.assertTrue(len(mean))
+        # Each cluster averages its own values, however dense it is.
+        np.testing.assert_allclose(mean[pt_lat < 37.77], 1)
+        np.testing.assert_allclose(mean[pt_lat > 37.78], 5)
+        # Cells far from any business have no value.
+        self.assertFalse(((pt_lat > 37.765) & (pt_lat < 37.78)).any())
+
+    def test_normalize_bounds(self):
+        surface = density.normalize(
+            [37.75, 40.0], [-122.45, -120.0], [1.0, 9.0],
+            bounds=(37.7, -122.5, 37.8, -122.4), min_weight=0.01)
+        self.assertAlmostEqual(surface.weight.sum(), 1)
+        self.assertTrue(np.all(surface.points()[2] == 1.0))
+
+        empty = density.normalize([], [], [])
+        self.assertEqual(len(empty.points()[0]), 0)
+
+    def test_max_cells(self):
+        # A bogus coordinate at (0, 0) stretches the grid around the world
+        with self.assertRaises(ValueError):
+            density.normalize([37.75, 0.0], [-122.45, 0.0], [1.0, 1.0])
+        # Unless bounds leave it out
+        density.normalize(
+            [37.75, 0.0], [-122.45, 0.0], [1.0, 1.0],
+            bounds=(37.7, -122.5, 37.8, -122.4))
+
+
+if __name__ == '__main__':
+    unittest.main()
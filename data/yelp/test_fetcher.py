@@ -0,0 +1,220 @@
+import os
+import tempfile
+import unittest
+
+from yelp.cache import CacheMode, ResponseCache
+from yelp.metrics import Metrics
+from yelp.snapshots import REMOVED, SnapshotStore, iter_change_businesses
+from yelp.store import BusinessStore, trim_business
+from yelp.stub_api import StubYelpAPI, make_businesses
+from yelp.yelp import Fetcher
+
+
+class TestFetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.api = StubYelpAPI({
+            'foo': make_businesses('foo', 120),
+            'bar': make_businesses('bar', 3),
+            # Leaf category
+            'abruzzese': make_businesses('abruzzese', 400),
+        })
+        self.api.start()
+
+    def tearDown(self):
+        self.api.stop()
+
+    def get_fetcher(self, **kwargs):
+        fetcher = Fetcher(
+            is_test=True, api_url=self.api.url, max_qps=1000, **kwargs)
+        self.addCleanup(fetcher.close)
+        fetcher.backoff_base = 0.001
+        fetcher.progress.destructive_reset(['foo', 'bar', 'empty'])
+        return fetcher
+
+    def test_fetch_all_businesses(self):
+        fetcher = self.get_fetcher(concurrency=3)
+        fetcher.fetch_all_businesses()
+        self.assertEqual(len(fetcher.store), 123)
+        for cat in ['foo', 'bar', 'empty']:
+            self.assertTrue(fetcher.progress.is_complete(cat))
+        # 3 pages of foo, 1 of bar, 1 of empty
+        self.assertEqual(len(self.api.requests), 5)
+
+        # Full businesses are archived, one frame per page, and the store
+        # keeps trimmed ones.
+        self.assertEqual(len(fetcher.archive.frames()), 4)
+        biz = self.api.businesses_by_category['foo'][0]
+        self.assertEqual(fetcher.archive.get(biz['id']), biz)
+        self.assertEqual(fetcher.store.get(biz['id']), trim_business(biz))
+
+    def test_persist_stats(self):
+        # Businesses listed under both foo and bar
+        self.api.businesses_by_category['bar'] = (
+            self.api.businesses_by_category['foo'][:3])
+        fetcher = self.get_fetcher()
+        fetcher.fetch_all_businesses()
+        self.assertEqual(len(fetcher.store), 120)
+        self.assertEqual(fetcher.persist_stats, {
+            'inserted': 120, 'unchanged': 3})
+        seq = fetcher.store.last_seq()
+
+        # Refetching unchanged businesses doesn't write to the store
+        fetcher.progress.delete_key('foo')
+        fetcher.progress.add_keys(['foo'])
+        fetcher.persist_stats.clear()
+        self.api.businesses_by_category['foo'][0]['rating'] = 1.0
+        fetcher.fetch_all_businesses()
+        self.assertEqual(fetcher.persist_stats, {
+            'updated': 1, 'unchanged': 119})
+        self.assertEqual(
+            [id for id, biz in fetcher.store.changes_since(seq)],
+            [self.api.businesses_by_category['foo'][0]['id']])
+
+    def test_persist_ignores_search_fields(self):
+        fetcher = self.get_fetcher()
+        biz = make_businesses('foo', 1)[0]
+        # The same business, found by searches around different centers
+        fetcher.persist_search_results(
+            {'businesses': [dict(biz, distance=120.5)]})
+        seq = fetcher.store.last_seq()
+        fetcher.persist_search_results(
+            {'businesses': [dict(biz, distance=830.2)]})
+        self.assertEqual(fetcher.persist_stats, {
+            'inserted': 1, 'unchanged': 1})
+        self.assertEqual(fetcher.store.last_seq(), seq)
+        self.assertEqual(len(fetcher.archive.frames()), 1)
+
+    def test_closures(self):
+        fetcher = self.get_fetcher()
+        with tempfile.TemporaryDirectory() as dir:
+            snapshots_path = os.path.join(dir, 'snapshots.sqlite3')
+            fetcher.fetch_all_businesses()
+            old = fetcher.finish_crawl(snapshots_path)
+
+            # Next crawl, a business is gone from the results
+            closed = self.api.businesses_by_category['foo'].pop(7)
+            fetcher.progress.destructive_reset(['foo', 'bar', 'empty'])
+            fetcher.fetch_all_businesses()
+            new = fetcher.finish_crawl(snapshots_path)
+
+            self.assertNotIn(closed['id'], fetcher.store)
+            self.assertEqual(len(fetcher.store), 122)
+            snapshots = SnapshotStore(snapshots_path)
+            changes = list(snapshots.diff(old, new))
+            self.assertEqual(
+                [(id, change) for id, change, a, b in changes],
+                [(closed['id'], REMOVED)])
+            self.assertEqual(
+                [biz.get('closed') for id, biz in
+                 iter_change_businesses(changes)], [1])
+            snapshots.close()
+
+            # A crawl that returned nothing closes nothing
+            fetcher.finish_crawl(snapshots_path)
+            self.assertEqual(len(fetcher.store), 122)
+
+    def test_persist_sees_other_writers(self):
+        fetcher = self.get_fetcher()
+        other = self.get_fetcher(store=BusinessStore(fetcher.store.path))
+        # Both have persisted before, so would have any caches warmed up
+        fetcher.persist_search_results({'businesses': []})
+        other.persist_search_results({'businesses': []})
+
+        page = {'businesses': make_businesses('foo', 3)}
+        fetcher.persist_search_results(page)
+        other.persist_search_results(page)
+        self.assertEqual(other.persist_stats, {'unchanged': 3})
+        self.assertEqual(len(other.archive.frames()), 0)
+        other.store.close()
+
+    def test_daily_quota(self):
+        self.api.daily_quota = 2
+        fetcher = self.get_fetcher(concurrency=1)
+        # add_keys doesn't keep the order it's given, so add foo first on
+        # its own.
+        fetcher.progress.destructive_reset(['foo'])
+        fetcher.progress.add_keys(['bar'])
+        fetcher.fetch_all_businesses()
+        self.assertTrue(fetcher.quota_exceeded.is_set())
+        # Nothing is requested once the quota error comes back
+        self.assertEqual(len(self.api.requests), 3)
+        # foo failed on its last page, and nothing else was tried.
+        self.assertTrue(fetcher.progress.is_incomplete('foo'))
+        self.assertTrue(fetcher.progress.is_incomplete('bar'))
+        self.assertEqual(len(fetcher.store), 100)
+
+    def test_replay_cache_miss(self):
+        with tempfile.TemporaryDirectory() as dir:
+            fetcher = self.get_fetcher(cache=ResponseCache(dir))
+            fetcher.progress.destructive_reset(['foo'])
+            fetcher.fetch_all_businesses()
+
+            # Offline, bar was never recorded, but foo still replays.
+            fetcher = self.get_fetcher(
+                cache=ResponseCache(dir, mode=CacheMode.REPLAY))
+            fetcher.progress.destructive_reset(['foo', 'bar'])
+            del self.api.requests[:]
+            fetcher.fetch_all_businesses()
+            self.assertTrue(fetcher.progress.is_complete('foo'))
+            self.assertTrue(fetcher.progress.is_incomplete('bar'))
+            self.assertEqual(len(fetcher.store), 120)
+            self.assertEqual(self.api.requests, [])
+
+    def test_retry(self):
+        self.api.failures = [503, 429]
+        fetcher = self.get_fetcher(concurrency=1)
+        fetcher.fetch_all_businesses()
+        self.assertEqual(len(fetcher.store), 123)
+        self.assertEqual(len(self.api.requests), 7)
+
+    def test_resume_at_failed_page(self):
+        fetcher = self.get_fetcher()
+        fetcher.max_retries = 1
+        fetcher.progress.destructive_reset(['foo'])
+        # Second page of foo fails, retry included
+        fetcher.persist_search_results = lambda response_json: \
+            self.api.failures.extend([503, 503])
+        fetcher.fetch_all_businesses()
+        self.assertTrue(fetcher.progress.is_incomplete('foo'))
+        self.assertEqual(fetcher.progress.get_cursor('foo'), (50, 120))
+
+        # Restarting resumes at the failed page
+        del fetcher.persist_search_results
+        del self.api.requests[:]
+        fetcher.fetch_all_businesses()
+        self.assertTrue(fetcher.progress.is_complete('foo'))
+        self.assertEqual(fetcher.progress.get_cursor('foo'), None)
+        self.assertEqual(
+            [r['offset'] for r in self.api.requests], ['50', '100'])
+
+    def test_metrics(self):
+        self.api.daily_quota = 10
+        metrics = Metrics()
+        fetcher = self.get_fetcher(metrics=metrics)
+        fetcher.fetch_all_businesses()
+        self.assertEqual(metrics.get('yelp_request_seconds').count, 5)
+        self.assertEqual(metrics.get('yelp_pages_total', category='foo'), 3)
+        self.assertEqual(metrics.get('yelp_quota_daily_limit'), 10)
+        self.assertEqual(metrics.get('yelp_quota_remaining'), 5)
+        self.assertGreater(metrics.get('yelp_response_bytes_total'), 0)
+        self.assertGreater(
+            metrics.get('yelp_progress_write_seconds', mode='json').count, 0)
+
+    def test_geo_split(self):
+        fetcher = self.get_fetcher()
+        fetcher.max_fetch_limit = 150
+        fetcher.progress.destructive_reset(['abruzzese'])
+        fetcher.fetch_all_businesses()
+        self.assertTrue(fetcher.progress.is_wontfix('abruzzese'))
+        self.assertEqual(len(fetcher.store), 400)
+        # Every search that wasn't split was fully fetched
+        self.assertEqual(
+            fetcher.get_incomplete_categories(), [])
+        self.assertTrue(any(
+            '@' in key and fetcher.progress.is_complete(key)
+            for key in fetcher.progress.keys()))
+
+
+if __name__ == '__main__':
+    unittest.main()
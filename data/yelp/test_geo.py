@@ -0,0 +1,43 @@
+import unittest
+
+from yelp import geo
+
+
+class TestGeo(unittest.TestCase):
+
+    def test_keys(self):
+        cell = geo.Cell(37.7, -122.5, 37.8, -122.4)
+        self.assertEqual(geo.parse_key('food'), ('food', None))
+        self.assertEqual(geo.parse_key(geo.make_key('food', cell)),
+                         ('food', cell))
+        params = geo.search_params(geo.make_key('food', cell), 'SF')
+        self.assertAlmostEqual(params['latitude'], 37.75)
+        self.assertAlmostEqual(params['longitude'], -122.45)
+        self.assertEqual(geo.search_params('food', 'SF'),
+                         {'location': 'SF', 'categories': 'food'})
+
+    def test_split(self):
+        cell = geo.Cell(0, 0, 2, 2)
+        quadrants = cell.split()
+        self.assertEqual(quadrants[0], geo.Cell(0, 0, 1, 1))
+        self.assertEqual(quadrants[3], geo.Cell(1, 1, 2, 2))
+        for q in quadrants:
+            self.assertLess(q.radius, cell.radius)
+        # Circumscribed circle covers every corner
+        lat, lng = cell.center
+        self.assertLessEqual(geo.haversine(lat, lng, 0, 0), cell.radius)
+
+    def test_choose_split(self):
+        # Leaves can only split by geo
+        self.assertEqual(geo.choose_split(3000, 0, 50, 1000),
+                         geo.SplitStrategy.GEO)
+        # A couple of children are cheaper than 4 quadrants
+        self.assertEqual(geo.choose_split(1200, 2, 50, 1000),
+                         geo.SplitStrategy.CATEGORY)
+        # Hundreds of mostly-empty children are not
+        self.assertEqual(geo.choose_split(1200, 300, 50, 1000),
+                         geo.SplitStrategy.GEO)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import io
+import json
+import unittest
+
+from yelp.jsonstream import iter_object_items, write_json_array
+
+
+DATA = {
+    'a': {'id': 'a', 'name': 'Café {"x"}', 'rating': 4.5},
+    'b': 12345,
+    'c': [1, 2, {'d': None}],
+    'e': -0.25e3,
+    'f': 'tail',
+}
+
+
+class TestJSONStream(unittest.TestCase):
+
+    def test_iter_object_items(self):
+        for text in [json.dumps(DATA), json.dumps(DATA, indent=4)]:
+            # Tiny chunks split keys, strings and numbers across reads
+            for chunk_size in [1, 2, 3, 7, 1000]:
+                items = list(iter_object_items(io.StringIO(text), chunk_size))
+                self.assertEqual(items, list(DATA.items()))
+
+    def test_iter_empty_object(self):
+        self.assertEqual(list(iter_object_items(io.StringIO(' { } '), 1)), [])
+
+    def test_iter_invalid(self):
+        with self.assertRaises(json.JSONDecodeError):
+            list(iter_object_items(io.StringIO('[1, 2]')))
+        with self.assertRaises(json.JSONDecodeError):
+            list(iter_object_items(io.StringIO('{"a": 1'), 2))
+
+    def test_write_json_array(self):
+        points = [[37.7, -122.4, 2], [37.8, -122.3, None]]
+        for items, expected in [(points, points), (iter(points), points),
+                                ([], [])]:
+            f = io.StringIO()
+            write_json_array(f, items)
+            self.assertEqual(f.getvalue(), json.dumps(expected))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import os
+import tempfile
+import time
+import unittest
+
+from yelp.leases import LeaseProgress, LeaseQueue, SharedRateLimiter
+from yelp.progress import ProgressStatus
+
+
+class TestLeaseQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.queue = LeaseQueue(
+            os.path.join(self.dir.name, 'queue.sqlite3'), max_attempts=2)
+
+    def tearDown(self):
+        self.queue.close()
+        self.dir.cleanup()
+
+    def test_claim(self):
+        self.queue.add('SF', ['a', 'b'])
+        self.queue.add('SF', ['a'])  # Already added
+        self.assertEqual(self.queue.pending(), 2)
+        self.assertEqual(self.queue.claim('w1'), ('SF', 'a'))
+        self.assertEqual(self.queue.claim('w2'), ('SF', 'b'))
+        # Everything is leased
+        self.assertEqual(self.queue.claim('w3'), None)
+
+        self.assertTrue(
+            self.queue.finish('SF', 'a', ProgressStatus.COMPLETE, 'w1'))
+        self.assertTrue(
+            self.queue.finish('SF', 'b', ProgressStatus.WONTFIX, 'w2'))
+        self.assertEqual(self.queue.pending(), 0)
+        self.assertEqual(self.queue.counts(), {
+            ProgressStatus.COMPLETE: 1, ProgressStatus.WONTFIX: 1})
+
+    def test_expired_lease(self):
+        self.queue.add('SF', ['a'])
+        self.assertEqual(self.queue.claim('w1', ttl=-1), ('SF', 'a'))
+        # w1's lease expired, so w2 takes over
+        self.assertEqual(self.queue.claim('w2'), ('SF', 'a'))
+        self.assertEqual(self.queue.claim('w1'), None)
+
+        # w1 can no longer finish the item, or move its cursor
+        stale = LeaseProgress(self.queue, 'SF', 'w1')
+        stale.set_cursor('a', 50, 120)
+        self.assertEqual(stale.get_cursor('a'), None)
+        self.assertFalse(
+            self.queue.finish('SF', 'a', ProgressStatus.COMPLETE, 'w1'))
+        stale.mark_wontfix('a')
+        self.assertTrue(stale.is_incomplete('a'))
+        self.assertTrue(
+            self.queue.finish('SF', 'a', ProgressStatus.COMPLETE, 'w2'))
+
+    def test_split(self):
+        self.queue.add('SF', ['a'])
+        self.queue.claim('w1', ttl=-1)
+        self.queue.claim('w2')
+        # w1's lease expired, so it can't split the item
+        self.assertFalse(self.queue.split('SF', 'a', ['a1', 'a2'], 'w1'))
+        self.assertEqual(self.queue.get_statuses('SF'), {
+            'a': ProgressStatus.INCOMPLETE})
+
+        LeaseProgress(self.queue, 'SF', 'w2').split('a', ['a1', 'a2'])
+        self.assertEqual(self.queue.get_statuses('SF'), {
+            'a': ProgressStatus.WONTFIX,
+            'a1': ProgressStatus.INCOMPLETE,
+            'a2': ProgressStatus.INCOMPLETE})
+        self.assertEqual(self.queue.claim('w2'), ('SF', 'a1'))
+
+    def test_cursor_renews_lease(self):
+        self.queue.add('SF', ['a'])
+        self.queue.claim('w1', ttl=-1)
+        progress = LeaseProgress(self.queue, 'SF', 'w1', ttl=60)
+        progress.set_cursor('a', 50, 120)
+        self.assertEqual(self.queue.claim('w2'), None)
+        self.assertEqual(progress.get_cursor('a'), (50, 120))
+        progress.mark_complete('a')
+        self.assertEqual(progress.get_cursor('a'), None)
+        self.assertTrue(progress.is_complete('a'))
+
+    def test_release(self):
+        self.queue.add('SF', ['a'])
+        for attempt in range(2):
+            self.assertEqual(self.queue.claim('w1'), ('SF', 'a'))
+            self.queue.release('SF', 'a', 'w1')
+        # Out of attempts
+        self.assertEqual(self.queue.claim('w1'), None)
+        self.assertEqual(self.queue.pending(), 0)
+
+    def test_release_without_failure(self):
+        self.queue.add('SF', ['a'])
+        for attempt in range(3):
+            self.assertEqual(self.queue.claim('w1'), ('SF', 'a'))
+            self.queue.release('SF', 'a', 'w1', failed=False)
+
+    def test_take_slot(self):
+        first = self.queue.take_slot('slot', 10)
+        self.assertAlmostEqual(self.queue.take_slot('slot', 10), first + 10)
+        self.assertAlmostEqual(self.queue.take_slot('slot', 10), first + 20)
+
+    def test_shared_rate_limiter(self):
+        other = LeaseQueue(self.queue.path)
+        limiters = [SharedRateLimiter(self.queue, 50),
+                    SharedRateLimiter(other, 50)]
+        start = time.time()
+        for i in range(10):
+            limiters[i % 2].acquire()
+        # 10 requests at 50 per second between both workers, the first
+        # right away
+        self.assertGreaterEqual(time.time() - start, 9 / 50)
+        other.close()
+
+    def test_progress(self):
+        progress = LeaseProgress(self.queue, 'SF')
+        progress.add_keys(['a', 'b'])
+        progress.mark_wontfix('b')
+        LeaseProgress(self.queue, 'Oakland').add_keys(['c'])
+        self.assertEqual(progress.get_data(), {
+            'a': ProgressStatus.INCOMPLETE, 'b': ProgressStatus.WONTFIX})
+        self.assertTrue(progress.is_incomplete('a'))
+
+
+if __name__ == '__main__':
+    unittest.main()
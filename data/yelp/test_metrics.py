@@ -0,0 +1,56 @@
+import os
+import tempfile
+import unittest
+
+from yelp.metrics import NULL_METRICS, Metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_to_prometheus(self):
+        metrics = Metrics()
+        metrics.inc('errors_total', code='A')
+        metrics.inc('errors_total', 2, code='A')
+        metrics.set('quota_remaining', 10)
+        metrics.observe('latency_seconds', 0.02)
+        metrics.observe('latency_seconds', 3)
+        self.assertEqual(metrics.get('errors_total', code='A'), 3)
+        self.assertIsNone(metrics.get('errors_total', code='B'))
+
+        text = metrics.to_prometheus()
+        self.assertIn('# TYPE errors_total counter\n', text)
+        self.assertIn('errors_total{code="A"} 3\n', text)
+        self.assertIn('quota_remaining 10\n', text)
+        self.assertIn('# TYPE latency_seconds histogram\n', text)
+        self.assertIn('latency_seconds_bucket{le="0.01"} 0\n', text)
+        self.assertIn('latency_seconds_bucket{le="0.025"} 1\n', text)
+        self.assertIn('latency_seconds_bucket{le="5"} 2\n', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 2\n', text)
+        self.assertIn('latency_seconds_count 2\n', text)
+
+    def test_time(self):
+        metrics = Metrics()
+        with metrics.time('write_seconds', mode='log'):
+            pass
+        self.assertEqual(metrics.get('write_seconds', mode='log').count, 1)
+
+    def test_export(self):
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, 'fetcher.prom')
+            metrics = Metrics(path, interval=60)
+            metrics.start()
+            metrics.inc('pages_total')
+            metrics.stop()
+            # Final values are written on stop
+            with open(path, 'r') as f:
+                self.assertEqual(f.read(), metrics.to_prometheus())
+
+    def test_null_metrics(self):
+        NULL_METRICS.inc('errors_total')
+        with NULL_METRICS.time('latency_seconds'):
+            pass
+        self.assertIsNone(NULL_METRICS.get('errors_total'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,10 @@
 import json
+import multiprocessing
 import os
 import tempfile
 import unittest
 
-from yelp.persist import update_json_file
+from yelp.persist import replace_dir, update_json_file
 
 
 def get_nonexistent_tmp_file_name():
@@ -13,6 +14,11 @@ def get_nonexistent_tmp_file_name():
     return fname
 
 
+def update_keys(fname, prefix, n):
+    for i in range(n):
+        update_json_file(fname, {'%s%d' % (prefix, i): i})
+
+
 class TestPersist(unittest.TestCase):
 
     @staticmethod
@@ -80,6 +86,33 @@ class TestPersist(unittest.TestCase):
             update_json_file(fname, [obj], update_fn=TestPersist.my_update_fn)
         os.remove(fname)
 
+    def test_concurrent_updates(self):
+        '''Updates from several processes don't overwrite each other.'''
+        fname = get_nonexistent_tmp_file_name()
+        processes = [
+            multiprocessing.Process(target=update_keys, args=(fname, p, 20))
+            for p in 'abcd'
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        with open(fname, 'r') as f:
+            self.assertEqual(len(json.loads(f.read())), 4 * 20)
+        os.remove(fname + '.lock')
+
+
+    def test_replace_dir(self):
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, 'tiles')
+            tmp_path = path + '.tmp'
+            # Whether or not there is a directory to replace
+            for version in ['1', '2']:
+                os.makedirs(os.path.join(tmp_path, version))
+                replace_dir(tmp_path, path)
+                self.assertEqual(os.listdir(path), [version])
+            self.assertEqual(os.listdir(dir), ['tiles'])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+
+from yelp import planner
+from yelp.stub_api import StubYelpAPI, make_businesses
+from yelp.yelp import Fetcher
+
+
+class TestPlanner(unittest.TestCase):
+
+    def setUp(self):
+        self.api = StubYelpAPI({
+            'foo': make_businesses('foo', 120),
+            'bar': make_businesses('bar', 3),
+            # Leaf category
+            'abruzzese': make_businesses('abruzzese', 400),
+        })
+        self.api.start()
+        self.fetcher = Fetcher(
+            is_test=True, api_url=self.api.url, max_qps=1000)
+        self.addCleanup(self.fetcher.close)
+        self.fetcher.max_fetch_limit = 150
+        self.fetcher.progress.destructive_reset(
+            ['foo', 'bar', 'empty', 'abruzzese'])
+
+    def tearDown(self):
+        self.api.stop()
+
+    def test_plan(self):
+        plan = planner.make_plan(self.fetcher)
+        self.assertEqual(plan['split'][0], 'abruzzese')
+        self.assertEqual(plan['totals']['foo'], 120)
+        self.assertEqual(plan['totals']['empty'], 0)
+        self.assertTrue(all(
+            t <= 150 for t in plan['totals'].values()))
+        self.assertEqual(plan['probes'], len(self.api.requests))
+        self.assertTrue(all(r['limit'] == '1' for r in self.api.requests))
+        # Planning doesn't change progress
+        self.assertTrue(self.fetcher.progress.is_incomplete('abruzzese'))
+
+    def test_execute_plan(self):
+        plan = planner.make_plan(self.fetcher)
+        del self.api.requests[:]
+        self.fetcher.fetch_all_businesses(plan)
+        self.assertEqual(len(self.fetcher.store), 523)
+        self.assertEqual(self.fetcher.get_incomplete_categories(), [])
+        # Exactly the planned pages, none of them thrown away
+        self.assertEqual(len(self.api.requests), plan['pages'])
+
+    def test_plan_out_of_quota(self):
+        # The quota runs out while probing abruzzese's geo cells.
+        self.api.daily_quota = 5
+        plan = planner.make_plan(self.fetcher)
+        self.assertIn('abruzzese', plan['split'])
+        self.assertTrue(plan['pending'])
+        self.assertTrue(all(key.startswith('abruzzese')
+                            for key in plan['pending']))
+
+        # The children that weren't probed are still fetched.
+        self.api.daily_quota = None
+        self.fetcher.quota_exceeded.clear()
+        self.fetcher.fetch_all_businesses(plan)
+        self.assertEqual(len(self.fetcher.store), 523)
+        self.assertEqual(self.fetcher.get_incomplete_categories(), [])
+
+    def test_plan_for_other_location(self):
+        plan = planner.make_plan(self.fetcher)
+        plan['location'] = 'Oakland'
+        with self.assertRaises(ValueError):
+            self.fetcher.apply_plan(plan)
+
+
+if __name__ == '__main__':
+    unittest.main()
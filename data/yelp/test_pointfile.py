@@ -0,0 +1,76 @@
+import gzip
+import math
+import os
+import random
+import tempfile
+import unittest
+
+from yelp import pointfile
+
+
+class TestPointFile(unittest.TestCase):
+
+    def assertPointsAlmostEqual(self, decoded, points):
+        lat, lng, values = decoded
+        # Decoded points come back sorted
+        points = sorted(points, key=lambda p: (p[0], p[1]))
+        self.assertEqual(len(lat), len(points))
+        for i, (plat, plng, pvalue) in enumerate(points):
+            self.assertAlmostEqual(lat[i], plat, places=6)
+            self.assertAlmostEqual(lng[i], plng, places=6)
+            if pvalue is None:
+                self.assertTrue(math.isnan(values[i]))
+            else:
+                self.assertEqual(values[i], pvalue)
+
+    def test_roundtrip(self):
+        rng = random.Random(0)
+        coords = [(rng.uniform(37.7, 37.8), rng.uniform(-122.5, -122.4))
+                  for i in range(100)]
+        for values, value_type in [
+            ([rng.randint(1, 4) for c in coords], 0),
+            ([rng.randint(0, 100000) for c in coords], 1),
+            ([rng.choice([1.0, 2.5, 4.5]) for c in coords], 2),
+            ([None] + [1] * (len(coords) - 1), 2),
+        ]:
+            points = [[lat, lng, v] for (lat, lng), v in zip(coords, values)]
+            data = pointfile.encode_point_list(points)
+            self.assertEqual(data[5], value_type)
+            self.assertPointsAlmostEqual(pointfile.decode_points(data), points)
+
+    def test_unplaceable_and_empty(self):
+        data = pointfile.encode_point_list(
+            [[None, None, 1], [37.7, -122.4, 2]])
+        self.assertPointsAlmostEqual(
+            pointfile.decode_points(data), [[37.7, -122.4, 2]])
+        self.assertPointsAlmostEqual(
+            pointfile.decode_points(pointfile.encode_point_list([])), [])
+
+    def test_write_point_file(self):
+        points = [[37.7, -122.4, 2], [37.8, -122.3, None],
+                  [None, None, 1], [37.75, -122.35, 3]]
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, 'points.bin')
+            writer = pointfile.PointFileWriter(path)
+            for point in points:
+                writer.write(point)
+            writer.close()
+            with open(path, 'rb') as f:
+                data = f.read()
+            with open(path + '.gz', 'rb') as f:
+                self.assertEqual(gzip.decompress(f.read()), data)
+        # Same as encoding the points all at once
+        self.assertEqual(data, pointfile.encode_point_list(points))
+        self.assertPointsAlmostEqual(
+            pointfile.decode_points(data), points[:2] + points[3:])
+
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, 'points.bin')
+            pointfile.PointFileWriter(path).close()
+            with open(path, 'rb') as f:
+                self.assertEqual(
+                    f.read(), pointfile.encode_point_list([]))
+
+
+if __name__ == '__main__':
+    unittest.main()
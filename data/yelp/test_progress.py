@@ -1,3 +1,5 @@
+import json
+import os
 import tempfile
 import unittest
 
@@ -54,6 +56,110 @@ class TestProgressMeter(unittest.TestCase):
         self.assertEqual(meter.get_value('c'), ProgressStatus.WONTFIX)
         self.assertEqual(meter.get_value('d'), ProgressStatus.INCOMPLETE)
 
+    def test_cursors(self):
+        path = get_nonexistent_tmp_file_name()
+        meter = ProgressMeter(path=path)
+        meter.add_keys(['a', 'b'])
+        self.assertEqual(meter.get_cursor('a'), None)
+        meter.set_cursor('a', 50, 120)
+        meter.set_cursor('b', 100, 120)
+        # Cursors don't show up as keys
+        self.assertEqual(set(meter.keys()), {'a', 'b'})
+        # and persist
+        self.assertEqual(ProgressMeter(path=path).get_cursor('a'), (50, 120))
+        # Finishing a key clears its cursor
+        meter.mark_complete('a')
+        self.assertEqual(meter.get_cursor('a'), None)
+        meter.destructive_reset(['a'])
+        self.assertEqual(meter.get_cursor('b'), None)
+
+    def test_split(self):
+        meter = ProgressMeter(path=get_nonexistent_tmp_file_name())
+        meter.add_keys(['a'])
+        meter.set_cursor('a', 50, 120)
+        meter.split('a', ['a1', 'a2'])
+        self.assertTrue(meter.is_wontfix('a'))
+        self.assertEqual(meter.get_cursor('a'), None)
+        self.assertTrue(meter.is_incomplete('a1'))
+        self.assertTrue(meter.is_incomplete('a2'))
+
+
+class TestProgressMeterLog(unittest.TestCase):
+
+    def test_replay(self):
+        path = get_nonexistent_tmp_file_name()
+        meter = ProgressMeter(path=path, use_log=True)
+        self.assertEqual(meter.get_data(), {})
+        meter.add_keys(['a', 'b', 'c'])
+        meter.mark_complete('a')
+        meter.mark_wontfix('b')
+        meter.delete_key('c')
+        meter.close()
+        # A fresh meter replays the log
+        meter = ProgressMeter(path=path, use_log=True)
+        self.assertEqual(
+            meter.get_data(),
+            {'a': ProgressStatus.COMPLETE, 'b': ProgressStatus.WONTFIX}
+        )
+        meter.close()
+
+    def test_replay_torn_write(self):
+        path = get_nonexistent_tmp_file_name()
+        meter = ProgressMeter(path=path, use_log=True)
+        meter.add_keys(['a'])
+        meter.close()
+        with open(path + '.log', 'a') as f:
+            f.write('["b", ')
+        # Writes after a restart land after the torn one, and are kept.
+        meter = ProgressMeter(path=path, use_log=True)
+        meter.mark_complete('a')
+        meter.close()
+        meter = ProgressMeter(path=path, use_log=True)
+        self.assertEqual(meter.get_data(), {'a': ProgressStatus.COMPLETE})
+        meter.close()
+
+    def test_compaction(self):
+        path = get_nonexistent_tmp_file_name()
+        meter = ProgressMeter(path=path, use_log=True, compact_threshold=3)
+        meter.add_keys(['a', 'b'])
+        meter.mark_complete('a')  # Triggers compaction
+        meter.mark_complete('b')
+        meter.close()
+        with open(path, 'r') as f:
+            snapshot = json.loads(f.read())
+        self.assertEqual(
+            snapshot,
+            {'a': ProgressStatus.COMPLETE, 'b': ProgressStatus.INCOMPLETE}
+        )
+        self.assertFalse(os.path.exists(path + '.log.old'))
+        meter = ProgressMeter(path=path, use_log=True)
+        self.assertEqual(meter.get_value('b'), ProgressStatus.COMPLETE)
+        meter.close()
+
+    def test_cursors(self):
+        path = get_nonexistent_tmp_file_name()
+        meter = ProgressMeter(path=path, use_log=True)
+        meter.add_keys(['a'])
+        meter.set_cursor('a', 50, 120)
+        meter.close()
+        meter = ProgressMeter(path=path, use_log=True)
+        self.assertEqual(meter.get_cursor('a'), (50, 120))
+        meter.mark_wontfix('a')
+        meter.close()
+        meter = ProgressMeter(path=path, use_log=True)
+        self.assertEqual(meter.get_cursor('a'), None)
+        meter.close()
+
+    def test_load_existing_json(self):
+        path = get_nonexistent_tmp_file_name()
+        meter = ProgressMeter(path=path)
+        meter.add_keys(['a'])
+        meter.mark_wontfix('a')
+        # Existing progress files load unchanged in log mode
+        meter = ProgressMeter(path=path, use_log=True)
+        self.assertEqual(meter.get_value('a'), ProgressStatus.WONTFIX)
+        meter.close()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,143 @@
+import os
+import random
+import tempfile
+import unittest
+
+from yelp.snapshots import (
+    ADDED, CHANGED, REMOVED, SnapshotStore, iter_change_businesses,
+    merge_join, take_snapshot)
+from yelp.store import BusinessStore
+
+
+def make_business(i, rating=3.0):
+    return {
+        'id': 'biz-%04d' % i,
+        'coordinates': {'latitude': 37.7, 'longitude': -122.4},
+        'location': {'city': 'San Francisco'},
+        'rating': rating,
+    }
+
+
+class TestSnapshots(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.store_path = os.path.join(self.dir.name, 'store.sqlite3')
+        self.store = BusinessStore(self.store_path)
+        self.snapshots = SnapshotStore(
+            os.path.join(self.dir.name, 'snapshots.sqlite3'))
+
+    def tearDown(self):
+        self.snapshots.close()
+        self.store.close()
+        self.dir.cleanup()
+
+    def test_merge_join(self):
+        self.assertEqual(
+            list(merge_join([('a',), ('c',)], [('b',), ('c',), ('d',)])),
+            [('a', ('a',), None), ('b', None, ('b',)),
+             ('c', ('c',), ('c',)), ('d', None, ('d',))])
+
+    def test_snapshots(self):
+        self.store.upsert([make_business(i) for i in range(100)])
+        first = self.snapshots.take(self.store, 'first')
+
+        # A few openings, closures and rating changes
+        self.store.upsert([make_business(i) for i in range(100, 103)])
+        self.store.delete(['biz-0000', 'biz-0001'])
+        self.store.upsert([make_business(50, rating=4.5)])
+        second = self.snapshots.take(self.store)
+
+        # The second snapshot is a delta of the changes
+        info = self.snapshots.get_snapshot(second)
+        self.assertEqual(info['base'], first)
+        self.assertEqual(info['size'], 101)
+        self.assertEqual(self.snapshots.conn.execute(
+            'SELECT COUNT(*) FROM entries WHERE snapshot = ?',
+            (second,)).fetchone()[0], 6)
+
+        # Snapshots read back as they were taken
+        self.assertEqual(
+            [id for id, biz in self.snapshots.items(first)],
+            ['biz-%04d' % i for i in range(100)])
+        self.assertEqual(
+            list(self.snapshots.items(second)), list(self.store.items()))
+
+        changes = list(self.snapshots.diff(first, second))
+        self.assertEqual(
+            [(id, change) for id, change, old, new in changes],
+            [('biz-0000', REMOVED), ('biz-0001', REMOVED),
+             ('biz-0050', CHANGED), ('biz-0100', ADDED),
+             ('biz-0101', ADDED), ('biz-0102', ADDED)])
+        self.assertEqual(changes[2][2:], (
+            make_business(50), make_business(50, rating=4.5)))
+        self.assertEqual(
+            self.snapshots.diff_counts(second, first),
+            {ADDED: 2, REMOVED: 3, CHANGED: 1})
+
+        changed = dict(iter_change_businesses(changes))
+        self.assertEqual(changed['biz-0000']['closed'], 1)
+        self.assertEqual(changed['biz-0050']['rating_change'], 1.5)
+        self.assertEqual(changed['biz-0100']['opened'], 1)
+
+    def test_rebase(self):
+        self.store.upsert([make_business(i) for i in range(10)])
+        first = self.snapshots.take(self.store)
+        self.store.upsert([make_business(i, 1.0) for i in range(3)])
+        second = self.snapshots.take(self.store)
+        self.assertEqual(self.snapshots.get_snapshot(second)['base'], first)
+
+        # Too many changes for a delta
+        self.store.upsert([make_business(i, 2.0) for i in range(8)])
+        third = self.snapshots.take(self.store)
+        self.assertIsNone(self.snapshots.get_snapshot(third)['base'])
+        self.assertEqual(
+            list(self.snapshots.items(third)), list(self.store.items()))
+
+        # Snapshots of different bases diff the same as ones of one base
+        self.store.upsert([make_business(9, 5.0)])
+        fourth = self.snapshots.take(self.store)
+        self.assertEqual(self.snapshots.get_snapshot(fourth)['base'], third)
+        self.assertEqual(
+            self.snapshots.diff_counts(second, fourth), {CHANGED: 9})
+        self.assertEqual(self.snapshots.diff_counts(third, fourth),
+                         {CHANGED: 1})
+
+    def test_diff_matches_full_comparison(self):
+        rng = random.Random(0)
+        ids = list(range(200))
+        self.store.upsert([make_business(i) for i in ids])
+        taken = [self.snapshots.take(self.store)]
+        for _ in range(5):
+            self.store.upsert([
+                make_business(rng.randrange(300), rng.choice([1.0, 5.0]))
+                for _ in range(20)])
+            self.store.delete(
+                ['biz-%04d' % rng.randrange(300) for _ in range(5)])
+            taken.append(self.snapshots.take(self.store))
+
+        for old in taken:
+            for new in taken:
+                a = dict(self.snapshots.items(old))
+                b = dict(self.snapshots.items(new))
+                expected = sorted(
+                    [(id, ADDED) for id in b if id not in a] +
+                    [(id, REMOVED) for id in a if id not in b] +
+                    [(id, CHANGED) for id in a if id in b and a[id] != b[id]])
+                self.assertEqual(
+                    [(id, change) for id, change, x, y
+                     in self.snapshots.diff(old, new)],
+                    expected)
+
+    def test_take_snapshot(self):
+        self.store.upsert([make_business(i) for i in range(5)])
+        path = os.path.join(self.dir.name, 'taken.sqlite3')
+        first = take_snapshot('first', path, self.store_path)
+        # Unchanged stores aren't snapshot again
+        self.assertEqual(take_snapshot(None, path, self.store_path), first)
+        self.store.upsert([make_business(5)])
+        self.assertNotEqual(take_snapshot(None, path, self.store_path), first)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import random
+import unittest
+
+import numpy as np
+
+from yelp.spatial import GridIndex, haversine_array
+
+
+class TestGridIndex(unittest.TestCase):
+
+    def setUp(self):
+        rng = random.Random(0)
+        n = 2000
+        self.lat = np.array([rng.uniform(37.7, 37.82) for i in range(n)])
+        self.lng = np.array([rng.uniform(-122.52, -122.35) for i in range(n)])
+        self.lat[5] = self.lng[7] = np.nan  # Unplaceable rows
+        self.index = GridIndex.build(self.lat, self.lng, cell_size=0.01)
+
+    def brute_force_bbox(self, south, west, north, east):
+        return np.flatnonzero(
+            (self.lat >= south) & (self.lat <= north) &
+            (self.lng >= west) & (self.lng <= east))
+
+    def test_bbox(self):
+        for bbox in [
+            (37.75, -122.45, 37.8, -122.4),
+            (37.0, -123.0, 38.0, -122.0),  # Everything
+            (37.7, -122.52, 37.70001, -122.51999),
+            (40.0, -100.0, 41.0, -99.0),  # Nothing
+        ]:
+            self.assertEqual(
+                self.index.bbox(*bbox).tolist(),
+                self.brute_force_bbox(*bbox).tolist())
+
+    def test_radius(self):
+        distances = haversine_array(37.76, -122.44, self.lat, self.lng)
+        self.assertEqual(
+            self.index.radius(37.76, -122.44, 1500).tolist(),
+            np.flatnonzero(distances <= 1500).tolist())
+
+    def test_nearest(self):
+        distances = haversine_array(37.76, -122.44, self.lat, self.lng)
+        distances[np.isnan(distances)] = np.inf
+        for k in [1, 10, 100]:
+            self.assertEqual(
+                self.index.nearest(37.76, -122.44, k).tolist(),
+                np.argsort(distances, kind='stable')[:k].tolist())
+        # Far away from everything
+        self.assertEqual(len(self.index.nearest(0, 0, 3)), 3)
+
+    def test_far_apart(self):
+        # A bogus coordinate at (0, 0) spans millions of cells of the grid,
+        # but only cells with rows are stored.
+        lat = np.append(self.lat, 0.0)
+        lng = np.append(self.lng, 0.0)
+        index = GridIndex.build(lat, lng, cell_size=0.005)
+        self.assertGreater(index.n_cols * index.n_rows, 10 ** 8)
+        self.assertLess(len(index.offsets), len(lat) + 2)
+        bbox = (37.75, -122.45, 37.8, -122.4)
+        self.assertEqual(
+            index.bbox(*bbox).tolist(), self.brute_force_bbox(*bbox).tolist())
+        self.assertEqual(index.bbox(-1, -1, 1, 1).tolist(), [len(lat) - 1])
+        self.assertEqual(index.nearest(0.1, 0.1, 1).tolist(), [len(lat) - 1])
+
+    def test_empty(self):
+        index = GridIndex.build(np.zeros(0), np.zeros(0))
+        self.assertEqual(len(index.bbox(-90, -180, 90, 180)), 0)
+        self.assertEqual(len(index.nearest(0, 0, 5)), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+import json
+import multiprocessing
+import tempfile
+import threading
+import unittest
+
+from yelp.store import (
+    BusinessStore, fingerprint, import_json_file, trim_business)
+
+
+def get_nonexistent_tmp_file_name():
+    f = tempfile.NamedTemporaryFile()
+    fname = f.name
+    f.close()  # File is auto deleted
+    return fname
+
+
+def open_store(path, barrier):
+    barrier.wait()
+    BusinessStore(path).close()
+
+
+class TestBusinessStore(unittest.TestCase):
+
+    def test_upsert(self):
+        store = BusinessStore(get_nonexistent_tmp_file_name())
+        obj1 = {'id': '1', 'name': 'name1'}
+        obj2 = {'id': '2', 'name': 'name2'}
+        store.upsert([obj2, obj1])
+        self.assertEqual(len(store), 2)
+        self.assertIn('1', store)
+        # Items come back in sorted ID order
+        self.assertEqual(list(store.items()), [('1', obj1), ('2', obj2)])
+
+        # Change obj1
+        obj1['name'] = 'new_name1'
+        store.upsert([obj1])
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.get('1'), obj1)
+        self.assertEqual(store.get('3'), None)
+        self.assertEqual(dict(store.get_many(['1', '3'])), {'1': obj1})
+
+        self.assertEqual(
+            dict(store.fingerprints()),
+            {'1': fingerprint(obj1), '2': fingerprint(obj2)})
+
+        store.delete(['2'])
+        self.assertEqual(list(store.ids()), ['1'])
+        store.close()
+
+    def test_changes_since(self):
+        store = BusinessStore(get_nonexistent_tmp_file_name())
+        self.assertEqual(store.last_seq(), 0)
+        obj1 = {'id': '1', 'name': 'name1'}
+        obj2 = {'id': '2', 'name': 'name2'}
+        store.upsert([obj1, obj2])
+        seq = store.last_seq()
+        self.assertEqual(
+            list(store.changes_since(0)), [('1', obj1), ('2', obj2)])
+        self.assertEqual(list(store.changes_since(seq)), [])
+
+        obj3 = {'id': '3', 'name': 'name3'}
+        store.upsert([obj3])
+        store.delete(['1'])
+        self.assertEqual(
+            list(store.changes_since(seq)), [('3', obj3), ('1', None)])
+
+        # Re-adding a deleted business is no longer a deletion
+        store.upsert([obj1])
+        self.assertEqual(
+            list(store.changes_since(seq)), [('1', obj1), ('3', obj3)])
+        store.close()
+
+    def test_concurrent_writers_get_distinct_seqs(self):
+        path = get_nonexistent_tmp_file_name()
+        BusinessStore(path).close()
+
+        def write(writer):
+            store = BusinessStore(path)
+            for i in range(20):
+                store.upsert([{'id': '%d-%d-%d' % (writer, i, j)}
+                              for j in range(5)])
+            store.close()
+        threads = [threading.Thread(target=write, args=(i,))
+                   for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        store = BusinessStore(path)
+        # Every write has a seq of its own
+        self.assertEqual(
+            store.conn.execute(
+                'SELECT seq, COUNT(*) FROM businesses GROUP BY seq '
+                'ORDER BY seq').fetchall(),
+            [(seq, 5) for seq in range(1, 81)])
+        store.close()
+
+    def test_concurrent_open(self):
+        # Crawl workers open each city's new store at about the same time.
+        path = get_nonexistent_tmp_file_name()
+        barrier = multiprocessing.Barrier(8)
+        processes = [
+            multiprocessing.Process(target=open_store, args=(path, barrier))
+            for i in range(8)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        self.assertEqual([p.exitcode for p in processes], [0] * 8)
+
+    def test_trim_business(self):
+        biz = {
+            'id': '1',
+            'name': 'name1',
+            'coordinates': {'latitude': 37.7, 'longitude': -122.4},
+            'location': {'city': 'San Francisco', 'zip_code': '94110'},
+            'rating': 4.5,
+            'review_count': 10,
+            'categories': [{'alias': 'foo', 'title': 'Foo'}],
+        }
+        hot = trim_business(biz)
+        self.assertEqual(hot, {
+            'id': '1',
+            'coordinates': {'latitude': 37.7, 'longitude': -122.4},
+            'location': {'city': 'San Francisco'},
+            'rating': 4.5,
+            'review_count': 10,
+            'categories': [{'alias': 'foo'}],
+        })
+        self.assertEqual(trim_business(hot), hot)
+
+        # Trimmed businesses are stored with the full business's fingerprint
+        store = BusinessStore(get_nonexistent_tmp_file_name())
+        store.upsert([hot], fingerprints=[fingerprint(biz)])
+        self.assertEqual(store.get('1'), hot)
+        self.assertEqual(dict(store.fingerprints()), {'1': fingerprint(biz)})
+        store.close()
+
+    def test_import_json_file(self):
+        json_path = get_nonexistent_tmp_file_name()
+        store_path = get_nonexistent_tmp_file_name()
+        data = {
+            '1': {'id': '1', 'name': 'name1'},
+            '2': {'id': '2', 'name': 'name2'},
+        }
+        with open(json_path, 'w') as f:
+            f.write(json.dumps(data))
+
+        self.assertEqual(import_json_file(json_path, store_path), 2)
+        store = BusinessStore(store_path)
+        self.assertEqual(dict(store.items()), data)
+        store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+import unittest
+
+from yelp import synthetic
+from yelp.yelp_categories import CategoryIndex
+
+
+class TestSynthetic(unittest.TestCase):
+
+    def test_deterministic(self):
+        self.assertEqual(
+            list(synthetic.iter_businesses(50, seed=1)),
+            list(synthetic.iter_businesses(50, seed=1)))
+        self.assertNotEqual(
+            list(synthetic.iter_businesses(50, seed=1)),
+            list(synthetic.iter_businesses(50, seed=2)))
+
+    def test_categories(self):
+        categories = synthetic.make_categories(200, top_level=10)
+        index = CategoryIndex(categories)
+        self.assertEqual(len(index.top_level), 10)
+        # Every category descends from a top level category
+        for alias in index.aliases[10:]:
+            self.assertTrue(
+                set(index.ancestors[alias]) & set(index.top_level))
+
+        aliases = set(index.aliases)
+        for biz in synthetic.iter_businesses(100, categories=categories):
+            self.assertTrue(biz['categories'])
+            for c in biz['categories']:
+                self.assertIn(c['alias'], aliases)
+
+
+if __name__ == '__main__':
+    unittest.main()
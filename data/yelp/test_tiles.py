@@ -0,0 +1,58 @@
+import random
+import unittest
+
+from yelp import tiles
+
+
+class TestTiles(unittest.TestCase):
+
+    def test_to_tile(self):
+        self.assertEqual(tiles.to_tile(0.1, 0.1, 1), (1, 0))
+        self.assertEqual(tiles.to_tile(-0.1, -0.1, 1), (0, 1))
+        # San Francisco, as on the OSM tile server
+        self.assertEqual(tiles.to_tile(37.75, -122.41, 12), (655, 1583))
+
+    def test_tile_bounds(self):
+        south, west, north, east = tiles.tile_bounds(12, 655, 1583)
+        self.assertTrue(south < 37.75 < north and west < -122.41 < east)
+        # Points just inside each corner are in the tile
+        for lat in (south + 1e-9, north - 1e-9):
+            for lng in (west + 1e-9, east - 1e-9):
+                self.assertEqual(tiles.to_tile(lat, lng, 12), (655, 1583))
+
+    def test_pyramid(self):
+        rng = random.Random(0)
+        points = [
+            [rng.uniform(37.7, 37.8), rng.uniform(-122.5, -122.4),
+             rng.randint(1, 4)]
+            for i in range(200)
+        ]
+        points.append([None, None, 1])  # Can't be placed
+        points.append([37.75, -122.45, None])  # No value to aggregate
+        pyramid = tiles.TilePyramid(10, 14)
+        for point in points:
+            pyramid.add(point)
+
+        by_zoom = {}
+        for (z, x, y), contents in pyramid.tiles():
+            by_zoom.setdefault(z, []).extend(contents)
+        self.assertEqual(sorted(by_zoom), [10, 11, 12, 13, 14])
+        # Max zoom tiles hold exactly the placeable points
+        self.assertEqual(
+            sorted(by_zoom[14], key=str), sorted(points[:200] + points[-1:],
+                                                  key=str))
+        # Bins at every other zoom add up to all the values
+        for z in range(10, 14):
+            self.assertEqual(sum(b[3] for b in by_zoom[z]), 200)
+            self.assertEqual(
+                sum(b[2] for b in by_zoom[z]),
+                sum(p[2] for p in points[:200]))
+            for lat, lng, total, count, mean in by_zoom[z]:
+                self.assertEqual(mean, total / count)
+                self.assertTrue(37.7 <= lat <= 37.8)
+        # Coarser zooms have fewer bins
+        self.assertLess(len(by_zoom[10]), len(by_zoom[13]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import json
+import os
+import tempfile
+import unittest
+
+from yelp.yelp_categories import load_category_index
+
+
+CATEGORIES = [
+    {'alias': 'food', 'parents': []},
+    {'alias': 'restaurants', 'parents': []},
+    {'alias': 'bakeries', 'parents': ['food']},
+    {'alias': 'italian', 'parents': ['restaurants']},
+    {'alias': 'abruzzese', 'parents': ['italian']},
+    {'alias': 'cafes', 'parents': ['food', 'restaurants']},
+]
+
+
+class TestCategoryIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'categories.json')
+        self.cache_path = os.path.join(self.dir.name, 'index.pickle')
+        with open(self.path, 'w') as f:
+            f.write(json.dumps(CATEGORIES))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_index(self):
+        index = load_category_index(self.path, self.cache_path)
+        self.assertEqual(index.top_level, ('food', 'restaurants'))
+        self.assertEqual(index.children['food'], ('bakeries', 'cafes'))
+        self.assertEqual(index.parents['cafes'], ('food', 'restaurants'))
+        self.assertEqual(
+            index.descendants['restaurants'], ('italian', 'cafes', 'abruzzese'))
+        self.assertEqual(index.ancestors['abruzzese'], ('italian', 'restaurants'))
+        self.assertEqual(index.children['abruzzese'], ())
+
+    def test_cache(self):
+        load_category_index(self.path, self.cache_path)
+        self.assertTrue(os.path.exists(self.cache_path))
+        # Served from cache, without parsing categories.json
+        stat = os.stat(self.path)
+        with open(self.path, 'w') as f:
+            f.write(' ' * stat.st_size)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        index = load_category_index(self.path, self.cache_path)
+        self.assertEqual(index.top_level, ('food', 'restaurants'))
+
+        # Rebuilt when categories.json changes
+        with open(self.path, 'w') as f:
+            f.write(json.dumps(CATEGORIES[:1]))
+        index = load_category_index(self.path, self.cache_path)
+        self.assertEqual(index.top_level, ('food',))
+
+
+if __name__ == '__main__':
+    unittest.main()
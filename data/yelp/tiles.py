@@ -0,0 +1,112 @@
+'''
+Web Mercator tile pyramid of pre-aggregated heatmap points, so the map only
+downloads what's in view at the current zoom.
+
+Tiles are the usual 256px slippy-map tiles, addressed `<z>/<x>/<y>`. Below
+`max_zoom`, each tile is a grid of `BIN_SIZE`px bins, each bin written as
+    `[lat, lng, sum, count, mean]`
+where `lat, lng` is the centroid of the points in it. At `max_zoom`, tiles
+hold the raw `[lat, lng, value]` points, so together they are exactly the
+layer's points (less any without coordinates).
+'''
+
+import math
+
+TILE_SIZE = 256
+BIN_SIZE = 16
+
+# Web Mercator can't represent the poles.
+MAX_LATITUDE = 85.0511287798
+
+
+def to_pixel(lat, lng, zoom):
+    '''Global pixel coordinates of a point at `zoom`.'''
+    lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))
+    scale = TILE_SIZE * (1 << zoom)
+    x = (lng + 180) / 360 * scale
+    sin = math.sin(math.radians(lat))
+    y = (0.5 - math.log((1 + sin) / (1 - sin)) / (4 * math.pi)) * scale
+    return x, y
+
+
+def to_tile(lat, lng, zoom):
+    x, y = to_pixel(lat, lng, zoom)
+    return int(x // TILE_SIZE), int(y // TILE_SIZE)
+
+
+def tile_bounds(z, x, y):
+    '''`(south, west, north, east)` of a tile.'''
+    n = 1 << z
+
+    def lat(y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    return lat(y + 1), x / n * 360 - 180, lat(y), (x + 1) / n * 360 - 180
+
+
+def bin_key(lat, lng, zoom):
+    '''`(zoom, tile x, tile y, bin x, bin y)` that a point falls in.'''
+    x, y = to_pixel(lat, lng, zoom)
+    bx, by = int(x // BIN_SIZE), int(y // BIN_SIZE)
+    bins_per_tile = TILE_SIZE // BIN_SIZE
+    return (zoom, bx // bins_per_tile, by // bins_per_tile, bx, by)
+
+
+class Bin():
+    '''Running aggregate of the points in a bin.'''
+    __slots__ = ['lat_sum', 'lng_sum', 'sum', 'count']
+
+    def __init__(self):
+        self.lat_sum = self.lng_sum = self.sum = 0
+        self.count = 0
+
+    def add(self, lat, lng, value):
+        self.lat_sum += lat
+        self.lng_sum += lng
+        self.sum += value
+        self.count += 1
+
+    def to_list(self):
+        return [
+            self.lat_sum / self.count, self.lng_sum / self.count,
+            self.sum, self.count, self.sum / self.count,
+        ]
+
+
+class TilePyramid():
+    '''Tiles of one layer, from zoom `min_zoom` through `max_zoom`.'''
+
+    def __init__(self, min_zoom, max_zoom):
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.bins = {}  # bin key -> Bin
+        self.points = {}  # (max_zoom, x, y) -> [points]
+
+    def add(self, point):
+        lat, lng, value = point
+        if lat is None or lng is None:
+            return
+        self.points.setdefault(
+            (self.max_zoom,) + to_tile(lat, lng, self.max_zoom), []
+        ).append(point)
+        if value is None:
+            return
+        for zoom in range(self.min_zoom, self.max_zoom):
+            key = bin_key(lat, lng, zoom)
+            b = self.bins.get(key)
+            if b is None:
+                b = self.bins[key] = Bin()
+            b.add(lat, lng, value)
+
+    def tiles(self):
+        '''Yield `((z, x, y), tile contents)` for every non-empty tile.'''
+        tiles = {}
+        for key in sorted(self.bins):
+            b = self.bins[key]
+            if b.count:
+                tiles.setdefault(key[:3], []).append(b.to_list())
+        yield from tiles.items()
+        yield from self.points.items()
+
+
+def tile_path(root, layer_name, z, x, y):
+    return '%s/%s/%d/%d/%d.json' % (root, layer_name, z, x, y)
@@ -3,19 +3,31 @@ Fetch data from Yelp API such that we circumvent the download limits and can
 pause/resume progress when we are rate limited or crash.
 '''
 
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 import json
 import logging
 import os
 import pprint
+import random
 import requests
+import shutil
 import sys
 import tempfile
+import threading
+import time
 
+from . import geo
 from . import util
-from . import persist
+from .archive import ResponseArchive
+from .cache import CacheMiss, ResponseCache
+from .metrics import NULL_METRICS, Metrics
 from .progress import ProgressMeter, ProgressStatus
+from .ratelimit import TokenBucket
 from .settings import *
+from .snapshots import take_snapshot
+from .store import BusinessStore, fingerprint, trim_business
 from . import yelp_categories
 
 logger = logging.getLogger(__name__)
@@ -26,6 +38,7 @@ logger.setLevel(logging.INFO)
 class MyError(Enum):
     API_ERROR = 1
     API_EXCEEDED_FETCH_LIMIT = 2
+    API_DAILY_QUOTA_EXCEEDED = 3
 
 
 # Yelp API constants
@@ -34,128 +47,427 @@ YELP_SEARCH_API_URL = 'https://api.yelp.com/v3/businesses/search'
 YELP_MAX_FETCH_LIMIT = 1000
 YELP_REQUEST_FETCH_LIMIT = 50
 
+# Error code returned once the daily API quota is used up.
+YELP_QUOTA_ERROR_CODE = 'ACCESS_LIMIT_REACHED'
+
+
+class RetryableError(Exception):
+    '''A transient API failure, worth retrying after backing off.'''
+
 
 class Fetcher(object):
 
     # Auth
 
-    def __init__(self, is_test=False):
+    def __init__(self, is_test=False, api_url=YELP_SEARCH_API_URL,
+                 concurrency=FETCH_CONCURRENCY, max_qps=YELP_MAX_QPS,
+                 cache=None, metrics=None, location=SEARCH_LOCATION,
+                 bounds=SEARCH_BOUNDS, progress=None, store=None,
+                 archive=None, rate_limiter=None):
+        '''
+        Search `location`, splitting searches into geo cells within `bounds`
+        (if known) when needed. `progress`, `store` and `archive` default to
+        the local progress file, business store and raw archive.
+        `rate_limiter`, anything with an `acquire()` method, defaults to a
+        `TokenBucket` of `max_qps`.
+        '''
         tlc = yelp_categories.get_top_level_categories()
+        self.location = location
+        self.bounds = bounds
+
+        if metrics is None:
+            metrics = NULL_METRICS
+            if YELP_METRICS_PATH and not is_test:
+                metrics = Metrics(YELP_METRICS_PATH, YELP_METRICS_INTERVAL)
+        self.metrics = metrics
 
         if is_test:
-            self.progress = ProgressMeter(tempfile.TemporaryFile().name)
-            self.search_data_path = tempfile.TemporaryFile().name
+            store_path = tempfile.NamedTemporaryFile().name
+        else:
+            store_path = BUSINESS_STORE_PATH
+        self.store = store if store is not None else BusinessStore(store_path)
+
+        # A temporary archive for tests, removed by `close`.
+        self.temp_archive_path = None
+        if archive is None:
+            if is_test:
+                self.temp_archive_path = tempfile.mkdtemp()
+            archive = ResponseArchive(
+                self.temp_archive_path or RAW_ARCHIVE_PATH)
+        self.archive = archive
+
+        if progress is not None:
+            self.progress = progress
         else:
-            self.progress = ProgressMeter(PROGRESS_PATH)
-            self.search_data_path = SEARCH_API_DATA_PATH
+            if is_test:
+                self.progress = ProgressMeter(
+                    tempfile.NamedTemporaryFile().name, metrics=metrics)
+            else:
+                self.progress = ProgressMeter(
+                    PROGRESS_PATH, use_log=True, metrics=metrics)
+            # This won't overwrite existing progress
+            self.progress.add_keys(tlc)
+        self.max_fetch_limit = YELP_MAX_FETCH_LIMIT
+
+        if cache is None and YELP_CACHE_MODE and not is_test:
+            cache = ResponseCache(
+                RESPONSE_CACHE_PATH, mode=YELP_CACHE_MODE,
+                ttl=YELP_CACHE_TTL, max_bytes=YELP_CACHE_MAX_BYTES)
+        self.cache = cache
+
+        # Concurrency
+        self.api_url = api_url
+        self.concurrency = max(1, concurrency)
+        self.rate_limiter = rate_limiter if rate_limiter is not None \
+            else TokenBucket(max_qps)
+        self.max_retries = YELP_MAX_RETRIES
+        self.backoff_base = YELP_BACKOFF_BASE
+        self.backoff_max = YELP_BACKOFF_MAX
+        self.quota_exceeded = threading.Event()
+        # Serializes progress and business store writes across workers.
+        self.write_lock = threading.RLock()
+        # Counts of 'inserted', 'updated' and 'unchanged' businesses.
+        self.persist_stats = Counter()
+        # Pooled keep-alive connections, one per worker.
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def close(self):
+        '''Close connections, and remove a temporary archive.'''
+        self.session.close()
+        if self.temp_archive_path is not None:
+            self.archive.close()
+            shutil.rmtree(self.temp_archive_path, ignore_errors=True)
+            self.temp_archive_path = None
+
+    def request(self, params):
+        '''
+        Return the decoded API response for `params`, from the response
+        cache if we have one.
+        Transient failures are retried with backoff; returns None if they
+        persist, or if a replay-only cache doesn't have the response.
+        '''
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                delay = self.backoff_delay(attempt)
+                logger.info('Retrying in %.1fs (attempt %d of %d).' % (
+                    delay, attempt, self.max_retries))
+                self.metrics.inc('yelp_retries_total')
+                time.sleep(delay)
+            try:
+                if self.cache is not None:
+                    return self.cache.fetch(
+                        self.api_url, params, self.api_request)
+                return self.api_request(params)
+            except RetryableError as e:
+                logger.warning('Transient API error: %s' % e)
+            except CacheMiss as e:
+                logger.error(e)
+                return None
+        logger.error('Giving up after %d retries.' % self.max_retries)
+        return None
+
+    def backoff_delay(self, attempt):
+        '''Seconds to wait before retry number `attempt`: "full jitter".'''
+        return random.uniform(0, min(
+            self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
 
-        self.progress.add_keys(tlc)  # This won't overwrite existing progress
+    def api_request(self, params):
+        '''
+        Make a rate-limited API request and return the decoded response.
+        Flags `quota_exceeded` if the daily API quota has been reached.
+        Raises `RetryableError` for failures that are worth retrying.
+        '''
+        self.rate_limiter.acquire()
+        try:
+            with self.metrics.time('yelp_request_seconds'):
+                resp = self.session.get(
+                    url=self.api_url, params=params, headers=YELP_AUTH_HEADER)
+                response_json = resp.json()
+        except (requests.ConnectionError, requests.Timeout, ValueError) as e:
+            self.metrics.inc('yelp_api_errors_total', code=type(e).__name__)
+            raise RetryableError(repr(e))
+        if self.metrics.enabled:
+            self.record_response_metrics(resp)
+        error = response_json.get('error')
+        if error is None:
+            return response_json
+        code = error.get('code')
+        self.metrics.inc('yelp_api_errors_total', code=code)
+        if code == YELP_QUOTA_ERROR_CODE:
+            logger.error('Daily API quota reached. Stopping.')
+            self.quota_exceeded.set()
+        elif resp.status_code >= 500 or resp.status_code == 429:
+            raise RetryableError('%d %s' % (resp.status_code, code))
+        return response_json
+
+    def record_response_metrics(self, resp):
+        '''Record response size, and the daily quota Yelp reports left.'''
+        self.metrics.inc('yelp_response_bytes_total', len(resp.content))
+        for header, name in (
+            ('RateLimit-DailyLimit', 'yelp_quota_daily_limit'),
+            ('RateLimit-Remaining', 'yelp_quota_remaining'),
+        ):
+            value = resp.headers.get(header)
+            if value is None:
+                continue
+            try:
+                self.metrics.set(name, float(value))
+            except ValueError:
+                logger.warning('Unparseable %s header: %s' % (header, value))
 
     def persist_search_results(self, response_json):
         '''
-        Persist data from the Yelp v3/businesses/search API to local JSON.
-        Save format: key value store where
-            key = unique yelp business ID
-            value = JSON representation of business as returned by API
-        '''
-        def my_update_fn(old_data, new_data):
-            '''Update dict with 'id' field as key'''
-            for biz in new_data:
-                old_data[biz.get('id')] = biz
-            return old_data
-        persist.update_json_file(
-            self.search_data_path,
-            response_json.get('businesses'),
-            update_fn=my_update_fn)
-
-    def fetch_all_businesses(self):
+        Persist data from the Yelp v3/businesses/search API to the local
+        business store, keyed on unique yelp business ID.
+        Businesses that are unchanged since they were last stored, e.g. ones
+        listed under several categories, aren't rewritten. They are looked
+        up in the store page by page, so writes by other processes sharing
+        it count too.
+        Changed businesses are archived as returned, and stored trimmed to
+        what the transforms need. Every business is marked as seen by this
+        crawl.
+        '''
+        businesses = response_json.get('businesses') or []
+        with self.write_lock:
+            stored = self.store.get_fingerprints(
+                biz['id'] for biz in businesses)
+            self.store.mark_seen(biz['id'] for biz in businesses)
+            changed = {}
+            fingerprints = {}
+            for biz in businesses:
+                fp = fingerprint(biz)
+                old = fingerprints.get(biz['id'], stored.get(biz['id']))
+                if old == fp:
+                    self.persist_stats['unchanged'] += 1
+                    continue
+                self.persist_stats[
+                    'inserted' if old is None else 'updated'] += 1
+                fingerprints[biz['id']] = fp
+                changed[biz['id']] = biz
+            if changed:
+                with self.metrics.time('yelp_store_write_seconds'):
+                    # Archive first, so a stored business is always archived.
+                    self.archive.append(changed.values())
+                    self.store.upsert(
+                        [trim_business(biz) for biz in changed.values()],
+                        fingerprints=[fingerprints[id] for id in changed])
+
+    def get_incomplete_categories(self):
+        with self.write_lock:
+            return [
+                k for k, v in self.progress.get_data().items()
+                if v is ProgressStatus.INCOMPLETE
+            ]
+
+    def fetch_all_businesses(self, plan=None):
+        '''
+        Fetch all incomplete keys, narrowing searches down as needed.
+        With a `plan`, first set up progress to follow it.
+        '''
+        if plan is not None:
+            self.apply_plan(plan)
+
         complete_categories = [
             k for k, v in self.progress.get_data().items()
             if v is ProgressStatus.COMPLETE
         ]
         print("complete categories", len(complete_categories))
 
-        incomplete_categories = [
-            k for k, v in self.progress.get_data().items()
-            if v is ProgressStatus.INCOMPLETE
-        ]
+        incomplete_categories = self.get_incomplete_categories()
         print("incomplete categories", len(incomplete_categories))
 
-        for cat in incomplete_categories:
-            # search_category = 'convenience'  # 235
-            # search_category = 'food'  # 3500
-            params = {
-                'location': 'San Francisco',
-                'term': '',
-                'offset': 0,
-                'limit': YELP_REQUEST_FETCH_LIMIT,
-                # 'open_at': 1571081461,
-                'categories': cat,
-                # 'pricing_filter': '1, 2',
-                # 'sort_by': 'rating',
-            }
-            self.fetch_businesses_by_params(params)
+        # Narrowing down a category adds child categories to the progress
+        # meter, so keep going until there is nothing new left to try.
+        attempted = set()
+        self.metrics.start()
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                while not self.quota_exceeded.is_set():
+                    categories = [
+                        c for c in self.get_incomplete_categories()
+                        if c not in attempted
+                    ]
+                    if not categories:
+                        break
+                    attempted.update(categories)
+                    # Consume results so that worker exceptions propagate.
+                    list(executor.map(self.fetch_category, categories))
+        finally:
+            self.metrics.stop()
 
-    def fetch_businesses_by_params(self, params):
-        category = params.get('categories')
+        print("inserted %(inserted)d, updated %(updated)d, "
+              "unchanged %(unchanged)d businesses" % self.persist_stats)
 
-        if self.progress.is_complete(category) == True:
-            logger.info(
-                "Category %s is already completed. Skipping." % category)
-            return
-        if self.progress.is_wontfix(category) == True:
-            logger.info("Category %s is marked wontfix. Skipping." % category)
+    def fetch_category(self, key):
+        '''
+        Fetch all businesses for a progress key: a category, optionally
+        restricted to a geo cell. See `geo.py`.
+        '''
+        if self.quota_exceeded.is_set():
             return
+        # search_category = 'convenience'  # 235
+        # search_category = 'food'  # 3500
+        params = {
+            'term': '',
+            'offset': 0,
+            'limit': YELP_REQUEST_FETCH_LIMIT,
+            # 'open_at': 1571081461,
+            # 'pricing_filter': '1, 2',
+            # 'sort_by': 'rating',
+        }
+        params.update(geo.search_params(key, self.location))
+        self.fetch_businesses_by_params(params, key=key)
 
-        # Make API request
-        resp = requests.get(
-            url=YELP_SEARCH_API_URL, params=params, headers=YELP_AUTH_HEADER)
-        if resp.json().get('error') is not None:
-            logger.error(
-                'API error - %s' % resp.json()['error'].get('description'))
-            pprint.pprint(resp.json())
-            return
+    def fetch_businesses_by_params(self, params, key=None):
+        if key is None:
+            key = params.get('categories')
 
-        # Dump business info
-        total = resp.json()['total']
-        if params['offset'] == 0:
-            logger.info("Category %s - %d results" % (category, total))
-        if total == 0:
-            self.progress.mark_complete(category)
+        if self.progress.is_complete(key) == True:
+            logger.info("Key %s is already completed. Skipping." % key)
+            return
+        if self.progress.is_wontfix(key) == True:
+            logger.info("Key %s is marked wontfix. Skipping." % key)
             return
+        cursor = self.progress.get_cursor(key)
+        if cursor is not None:
+            params['offset'] = cursor[0]
+            logger.info("Key %s - resuming at offset=%d of %d" % (
+                key, cursor[0], cursor[1]))
+
+        while not self.quota_exceeded.is_set():
+            # Make API request
+            response_json = self.request(params)
+            if response_json is None:
+                # Out of retries; the cursor resumes at this page next time.
+                return
+            if response_json.get('error') is not None:
+                logger.error('API error - %s' %
+                             response_json['error'].get('description'))
+                pprint.pprint(response_json)
+                return
 
-        # Save data
-        self.persist_search_results(resp.json())
+            self.metrics.inc(
+                'yelp_pages_total', category=geo.parse_key(key)[0])
 
-        # If within API single request limit, return current results.
-        if total <= YELP_REQUEST_FETCH_LIMIT:
-            self.progress.mark_complete(category)
-            return
-        # If we need to fetch more but within the API limit, fetch them all now.
-        if total <= YELP_MAX_FETCH_LIMIT:
+            # Dump business info
+            total = response_json['total']
+            if params['offset'] == 0:
+                logger.info("Key %s - %d results" % (key, total))
+            if total == 0:
+                with self.write_lock:
+                    self.progress.mark_complete(key)
+                return
+
+            # Save data
+            self.persist_search_results(response_json)
+
+            # If within API single request limit, return current results.
+            if total <= YELP_REQUEST_FETCH_LIMIT:
+                with self.write_lock:
+                    self.progress.mark_complete(key)
+                return
+            # Otherwise, must narrow down search to get under API limit.
+            if total > self.max_fetch_limit:
+                logger.info("\tExceeded API limit. Narrowing down search.")
+                self.narrow_search(key, total)
+                return
+            # Within the API limit: fetch the next page, if any.
             if params['offset'] + params['limit'] >= total:
-                self.progress.mark_complete(category)
+                with self.write_lock:
+                    self.progress.mark_complete(key)
                 return
             params['offset'] += YELP_REQUEST_FETCH_LIMIT
+            with self.write_lock:
+                self.progress.set_cursor(key, params['offset'], total)
             logger.info("Fetch next page; offset=%d" % params['offset'])
-            self.fetch_businesses_by_params(params)
-            return
 
-        # Otherwise, must narrow down search to get under API limit.
-        logger.info("\tExceeded API limit. Narrowing down search.")
-        category = params.get('categories', '')
+    def narrow_search(self, key, total):
+        '''
+        Split a key whose results exceed the API limit into smaller searches,
+        by child category or geo cell, whichever should take fewer requests.
+        '''
+        new_keys = self.split_key(key, total)
+        # Mark parent key as wontfix, and add the new keys to try.
+        with self.write_lock:
+            self.progress.split(key, new_keys)
+
+    def split_key(self, key, total):
+        '''
+        The keys to search instead of `key`, which has `total` results. Empty
+        if it can't be split any further.
+        '''
+        category, cell = geo.parse_key(key)
         child_categories = yelp_categories.get_child_categories(category)
+        strategy = geo.choose_split(
+            total, len(child_categories),
+            YELP_REQUEST_FETCH_LIMIT, self.max_fetch_limit)
+        if cell is None and self.bounds is None:
+            # Can't split a location we don't know the bounds of.
+            strategy = geo.SplitStrategy.CATEGORY
 
-        if child_categories is []:
-            raise Exception((
-                "Data for category %s cannot be fully fetched because it has "
-                "no child categories and exceeds API limit"
-            ) % category)
+        if strategy == geo.SplitStrategy.CATEGORY:
+            new_keys = [geo.make_key(c, cell) for c in child_categories]
+            if not new_keys:
+                logger.error(
+                    "Data for %s cannot be fully fetched because it exceeds "
+                    "the API limit and %s has no search bounds" % (
+                        key, self.location))
+        else:
+            if cell is None:
+                cell = geo.Cell(*self.bounds)
+            if cell.radius < 2 * geo.MIN_CELL_RADIUS_METERS:
+                logger.error((
+                    "Data for %s cannot be fully fetched because it exceeds "
+                    "the API limit within a %dm radius"
+                ) % (key, cell.radius))
+                new_keys = []
+            else:
+                new_keys = [geo.make_key(category, c) for c in cell.split()]
+        logger.info("\tSplitting %s by %s into %d searches." % (
+            key, strategy, len(new_keys)))
+        return new_keys
 
-        # Mark parent category as wontfix, and add the new categories to try.
-        self.progress.mark_wontfix(category)
-        self.progress.add_keys(child_categories)
-        return None, []
+    def apply_plan(self, plan):
+        '''
+        Set up progress to fetch exactly the keys of a plan made by
+        `planner.make_plan`, without probing or narrowing again. Its pending
+        keys weren't probed, so are fetched (and narrowed) as usual.
+        '''
+        if plan['location'] != self.location:
+            raise ValueError('Plan is for %s, not %s' % (
+                plan['location'], self.location))
+        with self.write_lock:
+            for key in plan['split'] + plan['unfetchable']:
+                self.progress.mark_wontfix(key)
+            self.progress.add_keys(
+                list(plan['totals']) + plan.get('pending', []))
+            for key, total in plan['totals'].items():
+                if total == 0:
+                    self.progress.mark_complete(key)
+
+    def finish_crawl(self, snapshots_path=SNAPSHOTS_PATH):
+        '''
+        Wrap up a complete crawl: delete businesses it didn't return, which
+        have closed (or moved out of the searched area), snapshot the store
+        to compare with other crawls, and start a new crawl.
+        Returns the snapshot's ID.
+        '''
+        with self.write_lock:
+            # A crawl that returned nothing, e.g. one finished before seen
+            # businesses were recorded, can't tell what closed.
+            if self.store.n_seen():
+                closed = self.store.unseen_ids()
+                if closed:
+                    logger.info('%d businesses closed.' % len(closed))
+                    self.store.delete(closed)
+            snapshot = take_snapshot(
+                path=snapshots_path, store_path=self.store.path)
+            self.store.clear_seen()
+        return snapshot
 
     def multi_fetch_businesses_by_params(self, params, total_results):
         '''
@@ -173,4 +485,14 @@ class Fetcher(object):
 
 
 def main():
-    Fetcher().fetch_all_businesses()
+    '''Usage: fetch_yelp_data.py [path/to/crawl_plan.json]'''
+    plan = None
+    if len(sys.argv) > 1:
+        from .planner import load_plan
+        plan = load_plan(sys.argv[1])
+    fetcher = Fetcher()
+    fetcher.fetch_all_businesses(plan)
+    # Snapshot each complete crawl, to compare crawls over time.
+    if not fetcher.quota_exceeded.is_set() and \
+            not fetcher.get_incomplete_categories():
+        print("snapshot", fetcher.finish_crawl())
@@ -1,40 +1,150 @@
 '''
 Convenience methods over all Yelp API categories, as downloaded from:
     https://www.yelp.com/developers/documentation/v3/all_category_list
+
+The category hierarchy is indexed once and cached to `CATEGORY_INDEX_PATH`,
+so later processes skip parsing `categories.json`. The cache is rebuilt when
+`categories.json` changes or `CATEGORY_INDEX_VERSION` is bumped.
 '''
 
 import json
+import logging
+import os
+import pickle
+import tempfile
 
 from . import util
 
+logger = logging.getLogger(__name__)
+
+CATEGORIES_PATH = util.localize_path('categories.json')
+CATEGORY_INDEX_PATH = util.localize_path('categories.index.pickle')
+# Bump when the layout of `CategoryIndex` changes.
+CATEGORY_INDEX_VERSION = 1
+
 all_categories = None
 top_level_categories = None
+category_index = None
+
+
+class CategoryIndex():
+    '''
+    Lookup tables over the category hierarchy. Every table maps an alias to a
+    tuple of aliases, in `categories.json` order.
+    '''
+
+    def __init__(self, categories):
+        self.aliases = tuple(c['alias'] for c in categories)
+        self.parents = {
+            c['alias']: tuple(c.get('parents', [])) for c in categories}
+        children = {alias: [] for alias in self.aliases}
+        for c in categories:
+            for parent in c.get('parents', []):
+                children.setdefault(parent, []).append(c['alias'])
+        self.children = {k: tuple(v) for k, v in children.items()}
+        self.top_level = tuple(
+            alias for alias in self.aliases if not self.parents[alias])
+        self.descendants = {
+            alias: self._closure(alias, self.children)
+            for alias in self.children}
+        self.ancestors = {
+            alias: self._closure(alias, self.parents)
+            for alias in self.parents}
+
+    @staticmethod
+    def _closure(alias, edges):
+        '''All aliases reachable from `alias` along `edges`, breadth first.'''
+        found = []
+        seen = {alias}
+        frontier = list(edges.get(alias, ()))
+        while frontier:
+            next_frontier = []
+            for a in frontier:
+                if a not in seen:
+                    seen.add(a)
+                    found.append(a)
+                    next_frontier.extend(edges.get(a, ()))
+            frontier = next_frontier
+        return tuple(found)
+
+
+def build_category_index(path=CATEGORIES_PATH):
+    with open(path, 'r') as f:
+        return CategoryIndex(json.loads(f.read()))
+
+
+def _source_signature(path):
+    stat = os.stat(path)
+    return (CATEGORY_INDEX_VERSION, stat.st_mtime_ns, stat.st_size)
+
+
+def load_category_index(path=CATEGORIES_PATH, cache_path=CATEGORY_INDEX_PATH):
+    '''
+    Load the category index from cache, rebuilding the cache if it is missing
+    or stale.
+    '''
+    signature = _source_signature(path)
+    try:
+        with open(cache_path, 'rb') as f:
+            cached_signature, index = pickle.load(f)
+        if cached_signature == signature:
+            return index
+        logger.info('Category index cache is stale. Rebuilding.')
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError,
+            AttributeError, ImportError, ValueError):
+        logger.info('No usable category index cache. Building.')
+
+    index = build_category_index(path)
+    try:
+        with tempfile.NamedTemporaryFile(
+                dir=os.path.dirname(cache_path), delete=False) as f:
+            pickle.dump((signature, index), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(f.name, cache_path)
+    except OSError:
+        logger.warning('Could not write category index cache %s' % cache_path)
+    return index
 
 
 def load_categories():
     '''Load all Yelp categories into global namespace'''
-    global all_categories, top_level_categories
+    global all_categories
 
     if all_categories is None:
-        with open(util.localize_path('categories.json'), 'r') as f:
+        with open(CATEGORIES_PATH, 'r') as f:
             all_categories = json.loads(f.read())  # All yelp categories
 
-    if top_level_categories is None:
-        top_level_categories = [
-            c['alias'] for c in
-            filter(lambda c: c.get('parents', []) == [], all_categories)
-        ]
+
+def get_category_index():
+    global category_index, top_level_categories
+
+    if category_index is None:
+        category_index = load_category_index()
+        top_level_categories = list(category_index.top_level)
+    return category_index
 
 
 def get_top_level_categories():
-    load_categories()
+    get_category_index()
     return top_level_categories
 
 
 def get_child_categories(parent_category):
-    load_categories()
-    return [
-        c['alias'] for c in filter(
-            lambda c: parent_category in c.get('parents', []), all_categories
-        )
-    ]
+    return list(get_category_index().children.get(parent_category, ()))
+
+
+def get_parent_categories(category):
+    return list(get_category_index().parents.get(category, ()))
+
+
+def get_descendant_categories(category):
+    '''All categories below `category` in the hierarchy.'''
+    return list(get_category_index().descendants.get(category, ()))
+
+
+def get_ancestor_categories(category):
+    '''All categories above `category` in the hierarchy.'''
+    return list(get_category_index().ancestors.get(category, ()))
+
+
+def is_leaf_category(category):
+    return not get_category_index().children.get(category)
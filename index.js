@@ -27,30 +27,197 @@ $("#map").ready(function(){
 	}
 
   function addPointsToMap(layerName, points) {
-    mapLayerControl.addBaseLayer(
-      L.heatLayer(points, defaultMapOptions).addTo(map),
-      layerName
-    );
+    var heatLayer = L.heatLayer(points, defaultMapOptions).addTo(map);
+    mapLayerControl.addBaseLayer(heatLayer, layerName);
 		$(mapLayerControl._form).find('input[type=radio]')[0].click();
+    return heatLayer;
   }
 
-  // Load local JSON data
-  $.getJSON("data/yelp_price_points.json", function(points) {
-    points = filterPointsToBounds(points);
-    addPointsToMap("Business price point", points);
-  });
-
-  $.getJSON("data/yelp_rating_points.json", function(points) {
-    points = filterPointsToBounds(points);
-    addPointsToMap("Business ratings", points);
-  });
-
-  $.getJSON("data/yelp_review_count_points.json", function(points) {
-    points = filterPointsToBounds(points);
-    addPointsToMap("Business review count", points);
-		console.log(points);
-		console.log(getHistogram(_.pluck(points, 2)));
-  });
+  var layerNames = {
+    yelp_price_points: "Business price point",
+    yelp_rating_points: "Business ratings",
+    yelp_review_count_points: "Business review count",
+  };
+
+  // Tiles under `baseUrl`, from the tile pyramid built by
+  // `datavis_transform.py` or from `data/serve.py`: only load the tiles in
+  // view at the current zoom. Bins below max zoom are
+  // `[lat, lng, sum, count, mean]`; max zoom tiles hold raw points.
+  // Most tiles a refresh requests; a view needing more shows nothing.
+  var MAX_TILES_PER_REFRESH = 64;
+
+  function loadTiledLayers(index, baseUrl) {
+    var tileCache = {};  // url -> points
+
+    function getTile(url) {
+      if (!tileCache[url]) {
+        tileCache[url] = $.getJSON(url).then(function(contents) {
+          return _.map(contents, function(p) {
+            return p.length === 5 ? [p[0], p[1], p[4]] : p;
+          });
+        }, function() {
+          return $.Deferred().resolve([]);  // Empty tiles aren't written
+        });
+      }
+      return tileCache[url];
+    }
+
+    function refreshLayer(layerName, heatLayer) {
+      if (!map.hasLayer(heatLayer)) {
+        return;
+      }
+      // Zoomed out past the pyramid, the view would take a tile request
+      // per min zoom tile, thousands of them, so show nothing instead.
+      if (map.getZoom() < index.min_zoom) {
+        heatLayer.setLatLngs([]);
+        return;
+      }
+      var z = Math.min(index.max_zoom, map.getZoom());
+      var bounds = map.getBounds();
+      var nw = map.project(bounds.getNorthWest(), z).divideBy(index.tile_size).floor(),
+          se = map.project(bounds.getSouthEast(), z).divideBy(index.tile_size).floor();
+      if ((se.x - nw.x + 1) * (se.y - nw.y + 1) > MAX_TILES_PER_REFRESH) {
+        heatLayer.setLatLngs([]);
+        return;
+      }
+      var requests = [];
+      for (var x = nw.x; x <= se.x; x++) {
+        for (var y = nw.y; y <= se.y; y++) {
+          requests.push(getTile(
+            baseUrl + layerName + "/" + z + "/" + x + "/" + y + ".json"));
+        }
+      }
+      $.when.apply($, requests).then(function() {
+        heatLayer.setLatLngs(_.flatten(_.toArray(arguments), true));
+      });
+    }
+
+    _.each(index.layers, function(layerName) {
+      var heatLayer = addPointsToMap(layerNames[layerName] || layerName, []);
+      var refresh = _.debounce(function() {
+        refreshLayer(layerName, heatLayer);
+      }, 100);
+      map.on('moveend zoomend', refresh);
+      heatLayer.on('add', refresh);
+      refresh();
+    });
+  }
+
+  // Binary point files written by `datavis_transform.py` (see
+  // `data/yelp/pointfile.py`), decoded straight into typed arrays.
+  function decodePointFile(buffer) {
+    var header = new DataView(buffer);
+    var magic = String.fromCharCode(
+      header.getUint8(0), header.getUint8(1),
+      header.getUint8(2), header.getUint8(3));
+    if (magic !== 'CPPT' || header.getUint8(4) !== 1) {
+      throw new Error('Not a version 1 point file');
+    }
+    var ValueArray = [Uint8Array, Int32Array, Float32Array][header.getUint8(5)],
+        count = header.getUint32(8, true),
+        originLat = header.getFloat64(12, true),
+        originLng = header.getFloat64(20, true),
+        scale = header.getFloat64(28, true),
+        offset = 36;
+    var dLat = new Int32Array(buffer, offset, count),
+        dLng = new Int32Array(buffer, offset + 4 * count, count),
+        values = new ValueArray(buffer, offset + 8 * count, count),
+        lat = new Float64Array(count),
+        lng = new Float64Array(count);
+    var qLat = 0, qLng = 0;
+    for (var i = 0; i < count; i++) {
+      qLat += dLat[i];
+      qLng += dLng[i];
+      lat[i] = originLat + qLat / scale;
+      lng[i] = originLng + qLng / scale;
+    }
+    return {lat: lat, lng: lng, values: values};
+  }
+
+  // Fetch the precompressed variant if the browser can decompress it.
+  function fetchPointFile(url) {
+    var gzipped = typeof DecompressionStream !== 'undefined';
+    return fetch(gzipped ? url + '.gz' : url).then(function(resp) {
+      if (!resp.ok) {
+        throw new Error('Failed to fetch ' + url);
+      }
+      if (gzipped) {
+        return new Response(
+          resp.body.pipeThrough(new DecompressionStream('gzip'))
+        ).arrayBuffer();
+      }
+      return resp.arrayBuffer();
+    }).then(decodePointFile);
+  }
+
+  function toPoints(decoded) {
+    var points = [];
+    for (var i = 0; i < decoded.lat.length; i++) {
+      if (!isNaN(decoded.values[i])) {
+        points.push([decoded.lat[i], decoded.lng[i], decoded.values[i]]);
+      }
+    }
+    return points;
+  }
+
+  // Load local point data, preferring binary point files over JSON.
+  function loadPoints(name) {
+    return fetchPointFile("data/" + name + ".bin").then(toPoints, function() {
+      return $.getJSON("data/" + name + ".json");
+    });
+  }
+
+  function loadPointLayers() {
+    _.each(layerNames, function(layerName, name) {
+      loadPoints(name).then(function(points) {
+        points = filterPointsToBounds(points);
+        addPointsToMap(layerName, points);
+        if (name === 'yelp_review_count_points') {
+          console.log(points);
+          console.log(getHistogram(_.pluck(points, 2)));
+        }
+      });
+    });
+  }
+
+  // Histogram of a layer's values in view, computed by `data/serve.py`.
+  function showServerHistogram(layerName) {
+    var bounds = map.getBounds();
+    $.getJSON("api/histogram", {
+      layer: layerName,
+      bbox: [bounds.getSouth(), bounds.getWest(),
+             bounds.getNorth(), bounds.getEast()].join(','),
+      bins: 4,
+      scale: 'log',
+    }).then(function(hist) {
+      $('#meta').text((layerNames[layerName] || layerName) + " in view: " +
+        _.map(hist.bins, function(bin) {
+          return Math.round(bin.x0) + "-" + Math.round(bin.x1) + ": " +
+            bin.count;
+        }).join(", "));
+    });
+  }
+
+  function loadServerLayers(index) {
+    loadTiledLayers(index, "api/tiles/");
+    var refresh = _.debounce(function() {
+      showServerHistogram('yelp_review_count_points');
+    }, 100);
+    map.on('moveend zoomend', refresh);
+    refresh();
+  }
+
+  // Prefer tiles served on demand by `data/serve.py`, then the tile pyramid
+  // if it has been built, then whole point files.
+  $.getJSON("api/tiles/index.json")
+    .done(loadServerLayers)
+    .fail(function() {
+      $.getJSON("data/tiles/index.json")
+        .done(function(index) {
+          loadTiledLayers(index, "data/tiles/");
+        })
+        .fail(loadPointLayers);
+    });
 
 	// Histogram fuckery
 	function getHistogram(values) {